@@ -1,11 +1,18 @@
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter
 from channels.routing import URLRouter
+from django.core.asgi import get_asgi_application
+from django.urls import re_path
 
-import main.urls
+django_asgi_application = get_asgi_application()
+
+import main.urls  # noqa: E402
 
 application = ProtocolTypeRouter(
     {
+        "http": URLRouter(
+            main.urls.http_urlpatterns + [re_path(r"", django_asgi_application)]
+        ),
         "websocket": AuthMiddlewareStack(URLRouter(main.urls.websocket_urlpatterns)),
     }
 )
@@ -146,13 +146,45 @@ DATABASES = {
 
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "main.cache.InstrumentedRedisCache",
         "LOCATION": f"redis://{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}/1",
         "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
         "KEY_PREFIX": "oat",
     }
 }
 
+# Warteschlange für Positionsberechnung, Geocoding und Websocket Benachrichtigung nach /update
+POSITION_QUEUE = {
+    "BACKEND": "main.jobs.RedisJobQueue",
+    "OPTIONS": {"key": "position", "prefix": "oat:jobs"},
+}
+
+# Prozesslokaler Index der Funkmasten (mcc, mnc, lac, cid) -> Koordinaten, BSIC und BTS
+# SNAPSHOT: mit "manage.py export_celltowers" erzeugte Datei, von allen Workern gemeinsam eingeblendet
+TOWER_INDEX = {
+    "MAXSIZE": 100_000,
+    "TTL": 600,
+    "SNAPSHOT": os.environ.get("CELLTOWER_SNAPSHOT"),
+}
+
+# Laterationsergebnisse: prozesslokale LRU (MAXSIZE, TTL in s) vor Redis (REDIS_TTL in s),
+# Abstände werden für den Schlüssel auf DISTANCE_STEP km gerundet
+LATERATION_CACHE = {
+    "MAXSIZE": 10_000,
+    "TTL": 3600,
+    "REDIS_TTL": 7 * 24 * 3600,
+    "DISTANCE_STEP": 0.01,
+}
+
+# Laufzeitmetriken für /metrics, die Prozesse führen ihre Histogramme über Redis zusammen
+METRICS = {
+    "ENABLED": True,
+    "REDIS": True,
+    "PREFIX": "oat:metrics",
+    "FLUSH_INTERVAL": 10,
+    "TOKEN": os.environ.get("METRICS_TOKEN"),
+}
+
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.sqlite3',
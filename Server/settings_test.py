@@ -0,0 +1,58 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+# Einstellungen für Tests und Lasttests ohne Redis, Postgres oder Docker:
+#   python manage.py test --settings=Server.settings_test
+#   python manage.py loadtest --in-process --settings=Server.settings_test
+# Mit gesetztem POSTGRES_HOST wird stattdessen eine lokale Postgres Datenbank verwendet.
+
+import os
+import tempfile
+
+_postgres = "POSTGRES_HOST" in os.environ
+for key, value in {
+    "POSTGRES_DB": "oat",
+    "POSTGRES_USER": "oat",
+    "POSTGRES_PASSWORD": "",
+    "POSTGRES_HOST": "localhost",
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+}.items():
+    os.environ.setdefault(key, value)
+
+from .settings import *  # noqa: E402,F401,F403
+
+if not _postgres:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(tempfile.gettempdir(), "oat.sqlite3"),
+            "OPTIONS": {"timeout": 30},
+        }
+    }
+
+CACHES = {"default": {"BACKEND": "main.cache.InstrumentedLocMemCache"}}
+CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+POSITION_QUEUE = {"BACKEND": "main.jobs.LocalJobQueue"}
+METRICS = {"ENABLED": True, "REDIS": False}
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+DEBUG = False
+DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
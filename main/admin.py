@@ -19,6 +19,7 @@ __author__ = "Patrick Frontzek"
 __copyright__ = "Copyright 2021, Patrick Frontzek"
 __license__ = "GPLv3"
 
+import json
 from django.contrib import admin
 from django.http import HttpResponseRedirect
 
@@ -48,10 +49,22 @@ class DeviceAdmin(admin.ModelAdmin):
         ("battery"),
         ("next_wake"),
     )
+    list_display = ("__str__", "last_seen", "battery", "status_count")
+    list_select_related = ("summary",)
 
     def battery(self, obj):
         return f"{obj.battery}V - {obj.battery_percentage}%"
 
+    @admin.display(description="Letzter Status", ordering="summary__timestamp")
+    def last_seen(self, obj):
+        summary = obj.get_summary()
+        return summary.timestamp if summary else None
+
+    @admin.display(description="Anzahl Status", ordering="summary__status_count")
+    def status_count(self, obj):
+        summary = obj.get_summary()
+        return summary.status_count if summary else 0
+
 
 admin.site.register(models.Celltower)
 
@@ -152,7 +165,10 @@ class StatusAdmin(admin.ModelAdmin):
     # inlines = [MeasurementInline,]
     change_form_template = "main/admin/status.html"
 
-    readonly_fields = (("error_list"),)
+    readonly_fields = (
+        ("error_list"),
+        ("parsed_data"),
+    )
 
     def changeform_view(self, request, object_id=None, form_url="", extra_context=None):
         extra_context = extra_context or {}
@@ -191,3 +207,6 @@ class StatusAdmin(admin.ModelAdmin):
 
     def error_list(self, obj):
         return "\r\n".join([e.listable_str() for e in obj.errors.all()])
+
+    def parsed_data(self, obj):
+        return json.dumps(obj.parsed_data, indent=2)
@@ -19,9 +19,11 @@ __author__ = "Patrick Frontzek"
 __copyright__ = "Copyright 2021, Patrick Frontzek"
 __license__ = "GPLv3"
 
-import json
+import logging
+import struct
 from dataclasses import dataclass
 from dataclasses import field
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 from django.http import HttpResponse
@@ -29,37 +31,44 @@ from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from enum import IntFlag
+from typing import Callable
+from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Tuple
 from typing import Union
 
+from . import metrics
+from .cache import tower_index
+from .jobs import enqueue_positions
+
+logger = logging.getLogger(__name__)
+
 
 class StructBase:
+    # ATMega Arduino: Little Endian
+    struct_format = "<"
+    _struct = struct.Struct(struct_format)
+
     def __init__(self, *args, **kwargs):
         pass
 
-    @classmethod
-    def __struct_format_string(cls) -> str:
-        return "<"  # ATMega Arduino: Little Endian
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Einmalig pro Layout kompilieren, statt den Formatstring bei jedem Aufruf neu zu parsen
+        cls._struct = struct.Struct(cls.struct_format)
 
     @classmethod
     def get_struct_format_string(cls) -> str:
-        if issubclass(cls, StructBase) and cls is not StructBase:
-            return f"{cls.__struct_format_string()}"
-        else:
-            return ""
+        return cls.struct_format
 
     @classmethod
     def struct_size(cls) -> int:
-        import struct
-
-        return struct.calcsize(cls.__struct_format_string())
+        return cls._struct.size
 
     @classmethod
     def from_struct(cls, buffer, offset=0):
-        import struct
-
-        return cls(*struct.unpack_from(cls.get_struct_format_string(), buffer, offset))
+        return cls(*cls._struct.unpack_from(buffer, offset))
 
 
 @dataclass
@@ -72,28 +81,7 @@ class TrackerUpdate(StructBase):
 
     imei = property(lambda self: int(f"{self.imei_high}{self.imei_low}"))
 
-    @classmethod
-    def __struct_format_string(cls) -> str:
-        return "< 2I f 2I"
-
-    @classmethod
-    def struct_size(cls) -> int:
-        import struct
-
-        return struct.calcsize(cls.__struct_format_string())
-
-    @classmethod
-    def from_struct(cls, buffer, offset=0):
-        import struct
-
-        data = struct.unpack_from(cls.__struct_format_string(), buffer, offset)
-        return cls(
-            imei_high=data[0],
-            imei_low=data[1],
-            spannung=data[2],
-            uplink=data[3],
-            uplink_success=data[4],
-        )
+    struct_format = "< 2I f 2I"
 
 
 class ExtrasFlags(IntFlag):
@@ -102,6 +90,11 @@ class ExtrasFlags(IntFlag):
     OPTION_NO_WAITTIME = 1 << 2
     VOLTAGE_RAW = 1 << 3
     ERROR_CODE = 1 << 4
+    # Tracker möchte eine Quittung der gespeicherten Zellen (CELL_BITMAP an die Antwort angehängt)
+    CELL_ACK = 1 << 5
+    # Vor den Zellen steht ein CELL_BITMAP, welche Zellen der letzten Quittung weiterhin gültig sind,
+    # danach folgen nur neue bzw. geänderte Zellen
+    CELL_DELTA = 1 << 6
 
 
 @dataclass
@@ -116,6 +109,12 @@ class UpdateHeader(StructBase):
     voltage_raw: int = 0
     voltage_ref: int = 0
 
+    struct_format = "< Q f 2I 3B"
+    # Mit ExtrasFlags.VOLTAGE_RAW liegen an Stelle der float Spannung zwei uint16 (Referenz, Rohwert)
+    struct_format_voltage_raw = "< Q 2H 2I 3B"
+    _voltage_raw_struct = struct.Struct("< 2H")
+    _voltage_raw_offset = struct.calcsize("< Q")
+
     @property
     def has_raw_voltage(self):
         return ExtrasFlags.VOLTAGE_RAW in self.extras_flags
@@ -129,90 +128,97 @@ class UpdateHeader(StructBase):
         return ExtrasFlags.VOLTAGE in self.extras_flags
 
     @classmethod
-    def __struct_format_string(cls, voltage_raw=False) -> str:
-        if voltage_raw:
-            return "< Q 2H 2I 3B"
-        else:
-            return "< Q f 2I 3B"
+    def get_struct_format_string(cls, voltage_raw=False) -> str:
+        return cls.struct_format_voltage_raw if voltage_raw else cls.struct_format
 
     @classmethod
     def struct_size(cls, voltage_raw=False) -> int:
-        import struct
-
-        return struct.calcsize(cls.__struct_format_string(voltage_raw))
+        # Beide Varianten sind gleich lang
+        return cls._struct.size
 
     @classmethod
     def from_struct(cls, buffer, offset=0):
-        import struct
-
-        data = struct.unpack_from(cls.__struct_format_string(), buffer, offset)
+        (
+            imei,
+            spannung,
+            uplink,
+            uplink_success,
+            version,
+            cells_length,
+            extras_flags,
+        ) = cls._struct.unpack_from(buffer, offset)
         obj = cls(
-            imei=data[0],
-            spannung=data[1],
-            uplink=data[2],
-            uplink_success=data[3],
-            version=data[4],
-            cells_length=data[5],
-            extras_flags=ExtrasFlags(data[6]),
+            imei=imei,
+            spannung=spannung,
+            uplink=uplink,
+            uplink_success=uplink_success,
+            version=version,
+            cells_length=cells_length,
+            extras_flags=ExtrasFlags(extras_flags),
         )
         if obj.has_raw_voltage:
-            data = struct.unpack_from(cls.__struct_format_string(True), buffer, offset)
-            obj = cls(
-                imei=data[0],
-                voltage_ref=data[1],
-                voltage_raw=data[2],
-                uplink=data[3],
-                uplink_success=data[4],
-                version=data[5],
-                cells_length=data[6],
-                extras_flags=ExtrasFlags(data[7]),
+            obj.spannung = 0.0
+            obj.voltage_ref, obj.voltage_raw = cls._voltage_raw_struct.unpack_from(
+                buffer, offset + cls._voltage_raw_offset
             )
         return obj
 
 
 @dataclass
-class CengResult(StructBase):
-    mode: int
-    cells_length: int
+class BatchHeader(StructBase):
+    imei: int
+    uplink: int
+    uplink_success: int
+    version: int
+    reports_length: int
+    extras_flags: ExtrasFlags
 
-    @classmethod
-    def __struct_format_string(cls):
-        return "< 2B"
+    # Version 5: mehrere gepufferte Reports in einem Upload, die 4 Füllbytes halten die Version an Offset 20
+    struct_format = "< Q 4x 2I 3B"
+    _reports_length_offset = struct.calcsize("< Q 4x 2I B")
 
     @classmethod
-    def struct_size(cls) -> int:
-        import struct
+    def from_struct(cls, buffer, offset=0):
+        obj = super().from_struct(buffer, offset)
+        obj.extras_flags = ExtrasFlags(obj.extras_flags)
+        return obj
+
+
+@dataclass
+class ReportHeader(StructBase):
+    age: int
+    voltage_ref: int
+    voltage_raw: int
+    cells_length: int
+    extras_flags: ExtrasFlags
 
-        return struct.calcsize(cls.__struct_format_string())
+    # Pro Report: Alter in Sekunden relativ zum Upload, Spannung immer als Rohwert
+    struct_format = "< I 2H 2B"
 
     @classmethod
     def from_struct(cls, buffer, offset=0):
-        import struct
+        obj = super().from_struct(buffer, offset)
+        obj.extras_flags = ExtrasFlags(obj.extras_flags)
+        return obj
 
-        data = struct.unpack_from(cls.__struct_format_string(), buffer, offset)
-        return cls(mode=data[0], cells_length=data[1])
+
+@dataclass
+class CengResult(StructBase):
+    mode: int
+    cells_length: int
+
+    struct_format = "< 2B"
 
 
 @dataclass
 class Extras(StructBase):
     tempratur: float
 
-    @classmethod
-    def __struct_format_string(cls):
-        return "< h"
-
-    @classmethod
-    def struct_size(cls) -> int:
-        import struct
-
-        return struct.calcsize(cls.__struct_format_string())
+    struct_format = "< h"
 
     @classmethod
     def from_struct(cls, buffer, offset=0):
-        import struct
-
-        data = struct.unpack_from(cls.__struct_format_string(), buffer, offset)
-        return cls(tempratur=data[0] / 4)
+        return cls(tempratur=cls._struct.unpack_from(buffer, offset)[0] / 4)
 
 
 @dataclass
@@ -229,29 +235,11 @@ class Cell(StructBase):
     dbm = property(lambda self: -113 + self.rxl)
     rssi = property(lambda self: self.rxl / 2)
 
-    @classmethod
-    def __struct_format_string(cls):
-        return "< 4H 2B"
-
-    @classmethod
-    def struct_size(cls) -> int:
-        import struct
-
-        return struct.calcsize(cls.__struct_format_string())
+    struct_format = "< 4H 2B"
 
-    @classmethod
-    def from_struct(cls, buffer, offset=0):
-        import struct
-
-        data = struct.unpack_from(cls.__struct_format_string(), buffer, offset)
-        return cls(
-            mcc=data[0],
-            mnc=data[1],
-            lac=data[2],
-            cellid=data[3],
-            bsic=data[4],
-            rxl=data[5],
-        )
+    @property
+    def key(self) -> Tuple[int, int, int, int]:
+        return self.mcc, self.mnc, self.lac, self.cellid
 
 
 @dataclass
@@ -262,6 +250,8 @@ class CellV2(Cell):
     frequency_downlink: float = 0.0
     band: str = ""
 
+    struct_format = "< 4H 2B H"
+
     def __post_init__(self):
         if self.arfcn == (2 ** 16) - 1:
             self.arfcn = 0
@@ -294,31 +284,6 @@ class CellV2(Cell):
             self.frequency_downlink = self.frequency_uplink + 45
             self.band = "GSM 900"
 
-    @classmethod
-    def __struct_format_string(cls):
-        return "< 4H 2B H"
-
-    @classmethod
-    def struct_size(cls) -> int:
-        import struct
-
-        return struct.calcsize(cls.__struct_format_string())
-
-    @classmethod
-    def from_struct(cls, buffer, offset=0):
-        import struct
-
-        data = struct.unpack_from(cls.__struct_format_string(), buffer, offset)
-        return cls(
-            mcc=data[0],
-            mnc=data[1],
-            lac=data[2],
-            cellid=data[3],
-            bsic=data[4],
-            rxl=data[5],
-            arfcn=data[6],
-        )
-
 
 class ErrorFlags(IntFlag):
     EXEC = (1 << 0) << 3
@@ -339,25 +304,408 @@ class Errors:
     length: int = 0
     values: List[Tuple[ErrorFlags, int]] = field(default_factory=list)
     datatype = "H"
+    _length_struct = struct.Struct("< B")
+    _value_struct = struct.Struct(f"< {datatype}")
 
     @classmethod
     def build(cls, offset: int, buffer):
-        import struct
-
-        obj = cls(length=struct.unpack_from("< B", buffer, offset)[0])
-        errors = struct.unpack_from(
-            f"< {obj.length}{cls.datatype}", buffer, offset + struct.calcsize("< B")
-        )
-        obj.values = [parse_error(e) for e in errors]
+        obj = cls(length=cls._length_struct.unpack_from(buffer, offset)[0])
+        start = offset + cls._length_struct.size
+        end = start + obj.length * cls._value_struct.size
+        if len(buffer) < end:
+            raise struct.error(f"unpack requires a buffer of {end} bytes")
+        obj.values = [
+            parse_error(e) for e, in cls._value_struct.iter_unpack(buffer[start:end])
+        ]
         return obj
 
     def struct_format_string(self):
         return f"< B {self.length}{self.datatype}"
 
     def struct_size(self) -> int:
-        import struct
+        return self._length_struct.size + self.length * self._value_struct.size
 
-        return struct.calcsize(self.struct_format_string())
+
+@dataclass
+class DecodedUpdate:
+    version: int
+    imei: int
+    header: Union[TrackerUpdate, UpdateHeader]
+    cells: List[Union[Cell, CellV2]] = field(default_factory=list)
+    extras_flags: ExtrasFlags = ExtrasFlags(0)
+    extras: Optional[Extras] = None
+    errors: Optional[Errors] = None
+    temp: Optional[float] = None
+    voltage_raw: Optional[float] = None
+    voltage_ref: Optional[int] = None
+    # Sekunden vor dem Upload und eigenständiger Payload des Reports (nur Version 5)
+    age: int = 0
+    raw: Optional[bytes] = None
+    # Nur mit ExtrasFlags.CELL_DELTA: Bitmap der übernommenen Zellen des vorherigen Status
+    delta_keep: Optional[int] = None
+    cells_unchanged: bool = False
+    previous: Optional[object] = None
+    # Bitmap der gespeicherten Zellen, Quittung für ExtrasFlags.CELL_ACK
+    stored_cells: int = 0
+
+    @property
+    def reports(self) -> List["DecodedUpdate"]:
+        return [self]
+
+
+@dataclass
+class DecodedBatch:
+    version: int
+    imei: int
+    header: BatchHeader
+    extras_flags: ExtrasFlags = ExtrasFlags(0)
+    reports: List[DecodedUpdate] = field(default_factory=list)
+
+
+_decoders: Dict[int, Callable[[memoryview], Union[DecodedUpdate, DecodedBatch]]] = {}
+
+# Alle Header teilen sich die ersten 20 Byte, danach folgt die Protokollversion
+VERSION_OFFSET = TrackerUpdate.struct_size()
+# Antwort an den Tracker: Serverzeit, nächste Weckzeit, Differenz
+WAKE_RESPONSE = struct.Struct("< 3L")
+# Bit i steht für die i-te Zelle der Liste in Speicherreihenfolge
+CELL_BITMAP = struct.Struct("< H")
+CELL_BITMAP_BITS = CELL_BITMAP.size * 8
+
+
+def register_decoder(version: int):
+    def decorator(decoder: Callable[[memoryview], Union[DecodedUpdate, DecodedBatch]]):
+        _decoders[version] = decoder
+        return decoder
+
+    return decorator
+
+
+def decode_update(body: bytes) -> Union[DecodedUpdate, DecodedBatch]:
+    buffer = memoryview(body)
+    version = buffer[VERSION_OFFSET]
+    try:
+        decoder = _decoders[version]
+    except KeyError:
+        raise ValueError(f"Unknown payload version {version}")
+    return decoder(buffer)
+
+
+def _add_cell(cells: List[Union[Cell, CellV2]], cell: Union[Cell, CellV2]):
+    if cell.mcc == 0 or cell.mnc == 0:
+        return
+    for c in cells:
+        if c.key == cell.key:
+            if c.rxl < cell.rxl:
+                c.rxl = cell.rxl
+                if isinstance(c, CellV2):
+                    c.arfcn = cell.arfcn
+            if c.bsic != cell.bsic:
+                print("BSIC MISMATCH")
+            return
+    cells.append(cell)
+
+
+def _decode_cells(
+    cell_class, buffer: memoryview, offset: int, length: int
+) -> List[Union[Cell, CellV2]]:
+    cells: List[Union[Cell, CellV2]] = []
+    end = offset + length * cell_class.struct_size()
+    if len(buffer) < end:
+        raise struct.error(f"unpack requires a buffer of {end} bytes")
+    for data in cell_class._struct.iter_unpack(buffer[offset:end]):
+        _add_cell(cells, cell_class(*data))
+    return cells
+
+
+@register_decoder(3)
+def _decode_v3(buffer: memoryview) -> DecodedUpdate:
+    header = TrackerUpdate.from_struct(buffer)
+    offset = TrackerUpdate.struct_size()
+    ceng = CengResult.from_struct(buffer, offset)
+    offset += CengResult.struct_size()
+    decoded = DecodedUpdate(
+        version=3,
+        imei=header.imei,
+        header=header,
+        cells=_decode_cells(Cell, buffer, offset, ceng.cells_length),
+        voltage_raw=header.spannung,
+    )
+    offset += ceng.cells_length * Cell.struct_size()
+    if len(buffer) >= offset + Extras.struct_size():
+        decoded.extras = Extras.from_struct(buffer, offset)
+        decoded.temp = decoded.extras.tempratur
+    return decoded
+
+
+@register_decoder(4)
+def _decode_v4(buffer: memoryview) -> DecodedUpdate:
+    header = UpdateHeader.from_struct(buffer)
+    offset = UpdateHeader.struct_size()
+    delta_keep = None
+    if ExtrasFlags.CELL_DELTA in header.extras_flags:
+        (delta_keep,) = CELL_BITMAP.unpack_from(buffer, offset)
+        offset += CELL_BITMAP.size
+    decoded = DecodedUpdate(
+        version=4,
+        imei=header.imei,
+        header=header,
+        cells=_decode_cells(CellV2, buffer, offset, header.cells_length),
+        extras_flags=header.extras_flags,
+        delta_keep=delta_keep,
+    )
+    offset += header.cells_length * CellV2.struct_size()
+    decoded.extras = Extras.from_struct(buffer, offset)
+    offset += Extras.struct_size()
+
+    if header.has_temperature:
+        decoded.temp = decoded.extras.tempratur
+    if header.has_voltage:
+        if header.has_raw_voltage:
+            decoded.voltage_raw = header.voltage_raw
+            decoded.voltage_ref = header.voltage_ref
+        else:
+            decoded.voltage_raw = header.spannung
+    if ExtrasFlags.ERROR_CODE in header.extras_flags:
+        try:
+            decoded.errors = Errors.build(buffer=buffer, offset=offset)
+        except Exception as e:
+            print(e)
+    return decoded
+
+
+@register_decoder(5)
+def _decode_v5(buffer: memoryview) -> DecodedBatch:
+    header = BatchHeader.from_struct(buffer)
+    batch = DecodedBatch(
+        version=5, imei=header.imei, header=header, extras_flags=header.extras_flags
+    )
+    # Jeder Report wird als eigenständiger v5 Payload mit genau einem Report abgelegt
+    single_header = bytearray(buffer[: BatchHeader.struct_size()])
+    single_header[BatchHeader._reports_length_offset] = 1
+    offset = BatchHeader.struct_size()
+    for _ in range(header.reports_length):
+        start = offset
+        report = ReportHeader.from_struct(buffer, offset)
+        offset += ReportHeader.struct_size()
+        decoded = DecodedUpdate(
+            version=5,
+            imei=header.imei,
+            header=report,
+            cells=_decode_cells(CellV2, buffer, offset, report.cells_length),
+            extras_flags=report.extras_flags,
+            age=report.age,
+        )
+        offset += report.cells_length * CellV2.struct_size()
+        decoded.extras = Extras.from_struct(buffer, offset)
+        offset += Extras.struct_size()
+        if ExtrasFlags.TEMPERATURE in report.extras_flags:
+            decoded.temp = decoded.extras.tempratur
+        if ExtrasFlags.VOLTAGE in report.extras_flags:
+            decoded.voltage_raw = report.voltage_raw
+            decoded.voltage_ref = report.voltage_ref
+        if ExtrasFlags.ERROR_CODE in report.extras_flags:
+            # Anders als bei v4 nicht ignorierbar, sonst stimmt der Offset der folgenden Reports nicht
+            decoded.errors = Errors.build(buffer=buffer, offset=offset)
+            offset += decoded.errors.struct_size()
+        decoded.raw = bytes(single_header) + bytes(buffer[start:offset])
+        batch.reports.append(decoded)
+    return batch
+
+
+def _encode_v4(decoded: DecodedUpdate) -> bytes:
+    """Vollständiger v4 Payload ohne CELL_DELTA, damit raw_data auch ohne den vorherigen Status lesbar bleibt."""
+    header = decoded.header
+    flags = header.extras_flags & ~ExtrasFlags.CELL_DELTA
+    voltage = (
+        (header.voltage_ref, header.voltage_raw)
+        if header.has_raw_voltage
+        else (header.spannung,)
+    )
+    body = struct.pack(
+        UpdateHeader.get_struct_format_string(voltage_raw=header.has_raw_voltage),
+        header.imei,
+        *voltage,
+        header.uplink,
+        header.uplink_success,
+        header.version,
+        len(decoded.cells),
+        flags,
+    )
+    for cell in decoded.cells:
+        body += CellV2._struct.pack(
+            cell.mcc, cell.mnc, cell.lac, cell.cellid, cell.bsic, cell.rxl, cell.arfcn
+        )
+    body += Extras._struct.pack(round(decoded.extras.tempratur * 4))
+    if decoded.errors:
+        body += Errors._length_struct.pack(decoded.errors.length)
+        for flags, code in decoded.errors.values:
+            body += Errors._value_struct.pack((flags.value << 10) | code)
+    return body
+
+
+def _resolve_delta(device, decoded: DecodedUpdate):
+    """Ergänzt die übernommenen Zellen aus dem letzten Status des Geräts.
+
+    Die Bits von delta_keep beziehen sich wie die Quittung auf die vollständige Zellliste des vorherigen
+    Uploads, einschließlich unbekannter Funkmasten, diese steht in dessen raw_data. Reihenfolge danach:
+    zuerst die übernommenen Zellen, danach die neuen Zellen. Auf diese Liste bezieht sich die nächste Quittung.
+    """
+    previous = device.last_position if device else None
+    kept: List[CellV2] = []
+    previous_count = 0
+    if previous is not None and previous.payload:
+        previous_cells = decode_update(previous.payload).cells[:CELL_BITMAP_BITS]
+        towers = tower_index.get_many(cell.key for cell in previous_cells)
+        for i, cell in enumerate(previous_cells):
+            if towers.get(cell.key) is None:
+                # Nicht gespeichert und daher auch nicht quittiert
+                continue
+            previous_count += 1
+            if decoded.delta_keep >> i & 1:
+                kept.append(
+                    CellV2(
+                        cell.mcc,
+                        cell.mnc,
+                        cell.lac,
+                        cell.cellid,
+                        cell.bsic,
+                        cell.rxl,
+                        getattr(cell, "arfcn", 0),
+                    )
+                )
+    changed = {cell.key for cell in decoded.cells}
+    decoded.cells_unchanged = (
+        previous is not None
+        and not previous.position_pending
+        and not changed
+        and len(kept) == previous_count > 0
+    )
+    decoded.previous = previous
+    decoded.cells = [cell for cell in kept if cell.key not in changed] + decoded.cells
+    decoded.raw = _encode_v4(decoded)
+
+
+def store_reports(device, reports: List[DecodedUpdate], body: bytes, timestamp=None):
+    """Legt Status, Fehler und Messungen aller Reports eines Uploads mit einer festen Anzahl an Abfragen an."""
+    from datetime import timedelta
+    from django.utils import timezone
+
+    from . import models
+
+    received = timestamp or timezone.now()
+    for decoded in reports:
+        if decoded.delta_keep is not None:
+            with metrics.timed("delta"):
+                _resolve_delta(device, decoded)
+
+    statuses: List[models.Status] = []
+    for decoded in reports:
+        status = models.Status(
+            device=device,
+            lat=0.0,
+            lon=0.0,
+            timestamp=received - timedelta(seconds=decoded.age),
+            radius=0.0,
+            position_pending=True,
+            raw_data=decoded.raw or body,
+        )
+        if decoded.temp is not None:
+            status.temp = decoded.temp
+        if decoded.voltage_raw is not None:
+            status.voltage_raw = decoded.voltage_raw
+        if decoded.voltage_ref is not None:
+            status.voltage_ref = decoded.voltage_ref
+        status.calc_battery(device)
+        if decoded.cells_unchanged:
+            # Gleiche Zellen wie beim letzten Mal, Lateration und Geocoding ergeben dasselbe
+            previous = decoded.previous
+            status.lat, status.lon, status.radius = (
+                previous.lat,
+                previous.lon,
+                previous.radius,
+            )
+            status.city_id = previous.city_id
+            status.position_pending = False
+            status.position_source = models.Status.PositionSource.copied
+        statuses.append(status)
+
+    with transaction.atomic():
+        with metrics.timed("celltowers"):
+            towers = tower_index.get_many(
+                cell.key for decoded in reports for cell in decoded.cells
+            )
+        measurements: List[models.Measurement] = []
+        changed: Dict[int, models.Celltower] = {}
+        for status, decoded in zip(statuses, reports):
+            decoded.stored_cells = 0
+            status_measurements: List[models.Measurement] = []
+            for i, cell in enumerate(decoded.cells):
+                tower = towers.get(cell.key)
+                if tower is None:
+                    print(f"Unknown celltower {cell}")
+                    continue
+                if i < CELL_BITMAP_BITS:
+                    decoded.stored_cells |= 1 << i
+                if tower.bsic is None or tower.bsic != cell.bsic:
+                    # Nur die Felder, die update_celltower_bsics braucht
+                    changed[tower.id] = models.Celltower(
+                        id=tower.id,
+                        mcc=tower.mcc,
+                        mnc=tower.mnc,
+                        lac=tower.lac,
+                        cid=tower.cid,
+                        bsic=cell.bsic,
+                        bts_id=tower.bts_id,
+                    )
+                # status_id wird von bulk_create nach dem Speichern der Status übernommen
+                measurement = models.Measurement(
+                    celltower_id=tower.id, status=status, rxl=cell.rxl
+                )
+                measurement.tower = tower
+                if isinstance(cell, CellV2):
+                    measurement.arfcn = cell.arfcn
+                status_measurements.append(measurement)
+            # Wie Status.clean_measurements, mit den Funkmasten aus dem Index
+            status.set_cleaned_measurements(
+                models.deduplicate_measurements(status_measurements)
+            )
+            measurements += status_measurements
+
+        with metrics.timed("status_write"):
+            models.Status.objects.bulk_create(statuses)
+            # Wie Status.save, bulk_create ruft save() nicht auf
+            newest = max(statuses, key=lambda s: s.timestamp)
+            if (
+                device.last_position is None
+                or device.last_position.timestamp < newest.timestamp
+            ):
+                device.last_position = newest
+                device.save(update_position=False)
+            else:
+                newest = None
+
+        errors: List[models.Error] = []
+        for status, decoded in zip(statuses, reports):
+            if decoded.errors:
+                errors += [
+                    models.Error(
+                        nr=i, status=status, flags=error[0].value, code=error[1]
+                    )
+                    for i, error in enumerate(decoded.errors.values)
+                ]
+        if errors:
+            models.Error.objects.bulk_create(errors)
+        models.DeviceSummary.record(device, len(statuses), newest, errors)
+
+        with metrics.timed("measurement_write"):
+            models.update_celltower_bsics(list(changed.values()))
+            models.Measurement.objects.bulk_create(measurements)
+    return statuses
+
+
+def store_update(device, decoded: DecodedUpdate, body: bytes, timestamp=None):
+    return store_reports(device, [decoded], body, timestamp=timestamp)[0]
 
 
 def update_bts(request):
@@ -369,220 +717,100 @@ def update_bts(request):
     return HttpResponse("OK")
 
 
+@metrics.timed("wake")
+def wake_response(device, decoded: Union[DecodedUpdate, DecodedBatch, None]) -> bytes:
+    """Antwort an den Tracker; setzt device.next_wake, speichert aber nicht."""
+    from datetime import timedelta
+    from django.utils import timezone
+
+    time_now = timezone.now()
+    if device:
+        if (
+            decoded
+            and ExtrasFlags.OPTION_NO_WAITTIME in decoded.extras_flags
+            and device.sleeptime == 0
+        ):
+            time_next = time_now
+        else:
+            time_next = device.get_next_waketime()
+        device.next_wake = time_next
+    else:
+        time_next = time_now + timedelta(minutes=1)
+    time_diff = int(time_next.timestamp()) - int(time_now.timestamp())
+    # time_next += timedelta(minutes=5)
+    # time_next -= timedelta(minutes=time_next.minute % 5, seconds=time_next.second)
+    print(f"{time_now} - {time_next} - {time_diff}")
+    response = WAKE_RESPONSE.pack(
+        int(timezone.now().timestamp()),
+        int(time_next.timestamp()),
+        time_diff,
+    )
+    if (
+        isinstance(decoded, DecodedUpdate)
+        and ExtrasFlags.CELL_ACK in decoded.extras_flags
+    ):
+        # Ohne gespeicherte Zellen ist die Quittung 0, der Tracker sendet dann wieder die vollständige Liste
+        response += CELL_BITMAP.pack(decoded.stored_cells)
+    return response
+
+
 @method_decorator(csrf_exempt, "dispatch")
 class StatusView(View):
     def post(self, request: HttpRequest):
-        print(len(request.body))
-        import struct
-        from datetime import timedelta
-        from django.utils import timezone
+        with metrics.scope("upload"):
+            return self._post(request)
 
+    def _post(self, request: HttpRequest):
+        print(len(request.body))
         device = None
-        header = None
+        decoded = None
         try:
-            from base64 import b64encode
-
             from . import models
 
-            cells: List[Union[Cell, CellV2]] = []
-            version = struct.unpack_from(
-                "< B", request.body, offset=TrackerUpdate.struct_size()
-            )[0]
-            status: models.Status
-
-            if version == 3:
-                trackerUpdate = TrackerUpdate.from_struct(request.body)
-                print(trackerUpdate)
-                cengResponse = CengResult.from_struct(
-                    request.body, offset=TrackerUpdate.struct_size()
-                )
-                device, device_created = models.Device.objects.get_or_create(
-                    sn=trackerUpdate.imei
-                )
-                for i in range(cengResponse.cells_length):
-                    cell = Cell.from_struct(
-                        request.body,
-                        offset=TrackerUpdate.struct_size()
-                        + CengResult.struct_size()
-                        + i * Cell.struct_size(),
-                    )
-                    if cell.mcc != 0 and cell.mnc != 0:
-                        found = False
-                        for c in cells:
-                            if (
-                                c.mcc == cell.mcc
-                                and c.mnc == cell.mnc
-                                and c.cellid == cell.cellid
-                                and c.lac == cell.lac
-                            ):
-                                found = True
-                                c.rxl = c.rxl if c.rxl > cell.rxl else cell.rxl
-                                if c.bsic != cell.bsic:
-                                    print("BSIC MISMATCH")
-                        if not found:
-                            cells.append(cell)
-                status = models.Status(
-                    device=device,
-                    lat=0.0,
-                    lon=0.0,
-                    timestamp=timezone.now(),
-                    radius=0.0,
-                    voltage_raw=trackerUpdate.spannung,
-                    raw_data=b64encode(request.body),
-                    parsed_data=json.dumps(
-                        (repr(trackerUpdate), repr(cengResponse), repr(cells))
-                    ),
-                )
-                if len(
-                    request.body
-                ) >= TrackerUpdate.struct_size() + CengResult.struct_size() + cengResponse.cells_length * Cell.struct_size() + struct.calcsize(
-                    "< h"
-                ):
-                    status.temp = (
-                        struct.unpack_from(
-                            "< h",
-                            request.body,
-                            TrackerUpdate.struct_size()
-                            + CengResult.struct_size()
-                            + cengResponse.cells_length * Cell.struct_size(),
-                        )[0]
-                        / 4
-                    )
-                status.save()
-            elif version == 4:
-                header = UpdateHeader.from_struct(request.body)
-                print(header)
+            with metrics.timed("decode"):
+                decoded = decode_update(request.body)
+            print(decoded.header)
+            with metrics.timed("device"):
                 device, device_created = models.Device.objects.get_or_create(
-                    sn=header.imei
+                    sn=decoded.imei
                 )
+            statuses = store_reports(device, decoded.reports, request.body)
+            # Position, Stadt und Benachrichtigung übernimmt der Worker, der Tracker wartet nur auf die Weckzeit
+            with metrics.timed("enqueue"):
+                enqueue_positions(statuses)
+        except Exception as e:
+            print(e)
+            metrics.inc("upload_error")
+        response = HttpResponse(wake_response(device, decoded), status=200)
+        device.save()
+        return response
 
-                for i in range(header.cells_length):
-                    cell = CellV2.from_struct(
-                        request.body,
-                        offset=UpdateHeader.struct_size() + i * CellV2.struct_size(),
-                    )
-                    if cell.mcc != 0 and cell.mnc != 0:
-                        found = False
-                        for c in cells:
-                            if (
-                                c.mcc == cell.mcc
-                                and c.mnc == cell.mnc
-                                and c.cellid == cell.cellid
-                                and c.lac == cell.lac
-                            ):
-                                found = True
-                                if c.rxl < cell.rxl:
-                                    c.rxl = cell.rxl
-                                    c.arfcn = cell.arfcn
-                                if c.bsic != cell.bsic:
-                                    print("BSIC MISMATCH")
-                        if not found:
-                            cells.append(cell)
-
-                extras = Extras.from_struct(
-                    request.body,
-                    offset=UpdateHeader.struct_size()
-                    + header.cells_length * CellV2.struct_size(),
-                )
 
-                status = models.Status(
-                    device=device,
-                    lat=0.0,
-                    lon=0.0,
-                    timestamp=timezone.now(),
-                    radius=0.0,
-                    raw_data=b64encode(request.body),
-                    parsed_data=json.dumps((repr(header), repr(extras), repr(cells))),
-                )
-                if ExtrasFlags.TEMPERATURE in header.extras_flags:
-                    status.temp = extras.tempratur
-                if ExtrasFlags.VOLTAGE in header.extras_flags:
-                    if ExtrasFlags.VOLTAGE_RAW in header.extras_flags:
-                        status.voltage_raw = header.voltage_raw
-                        status.voltage_ref = header.voltage_ref
-                    else:
-                        status.voltage_raw = header.spannung
-                status.save()
-                if ExtrasFlags.ERROR_CODE in header.extras_flags:
-                    try:
-                        print(
-                            UpdateHeader.struct_size()
-                            + header.cells_length * CellV2.struct_size()
-                        )
-                        errors = Errors.build(
-                            buffer=request.body,
-                            offset=UpdateHeader.struct_size()
-                            + header.cells_length * CellV2.struct_size()
-                            + extras.struct_size(),
-                        )
-                        for i, error in enumerate(errors.values):
-                            models.Error(
-                                nr=i, status=status, flags=error[0].value, code=error[1]
-                            ).save()
-                    except Exception as e:
-                        print(e)
-                        pass
-            for cell in cells:
-                try:
-                    celltower = models.Celltower.objects.get(
-                        mnc=cell.mnc, mcc=cell.mcc, lac=cell.lac, cid=cell.cellid
-                    )
-                    if celltower.bsic is None or celltower.bsic != cell.bsic:
-                        celltower.bsic = cell.bsic
-                        celltower.save()
-                    measurement = models.Measurement(
-                        celltower=celltower, status=status, rxl=cell.rxl
-                    )
-                    if version == 4:
-                        measurement.arfcn = cell.arfcn
-                    measurement.save()
-                except Exception as e:
-                    print(e)
-            status.new_calc_location()
-            print(status.point)
-            status.set_city()
-            from asgiref.sync import async_to_sync
-            from channels.layers import get_channel_layer
-
-            async_to_sync(get_channel_layer().group_send)(
-                "device",
-                {
-                    "type": "device_update",
-                    "message": {"device": device.sn, "status": status.id},
-                },
-            )
-            for user in device.users.all():
-                async_to_sync(get_channel_layer().group_send)(
-                    "user",
-                    {"type": "user_update", "user": user.id, "device": device.sn},
+async def ingest_async(body: bytes) -> bytes:
+    """Wie StatusView.post, aber ohne einen Thread pro Verbindung zu blockieren."""
+    from asgiref.sync import sync_to_async
+
+    from . import models
+
+    with metrics.scope("upload"):
+        device = None
+        decoded = None
+        try:
+            with metrics.timed("decode"):
+                decoded = decode_update(body)
+            logger.debug("%s", decoded.header)
+            with metrics.timed("device"):
+                device, device_created = await models.Device.objects.aget_or_create(
+                    sn=decoded.imei
                 )
-        except Exception as e:
-            print(e)
-        time_now = timezone.now()
+            # Transaktionen gibt es im async ORM nicht, der Schreibpfad läuft daher gesammelt in einem Thread
+            statuses = await sync_to_async(store_reports)(device, decoded.reports, body)
+            with metrics.timed("enqueue"):
+                await sync_to_async(enqueue_positions)(statuses)
+        except Exception:
+            logger.exception("Upload fehlgeschlagen")
+            metrics.inc("upload_error")
+        response = wake_response(device, decoded)
         if device:
-            if (
-                header
-                and ExtrasFlags.OPTION_NO_WAITTIME in header.extras_flags
-                and device.sleeptime == 0
-            ):
-                time_next = time_now
-            else:
-                time_next = device.get_next_waketime()
-        else:
-            time_next = time_now + timedelta(minutes=1)
-        time_diff = int(time_next.timestamp()) - int(time_now.timestamp())
-        # time_next += timedelta(minutes=5)
-        # time_next -= timedelta(minutes=time_next.minute % 5, seconds=time_next.second)
-        print(f"{time_now} - {time_next} - {time_diff}")
-        response = HttpResponse(
-            struct.pack(
-                "< 3L",
-                int(timezone.now().timestamp()),
-                int(time_next.timestamp()),
-                time_diff,
-            ),
-            status=200,
-        )
-        device.next_wake = time_next
-        device.save()
+            await device.asave(update_fields=["next_wake"])
         return response
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     name = "main"
+
+    def ready(self):
+        # Registriert den Abfragezähler für neue Datenbankverbindungen
+        from . import metrics  # noqa: F401
@@ -0,0 +1,526 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import functools
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django_redis.cache import RedisCache
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+from geopy import Point
+
+from . import metrics
+
+DEFAULT_TOWER_INDEX = {
+    "MAXSIZE": 100_000,
+    "TTL": 600,
+    "SNAPSHOT": None,
+    "RECHECK": 30,
+    "DIRTY_TTL": 7 * 24 * 3600,
+}
+DEFAULT_LATERATION_CACHE = {
+    "MAXSIZE": 10_000,
+    "TTL": 3600,
+    "REDIS_TTL": 7 * 24 * 3600,
+    "DISTANCE_STEP": 0.01,
+}
+
+_MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedCacheMixin:
+    """Zählt Cache Aufrufe für metrics.scope, ohne das Verhalten des Backends zu ändern."""
+
+    def get(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().get(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().set(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().add(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().delete(*args, **kwargs)
+
+    def incr(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().incr(*args, **kwargs)
+
+    def get_many(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().get_many(*args, **kwargs)
+
+    def set_many(self, *args, **kwargs):
+        metrics.count_cache_call()
+        return super().set_many(*args, **kwargs)
+
+
+class InstrumentedLocMemCache(InstrumentedCacheMixin, LocMemCache):
+    pass
+
+
+class InstrumentedRedisCache(InstrumentedCacheMixin, RedisCache):
+    pass
+
+
+class LRUCache:
+    """Threadsichere LRU Tabelle mit optionaler Lebensdauer pro Eintrag."""
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        on_evict: Optional[Callable[[int], None]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            expires, value = item
+            if expires and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        evicted = 0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                evicted += 1
+        if evicted and self.on_evict is not None:
+            self.on_evict(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+
+def memoize(maxsize: int = 4096):
+    """Begrenzte prozesslokale Memoisierung für reine Funktionen mit günstigem Ergebnis.
+
+    Für Rechnungen im Mikrosekundenbereich ist jeder Redis Zugriff teurer als das Ergebnis selbst, der Django
+    Cache bleibt aufwendigen, prozessübergreifend nützlichen Ergebnissen vorbehalten (siehe LaterationCache).
+    Aufrufe mit nicht hashbaren Argumenten (z.B. numpy Arrays) werden unverändert durchgereicht.
+    """
+
+    def decorator(function):
+        memo = functools.lru_cache(maxsize=maxsize)(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                return memo(*args, **kwargs)
+            except TypeError:
+                return function(*args, **kwargs)
+
+        wrapper.cache_info = memo.cache_info
+        wrapper.cache_clear = memo.cache_clear
+        return wrapper
+
+    return decorator
+
+
+CelltowerKey = Tuple[int, int, int, int]
+
+
+@dataclass(frozen=True)
+class TowerInfo:
+    id: int
+    mcc: int
+    mnc: int
+    lac: int
+    cid: int
+    lat: Optional[float]
+    lon: Optional[float]
+    bsic: Optional[int]
+    bts_id: Optional[int]
+    point: Optional[Point]
+    range: float = 0.0
+
+    @property
+    def key(self) -> CelltowerKey:
+        return self.mcc, self.mnc, self.lac, self.cid
+
+    @classmethod
+    def from_celltower(cls, celltower) -> "TowerInfo":
+        return cls(
+            id=celltower.id,
+            mcc=celltower.mcc,
+            mnc=celltower.mnc,
+            lac=celltower.lac,
+            cid=celltower.cid,
+            lat=celltower.lat,
+            lon=celltower.lon,
+            bsic=celltower.bsic,
+            bts_id=celltower.bts_id,
+            point=Point(celltower.lat, celltower.lon)
+            if celltower.lat is not None
+            else None,
+            range=celltower.range,
+        )
+
+
+class _TowerEntry:
+    __slots__ = ("info", "loaded", "checked")
+
+    def __init__(self, info: Optional[TowerInfo], loaded: float):
+        self.info = info
+        # Wanduhrzeit des gelesenen Stands, vergleichbar mit den Änderungsmarken anderer Prozesse
+        self.loaded = loaded
+        self.checked = time.monotonic()
+
+
+class TowerIndex:
+    """Prozesslokaler Index (mcc, mnc, lac, cid) -> TowerInfo der zuletzt gesehenen Funkmasten.
+
+    Fehlende Einträge kommen aus dem Snapshot (main.snapshot), sonst gesammelt mit einer Abfrage aus
+    der Datenbank, unbekannte Schlüssel werden als None gemerkt. Änderungen an Celltower hinterlegen
+    nach dem Commit pro Schlüssel eine Marke mit der Änderungszeit im Django Cache. Lokale Einträge werden
+    höchstens alle RECHECK Sekunden gesammelt gegen diese Marken geprüft, dazwischen ohne Cache Aufruf.
+    """
+
+    DIRTY_KEY = "tower_index:dirty:{}:{}:{}:{}"
+
+    def __init__(
+        self,
+        maxsize: int = DEFAULT_TOWER_INDEX["MAXSIZE"],
+        ttl: float = DEFAULT_TOWER_INDEX["TTL"],
+    ):
+        self.configure(maxsize, ttl)
+
+    def configure(
+        self,
+        maxsize: int,
+        ttl: float,
+        snapshot=None,
+        recheck: float = DEFAULT_TOWER_INDEX["RECHECK"],
+        dirty_ttl: float = DEFAULT_TOWER_INDEX["DIRTY_TTL"],
+    ):
+        self._by_key = LRUCache(maxsize, ttl)
+        self._key_by_id = LRUCache(maxsize, ttl)
+        self.snapshot = snapshot
+        self.recheck = recheck
+        # Marken müssen mindestens so lange leben wie lokale Einträge
+        self.dirty_ttl = max(dirty_ttl, ttl or 0)
+
+    def _store(self, key: CelltowerKey, info: Optional[TowerInfo], loaded: float):
+        self._by_key.set(key, _TowerEntry(info, loaded))
+        if info is not None:
+            self._key_by_id.set(info.id, key)
+
+    def _changed(self, keys: Iterable[CelltowerKey]) -> Dict[CelltowerKey, float]:
+        names = {self.DIRTY_KEY.format(*key): key for key in keys}
+        if not names:
+            return {}
+        try:
+            return {
+                names[name]: changed for name, changed in cache.get_many(names).items()
+            }
+        except Exception:
+            logger.exception("Änderungsmarken des Funkmast-Index nicht lesbar")
+            metrics.inc("tower_index_cache_error")
+            return {}
+
+    def _stale(self, entries: Dict[CelltowerKey, _TowerEntry]) -> set:
+        """Schlüssel der ``entries``, die seit dem Laden in einem anderen Prozess geändert wurden."""
+        now = time.monotonic()
+        due = {
+            key: entry
+            for key, entry in entries.items()
+            if now - entry.checked >= self.recheck
+        }
+        if not due:
+            return set()
+        changed = self._changed(due)
+        stale = set()
+        for key, entry in due.items():
+            if changed.get(key, -math.inf) >= entry.loaded:
+                stale.add(key)
+                self._by_key.pop(key)
+            else:
+                entry.checked = now
+        if stale:
+            metrics.inc("tower_index_stale", len(stale))
+        return stale
+
+    def _count(self, hits: int, misses: int):
+        if hits:
+            metrics.inc("tower_index_hit", hits)
+        if misses:
+            metrics.inc("tower_index_miss", misses)
+
+    def get_many(
+        self, keys: Iterable[CelltowerKey]
+    ) -> Dict[CelltowerKey, Optional[TowerInfo]]:
+        from .models import Celltower
+
+        entries: Dict[CelltowerKey, _TowerEntry] = {}
+        missing = []
+        for key in set(keys):
+            entry = self._by_key.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                entries[key] = entry
+        stale = self._stale(entries)
+        missing += stale
+        result = {key: entry.info for key, entry in entries.items() if key not in stale}
+        self._count(len(result), len(missing))
+        if missing and self.snapshot is not None:
+            # Seit dem Export geänderte Funkmasten kommen aus der Datenbank
+            changed = self._changed(missing)
+            fresh = [
+                key
+                for key in missing
+                if changed.get(key, -math.inf) < self.snapshot.mtime
+            ]
+            for key, info in self.snapshot.get_many(fresh).items():
+                result[key] = info
+                self._store(key, info, self.snapshot.mtime)
+            missing = [key for key in missing if key not in result]
+        if missing:
+            loaded = time.time()
+            found = Celltower.by_keys(missing)
+            for key in missing:
+                celltower = found.get(key)
+                result[key] = (
+                    None if celltower is None else TowerInfo.from_celltower(celltower)
+                )
+                self._store(key, result[key], loaded)
+        return result
+
+    def by_ids(self, ids: Iterable[int]) -> Dict[int, TowerInfo]:
+        from .models import Celltower
+
+        entries: Dict[CelltowerKey, _TowerEntry] = {}
+        missing = []
+        for celltower_id in set(ids):
+            key = self._key_by_id.get(celltower_id)
+            entry = self._by_key.get(key) if key is not None else None
+            if entry is None or entry.info is None or entry.info.id != celltower_id:
+                missing.append(celltower_id)
+            else:
+                entries[key] = entry
+        stale = self._stale(entries)
+        result = {
+            entry.info.id: entry.info
+            for key, entry in entries.items()
+            if key not in stale
+        }
+        missing += [entries[key].info.id for key in stale]
+        self._count(len(result), len(missing))
+        if missing:
+            loaded = time.time()
+            for celltower in Celltower.objects.filter(id__in=missing):
+                result[celltower.id] = TowerInfo.from_celltower(celltower)
+                self._store(celltower.key, result[celltower.id], loaded)
+        return result
+
+    def get_by_id(self, celltower_id: int) -> Optional[TowerInfo]:
+        return self.by_ids([celltower_id]).get(celltower_id)
+
+    def invalidate(self, celltower):
+        self.invalidate_many([celltower])
+
+    def invalidate_many(self, celltowers: Iterable):
+        """Verwirft die Funkmasten sofort lokal, die Marken für andere Prozesse folgen gesammelt nach dem Commit."""
+        from django.db import transaction
+
+        keys = set()
+        for celltower in celltowers:
+            keys.add(celltower.key)
+            self._by_key.pop(celltower.key)
+            old_key = self._key_by_id.pop(celltower.id)
+            if old_key is not None:
+                keys.add(old_key)
+                self._by_key.pop(old_key)
+        if keys:
+            transaction.on_commit(lambda: self._mark(keys))
+
+    def _mark(self, keys: Iterable[CelltowerKey]):
+        changed = time.time()
+        for key in keys:
+            # Ein anderer Thread kann den alten Stand vor dem Commit geladen haben
+            self._by_key.pop(key)
+        try:
+            cache.set_many(
+                {self.DIRTY_KEY.format(*key): changed for key in keys}, self.dirty_ttl
+            )
+        except Exception:
+            logger.exception("Änderungsmarken des Funkmast-Index nicht schreibbar")
+            metrics.inc("tower_index_cache_error")
+
+    def clear(self):
+        self._by_key.clear()
+        self._key_by_id.clear()
+
+    def __len__(self):
+        return len(self._by_key)
+
+
+class LaterationCache:
+    """Laterationsergebnisse in einer prozesslokalen LRU vor dem Django Cache (Redis) mit Lebensdauer.
+
+    Der Schlüssel ist ein Hash der sortierten Funkmasten mit auf DISTANCE_STEP km gerundeten Abständen,
+    kleine Schwankungen im Empfangspegel treffen so denselben Eintrag.
+    """
+
+    # 3: (lat, lon, Fehler) statt (lat, lon, Radius)
+    # 4: zusätzlich das tatsächlich verwendete Verfahren
+    VERSION = 4
+
+    def __init__(self):
+        self.configure(**{k.lower(): v for k, v in DEFAULT_LATERATION_CACHE.items()})
+
+    def configure(
+        self, maxsize: int, ttl: float, redis_ttl: Optional[float], distance_step: float
+    ):
+        self._local = LRUCache(
+            maxsize, ttl, on_evict=lambda n: metrics.inc("lateration_cache_evict", n)
+        )
+        self.redis_ttl = redis_ttl
+        self.distance_step = distance_step
+
+    def key(self, measurements, error_function, method) -> str:
+        towers = sorted(
+            (
+                round(m.point.latitude, 6),
+                round(m.point.longitude, 6),
+                round(m.dist / self.distance_step),
+            )
+            for m in measurements
+        )
+        digest = hashlib.blake2b(repr(towers).encode(), digest_size=16).hexdigest()
+        return (
+            f"lateration:v{self.VERSION}:{error_function.name}:{method.name}:{digest}"
+        )
+
+    def get(self, key: str):
+        value = self._local.get(key)
+        if value is not None:
+            metrics.inc("lateration_cache_local_hit")
+            return value
+        value = cache.get(key)
+        if value is not None:
+            metrics.inc("lateration_cache_redis_hit")
+            self._local.set(key, value)
+            return value
+        metrics.inc("lateration_cache_miss")
+        return None
+
+    def set(self, key: str, value):
+        self._local.set(key, value)
+        cache.set(key, value, self.redis_ttl)
+
+    def clear(self):
+        self._local.clear()
+
+    def __len__(self):
+        return len(self._local)
+
+
+def _configure_lateration_cache():
+    config = {**DEFAULT_LATERATION_CACHE, **getattr(settings, "LATERATION_CACHE", {})}
+    lateration_cache.configure(
+        config["MAXSIZE"], config["TTL"], config["REDIS_TTL"], config["DISTANCE_STEP"]
+    )
+
+
+def _configure_tower_index():
+    config = {**DEFAULT_TOWER_INDEX, **getattr(settings, "TOWER_INDEX", {})}
+    snapshot = None
+    if config["SNAPSHOT"]:
+        from .snapshot import CelltowerSnapshot
+
+        try:
+            snapshot = CelltowerSnapshot(config["SNAPSHOT"])
+        except OSError:
+            logger.warning(
+                "Snapshot %s nicht lesbar, Funkmasten kommen aus der Datenbank",
+                config["SNAPSHOT"],
+                exc_info=True,
+            )
+    tower_index.configure(
+        config["MAXSIZE"],
+        config["TTL"],
+        snapshot,
+        config["RECHECK"],
+        config["DIRTY_TTL"],
+    )
+
+
+tower_index = TowerIndex()
+_configure_tower_index()
+lateration_cache = LaterationCache()
+_configure_lateration_cache()
+
+
+@receiver(setting_changed)
+def _reset_tower_index(setting, **kwargs):
+    if setting == "TOWER_INDEX":
+        _configure_tower_index()
+    elif setting == "LATERATION_CACHE":
+        _configure_lateration_cache()
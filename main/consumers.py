@@ -1,5 +1,22 @@
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
+from .api import ingest_async
+
+
+class StatusConsumer(AsyncHttpConsumer):
+    """Async Variante von api.StatusView für den ASGI Server."""
+
+    async def handle(self, body: bytes):
+        if self.scope["method"] != "POST":
+            await self.send_response(405, b"", headers=[(b"Allow", b"POST")])
+            return
+        await self.send_response(
+            200,
+            await ingest_async(body),
+            headers=[(b"Content-Type", b"text/html; charset=utf-8")],
+        )
+
 
 class UserUpdateConsumer(AsyncJsonWebsocketConsumer):
     groups = ("user",)
@@ -49,7 +66,9 @@ class DeviceUpdateConsumer(AsyncJsonWebsocketConsumer):
         print("öööö")
         from channels.layers import get_channel_layer
 
-        await get_channel_layer("default").group_send("a", {"type": "b", "message": "zweiter"})
+        await get_channel_layer("default").group_send(
+            "a", {"type": "b", "message": "zweiter"}
+        )
 
     async def b(self, event):
         print(event)
@@ -0,0 +1,284 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import json
+import logging
+import queue
+import threading
+from abc import ABC
+from abc import abstractmethod
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from . import metrics
+
+DEFAULT_POSITION_QUEUE = {
+    "BACKEND": "main.jobs.RedisJobQueue",
+    "OPTIONS": {"key": "position"},
+}
+# Versuche pro Status, danach bleibt die Position ausstehend und wird als position_dead_letter gezählt
+MAX_POSITION_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(ABC):
+    @abstractmethod
+    def enqueue(self, job: dict):
+        pass
+
+    def enqueue_many(self, jobs: List[dict]):
+        for job in jobs:
+            self.enqueue(job)
+
+    @abstractmethod
+    def dequeue(self, timeout: float = 5) -> Optional[Tuple[object, dict]]:
+        """Liefert (token, job) oder None. Der Job bleibt bis ack(token) als in Bearbeitung vermerkt."""
+
+    @abstractmethod
+    def ack(self, token):
+        pass
+
+    @abstractmethod
+    def depth(self) -> int:
+        pass
+
+    @abstractmethod
+    def in_progress(self) -> int:
+        pass
+
+    def recover(self) -> int:
+        """Stellt nach einem Absturz liegengebliebene Jobs wieder in die Warteschlange."""
+        return 0
+
+
+class RedisJobQueue(JobQueue):
+    """Redis Liste; Jobs wandern beim Abholen atomar in eine Bearbeitungsliste und gehen so nicht verloren."""
+
+    def __init__(
+        self, key: str = "position", prefix: str = "oat:jobs", connection=None
+    ):
+        self.key = f"{prefix}:{key}"
+        self.processing_key = f"{self.key}:processing"
+        self._connection = connection
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            from django_redis import get_redis_connection
+
+            self._connection = get_redis_connection("default")
+        return self._connection
+
+    def enqueue(self, job: dict):
+        self.connection.lpush(self.key, json.dumps(job))
+
+    def enqueue_many(self, jobs: List[dict]):
+        if jobs:
+            self.connection.lpush(self.key, *[json.dumps(job) for job in jobs])
+
+    def dequeue(self, timeout: float = 5):
+        raw = self.connection.brpoplpush(
+            self.key, self.processing_key, timeout=int(timeout)
+        )
+        if raw is None:
+            return None
+        return raw, json.loads(raw)
+
+    def ack(self, token):
+        self.connection.lrem(self.processing_key, 1, token)
+
+    def depth(self) -> int:
+        return self.connection.llen(self.key)
+
+    def in_progress(self) -> int:
+        return self.connection.llen(self.processing_key)
+
+    def recover(self) -> int:
+        count = 0
+        while self.connection.rpoplpush(self.processing_key, self.key) is not None:
+            count += 1
+        return count
+
+
+class LocalJobQueue(JobQueue):
+    """Prozessinterne Warteschlange für Tests und Entwicklung, nicht dauerhaft."""
+
+    def __init__(self, **kwargs):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._in_progress = 0
+
+    def enqueue(self, job: dict):
+        self._queue.put(job)
+
+    def dequeue(self, timeout: float = 5):
+        try:
+            job = (
+                self._queue.get(timeout=timeout)
+                if timeout
+                else self._queue.get_nowait()
+            )
+        except queue.Empty:
+            return None
+        with self._lock:
+            self._in_progress += 1
+        return job, job
+
+    def ack(self, token):
+        with self._lock:
+            self._in_progress -= 1
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def in_progress(self) -> int:
+        return self._in_progress
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_position_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        config = getattr(settings, "POSITION_QUEUE", DEFAULT_POSITION_QUEUE)
+        _queue = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return _queue
+
+
+@receiver(setting_changed)
+def _reset_queue(setting, **kwargs):
+    global _queue
+    if setting == "POSITION_QUEUE":
+        _queue = None
+
+
+def enqueue_position(status):
+    get_position_queue().enqueue({"status": status.id})
+
+
+def enqueue_positions(statuses):
+    get_position_queue().enqueue_many([{"status": status.id} for status in statuses])
+
+
+def notify_status_update(status):
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+
+    device = status.device
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        "device",
+        {
+            "type": "device_update",
+            "message": {"device": device.sn, "status": status.id},
+        },
+    )
+    for user_id in device.users.values_list("id", flat=True):
+        async_to_sync(channel_layer.group_send)(
+            "user",
+            {"type": "user_update", "user": user_id, "device": device.sn},
+        )
+
+
+def process_position(job: dict):
+    """Position berechnen, Stadt bestimmen und Clients benachrichtigen."""
+    from .models import DeviceSummary
+    from .models import Status
+
+    try:
+        status = Status.objects.select_related("device").get(id=job["status"])
+    except Status.DoesNotExist:
+        return
+    if not status.position_pending:
+        # Position wurde bereits beim Speichern vom vorherigen Status übernommen
+        metrics.inc("position_reused")
+        with metrics.timed("notify"):
+            notify_status_update(status)
+        return
+    try:
+        with metrics.timed("calc_location"):
+            status.new_calc_location()
+    except Exception:
+        # Ausstehend lassen statt (0, 0) zu geokodieren und begrenzt erneut versuchen
+        metrics.inc("calc_location_error")
+        attempts = job.get("attempts", 1)
+        if attempts < MAX_POSITION_ATTEMPTS:
+            logger.warning(
+                "Position für Status %s fehlgeschlagen, Versuch %s",
+                status.id,
+                attempts,
+                exc_info=True,
+            )
+            get_position_queue().enqueue({**job, "attempts": attempts + 1})
+        else:
+            logger.error(
+                "Position für Status %s nach %s Versuchen aufgegeben",
+                status.id,
+                attempts,
+                exc_info=True,
+            )
+            metrics.inc("position_dead_letter")
+        return
+    status.position_pending = False
+    with metrics.timed("set_city"):
+        status.set_city()
+    DeviceSummary.update_position(status)
+    with metrics.timed("notify"):
+        notify_status_update(status)
+
+
+def run_worker(
+    job_queue: JobQueue = None,
+    stop: threading.Event = None,
+    timeout: float = 5,
+    burst: bool = False,
+):
+    """Arbeitet Jobs ab, bis ``stop`` gesetzt wird bzw. bei ``burst`` bis die Warteschlange leer ist."""
+    from django.db import close_old_connections
+
+    job_queue = job_queue or get_position_queue()
+    stop = stop or threading.Event()
+    processed = 0
+    while not stop.is_set():
+        item = job_queue.dequeue(timeout=0 if burst else timeout)
+        if item is None:
+            if burst:
+                break
+            continue
+        token, job = item
+        close_old_connections()
+        try:
+            with metrics.scope("position"):
+                process_position(job)
+            processed += 1
+        except Exception:
+            logger.exception("Job %s fehlgeschlagen", job)
+        finally:
+            job_queue.ack(token)
+    close_old_connections()
+    return processed
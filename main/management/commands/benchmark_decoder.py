@@ -0,0 +1,56 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import timeit
+from django.core.management.base import BaseCommand
+
+from main.api import decode_update
+from main.simulation import sample_payload
+
+
+class Command(BaseCommand):
+    help = "Misst die Dekodierzeit pro Payload Version"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--number", type=int, default=20_000, help="Dekodierungen pro Messung"
+        )
+        parser.add_argument(
+            "--cells",
+            type=int,
+            nargs="+",
+            default=[1, 7],
+            help="Anzahl Zellen pro Payload",
+        )
+
+    def handle(self, *args, **options):
+        for version in (3, 4, 5):
+            for cells in options["cells"]:
+                body = sample_payload(version, cells)
+                seconds = min(
+                    timeit.repeat(
+                        lambda: decode_update(body), number=options["number"], repeat=5
+                    )
+                )
+                self.stdout.write(
+                    f"v{version} {cells:>2} Zellen {len(body):>4} Byte: "
+                    f"{seconds / options['number'] * 1e6:8.2f} µs/Payload"
+                )
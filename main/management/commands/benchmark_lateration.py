@@ -0,0 +1,131 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import time
+from django.core.management.base import BaseCommand
+from geopy import distance
+
+import numpy as np
+
+from main.simulation import Fleet
+from main.utils import ErrorFunction
+from main.utils import OptimizationAlgorithm
+from main.utils import solve_lateration
+
+
+class Command(BaseCommand):
+    help = (
+        "Vergleicht die Lateration mit geodätischer und vektorisierter Fehlerfunktion pro Status, "
+        "sowie die Genauigkeit der Verfahren gegenüber der simulierten Position"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--statuses", type=int, default=50, help="Simulierte Status pro Kombination"
+        )
+        parser.add_argument(
+            "--cells", type=int, default=7, help="Funkmasten pro Status"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--error-function",
+            choices=[e.name for e in ErrorFunction],
+            nargs="+",
+            default=["ME", "RMSE"],
+        )
+        parser.add_argument(
+            "--method",
+            choices=[m.name for m in OptimizationAlgorithm],
+            nargs="+",
+            default=["NELDER_MEAD", "L_BFGS_B", "LINEAR_LSQ"],
+        )
+        parser.add_argument(
+            "--warm-start",
+            action="store_true",
+            help="Vergleicht zusätzlich Kalt- und Warmstart für den nächsten Status",
+        )
+
+    def handle(self, *args, **options):
+        fleet = Fleet(
+            devices=options["statuses"], seed=options["seed"], cells=options["cells"]
+        )
+        problems = [fleet.measurements(device) for device in range(options["statuses"])]
+        truth = list(zip(fleet.device_lat, fleet.device_lon))
+        for error_function in (
+            ErrorFunction[name] for name in options["error_function"]
+        ):
+            for method in (OptimizationAlgorithm[name] for name in options["method"]):
+                seconds = {}
+                results = {}
+                for geodesic in (True, False):
+                    start = time.perf_counter()
+                    results[geodesic] = [
+                        solve_lateration(
+                            measurements, error_function, method, geodesic=geodesic
+                        )
+                        for measurements in problems
+                    ]
+                    seconds[geodesic] = (time.perf_counter() - start) / len(problems)
+                deviation = max(
+                    distance.geodesic(
+                        (a.latitude, a.longitude), (b.latitude, b.longitude)
+                    ).meters
+                    for a, b in zip(results[True], results[False])
+                )
+                self.stdout.write(
+                    f"{error_function.name:>4} {method.name:<11} geodätisch {seconds[True] * 1e3:8.2f} ms "
+                    f"vektorisiert {seconds[False] * 1e3:7.2f} ms ({seconds[True] / seconds[False]:5.1f}x) "
+                    f"max. Abweichung {deviation:7.1f} m"
+                )
+                error = [
+                    distance.geodesic((a.latitude, a.longitude), b).meters
+                    for a, b in zip(results[False], truth)
+                ]
+                self.stdout.write(
+                    f"{'':16} Fehler zur wahren Position p50 {np.percentile(error, 50):7.0f} m "
+                    f"p95 {np.percentile(error, 95):7.0f} m, "
+                    f"{np.mean([r.nfev for r in results[False]]):6.1f} Auswertungen"
+                )
+                if options["warm_start"] and method != OptimizationAlgorithm.LINEAR_LSQ:
+                    self.warm_start(fleet, results[False], error_function, method)
+
+    def warm_start(self, fleet, previous, error_function, method):
+        # Jeder Tracker bewegt sich einen Schritt weiter, gestartet wird kalt bzw. ab der vorherigen Lösung
+        for device in range(len(previous)):
+            fleet._move(device)
+        problems = [fleet.measurements(device) for device in range(len(previous))]
+        for label, initial in (
+            ("kalt", lambda i: None),
+            ("warm", lambda i: (previous[i].latitude, previous[i].longitude)),
+        ):
+            start = time.perf_counter()
+            results = [
+                solve_lateration(
+                    measurements, error_function, method, initial=initial(i)
+                )
+                for i, measurements in enumerate(problems)
+            ]
+            seconds = (time.perf_counter() - start) / len(problems)
+            self.stdout.write(
+                f"{'':16} nächster Status {label} {seconds * 1e3:7.2f} ms, "
+                f"{np.mean([r.nit for r in results]):6.1f} Iterationen, "
+                f"{np.mean([r.nfev for r in results]):6.1f} Auswertungen"
+            )
@@ -0,0 +1,112 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import time
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from main import propagation
+from main.models import Measurement
+from main.simulation import Fleet
+
+
+def _redis_tier(key, function, *args, **kwargs):
+    # Bisheriges Verhalten: GET und SET im Django Cache um jede Rechnung
+    value = cache.get(key)
+    if value:
+        return value
+    value = function(*args, **kwargs)
+    cache.set(key, value, None)
+    return value
+
+
+def _legacy(measurement: Measurement):
+    dbm = measurement.dbm
+    frequency = measurement.frequency_downlink
+    pl = _redis_tier(
+        f"path_loss_dbm{20_000}{None}{dbm}", propagation.path_loss.__wrapped__, dbm
+    )
+    return (
+        _redis_tier(
+            f"path_loss_new{2}{0}{dbm}{frequency}",
+            propagation.path_loss_distance.__wrapped__,
+            pl,
+            frequency,
+        ),
+        _redis_tier(
+            f"hataopen{80.0}{3.0}{dbm}{frequency}",
+            propagation.hata_distance.__wrapped__,
+            pl,
+            frequency,
+        ),
+        _redis_tier(
+            f"hataCost{False}{80.0}{3.0}{dbm}{frequency}",
+            propagation.hata_cost_231_distance.__wrapped__,
+            pl,
+            frequency,
+        ),
+    )
+
+
+def _memoized(measurement: Measurement):
+    return (
+        measurement.path_loss().kilometers,
+        measurement.hata().kilometers,
+        measurement.hata_cost_231().kilometers,
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Misst Aufrufe pro Sekunde der Hilfsfunktionen für Pfadverlust und Hata, "
+        "mit Django Cache (bisher) und prozesslokaler Memoisierung"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--uploads", type=int, default=2000, help="Simulierte Uploads"
+        )
+        parser.add_argument(
+            "--cells", type=int, default=7, help="Funkmasten pro Upload"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        fleet = Fleet(seed=options["seed"], cells=options["cells"])
+        measurements = [
+            Measurement(rxl=cell.rxl, arfcn=cell.arfcn)
+            for i in range(options["uploads"])
+            for cell in fleet.visible_cells(i % len(fleet.imeis))
+        ]
+        # Je Messung get_path_loss, path_loss, hata und hata_cost_231 wie bisher, get_path_loss dreimal
+        calls = 6 * len(measurements)
+        for name, function in (("Django Cache", _legacy), ("memoisiert", _memoized)):
+            start = time.perf_counter()
+            for measurement in measurements:
+                function(measurement)
+            seconds = time.perf_counter() - start
+            self.stdout.write(
+                f"{name:<12} {calls / seconds:12,.0f} Aufrufe/s {seconds / len(measurements) * 1e6:8.2f} µs/Messung"
+            )
+        info = propagation.hata_distance.cache_info()
+        self.stdout.write(
+            f"hata_distance: {info.hits} Treffer, {info.misses} Berechnungen, {info.currsize} Einträge"
+        )
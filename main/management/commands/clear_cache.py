@@ -26,6 +26,29 @@ from django.core.management.base import BaseCommand
 class Command(BaseCommand):
     help = "Löscht den aktuellen Cache"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--legacy-lateration",
+            action="store_true",
+            help="Löscht nur die alten Laterationseinträge ohne Ablaufzeit",
+        )
+        parser.add_argument(
+            "--legacy-physics",
+            action="store_true",
+            help="Löscht nur die alten Einträge von Pfadverlust und Hata ohne Ablaufzeit",
+        )
+
     def handle(self, *args, **options):
+        if options["legacy_lateration"]:
+            # Alte Schlüssel waren f"lateration{measurements}...", "[" ist im Muster eine Zeichenklasse
+            deleted = cache.delete_pattern("lateration\\[*")
+            return f"{deleted} Laterationseinträge gelöscht"
+        if options["legacy_physics"]:
+            # Werden seit main.cache.memoize nur noch prozesslokal gehalten
+            deleted = sum(
+                cache.delete_pattern(pattern)
+                for pattern in ("path_loss_dbm*", "path_loss_new*", "hata*")
+            )
+            return f"{deleted} Einträge von Pfadverlust und Hata gelöscht"
         cache.clear()
         return "Cache gelöscht"
@@ -0,0 +1,58 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import Status
+from main.replay import payload_bytes
+
+
+class Command(BaseCommand):
+    help = "Wandelt base64 kodierte raw_data älterer Status in die Rohbytes um"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=2000, help="Status pro Transaktion"
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        converted = 0
+        last_id = 0
+        while True:
+            rows = list(
+                Status.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "raw_data")[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            changed = []
+            for status_id, raw_data in rows:
+                payload = payload_bytes(raw_data)
+                if payload != bytes(raw_data):
+                    changed.append(Status(id=status_id, raw_data=payload))
+            with transaction.atomic():
+                Status.objects.bulk_update(changed, ["raw_data"])
+            converted += len(changed)
+        return f"{converted} Status umgewandelt"
@@ -0,0 +1,51 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import time
+from django.core.management.base import BaseCommand
+
+from main.snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Exportiert alle Funkmasten sortiert in eine Snapshot Datei für TOWER_INDEX['SNAPSHOT'], "
+        "nach jedem Import erneut ausführen"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            type=str,
+            required=True,
+            help="Zieldatei, z.B. /data/celltowers.npy",
+        )
+        parser.add_argument("--chunk-size", type=int, default=100_000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count, skipped = export_snapshot(
+            options["output"], chunk_size=options["chunk_size"]
+        )
+        return (
+            f"{count} Funkmasten in {time.perf_counter() - start:.1f} s nach {options['output']} exportiert, "
+            f"{skipped} mit zu großem Schlüssel übersprungen"
+        )
@@ -0,0 +1,275 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import http.client
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection
+from typing import Callable
+from typing import List
+from typing import Optional
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from main.simulation import Fleet
+
+
+def post(url: str, body: bytes, upload_delay: float = 0.0) -> float:
+    """Sendet einen Upload wie der Tracker und liefert die Antwortzeit in Sekunden."""
+    parts = urlsplit(url)
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection(
+        parts.hostname, parts.port or 80, timeout=60
+    )
+    try:
+        connection.putrequest("POST", parts.path or "/")
+        connection.putheader("Content-Type", "application/octet-stream")
+        connection.putheader("Content-Length", str(len(body)))
+        connection.endheaders()
+        if upload_delay:
+            # Langsame GPRS Verbindung: Header sind da, der Body kommt verzögert
+            time.sleep(upload_delay)
+        connection.send(body)
+        response = connection.getresponse()
+        if response.status != 200 or len(response.read()) < 12:
+            raise http.client.HTTPException(f"HTTP {response.status}")
+    finally:
+        connection.close()
+    return time.perf_counter() - start
+
+
+class InProcessClient:
+    """Schickt Uploads durch den kompletten Django Stack ohne Server, zählt dabei die Datenbankabfragen."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.queries: List[int] = []
+
+    def post(self, url: str, body: bytes, upload_delay: float = 0.0) -> float:
+        from django.test import Client
+
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client()
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = client.post(
+                urlsplit(url).path or "/update",
+                body,
+                content_type="application/octet-stream",
+            )
+        if response.status_code != 200 or len(response.content) < 12:
+            raise http.client.HTTPException(f"HTTP {response.status_code}")
+        with self._lock:
+            self.queries.append(count)
+        return time.perf_counter() - start
+
+
+def report(
+    latencies: List[float],
+    errors: int,
+    seconds: float,
+    queries: Optional[List[int]] = None,
+) -> str:
+    if not latencies:
+        return f"0 Anfragen erfolgreich, {errors} Fehler"
+    ms = np.asarray(latencies) * 1000
+    text = (
+        f"{len(latencies) / seconds:8.1f} req/s  "
+        f"p50 {np.percentile(ms, 50):7.1f} ms  p95 {np.percentile(ms, 95):7.1f} ms  "
+        f"p99 {np.percentile(ms, 99):7.1f} ms  Fehler {errors}"
+    )
+    if queries:
+        text += f"  Abfragen/Anfrage {np.mean(queries):5.1f} (max {max(queries)})"
+    return text
+
+
+def run(
+    send: Callable[[bytes], float],
+    bodies: List[bytes],
+    concurrency: int,
+    rate: float = 0.0,
+):
+    """Schickt alle Uploads mit ``concurrency`` Threads, mit ``rate`` gleichmäßig verteilt auf req/s.
+
+    Bei fester Rate zählt die Latenz ab dem geplanten Startzeitpunkt, Wartezeit durch Rückstau
+    fließt also mit ein, statt die Messung zu schönen.
+    """
+    latencies: List[float] = []
+    errors: List[Exception] = []
+    start = time.perf_counter()
+
+    def task(i: int, body: bytes) -> float:
+        if not rate:
+            return send(body)
+        scheduled = start + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        send(body)
+        return time.perf_counter() - scheduled
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(task, i, body) for i, body in enumerate(bodies)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors.append(e)
+    return latencies, errors, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = (
+        "Lasttest für /update mit simulierten Trackern, z.B. WSGI (gunicorn) gegen ASGI (uvicorn) "
+        "oder mit --in-process ohne Server gegen eine Testdatenbank"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            nargs="+",
+            default=["http://localhost:8000/update", "http://localhost:8001/update"],
+            help="Ein oder mehrere Endpunkte, die nacheinander gemessen werden",
+        )
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0.0,
+            help="Ziel req/s, 0 = so schnell wie möglich",
+        )
+        parser.add_argument(
+            "--devices",
+            type=int,
+            default=100,
+            help="Anzahl simulierter Tracker (IMEIs)",
+        )
+        parser.add_argument(
+            "--towers", type=int, default=500, help="Anzahl simulierter Funkmasten"
+        )
+        parser.add_argument("--cells", type=int, default=7)
+        parser.add_argument(
+            "--payload-version",
+            type=int,
+            choices=[3, 4],
+            default=4,
+            help="Payload Version",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--upload-delay",
+            type=float,
+            default=0.0,
+            help="Sekunden zwischen Header und Body",
+        )
+        parser.add_argument(
+            "--in-process",
+            action="store_true",
+            help="Ohne Server über den Django Testclient gegen eine frisch angelegte Testdatenbank, "
+            "z.B. mit --settings=Server.settings_test",
+        )
+        parser.add_argument(
+            "--seed-towers",
+            action="store_true",
+            help="Simulierte Funkmasten in der Datenbank anlegen",
+        )
+
+    def handle(self, *args, **options):
+        fleet = Fleet(
+            devices=options["devices"],
+            towers=options["towers"],
+            seed=options["seed"],
+            cells=options["cells"],
+            version=options["payload_version"],
+        )
+        bodies = list(fleet.payloads(options["requests"]))
+        if options["in_process"]:
+            self.handle_in_process(fleet, bodies, options)
+            return
+        if options["seed_towers"]:
+            self.stdout.write(f"{fleet.seed_celltowers()} Funkmasten angelegt")
+        for url in options["url"]:
+            latencies, errors, seconds = run(
+                lambda body: post(url, body, options["upload_delay"]),
+                bodies,
+                options["concurrency"],
+                options["rate"],
+            )
+            if errors:
+                self.stderr.write(f"{url}: {errors[0]}")
+            self.stdout.write(f"{url:<40} {report(latencies, len(errors), seconds)}")
+
+    def handle_in_process(self, fleet: Fleet, bodies: List[bytes], options):
+        from django.test.utils import setup_test_environment
+        from django.test.utils import teardown_test_environment
+
+        from main import metrics
+
+        if connection.vendor == "sqlite" and not connection.settings_dict["TEST"].get(
+            "NAME"
+        ):
+            # Datei statt Shared-Cache im Speicher, sonst sperren sich die Threads gegenseitig die Tabellen
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                tempfile.gettempdir(), "oat-loadtest.sqlite3"
+            )
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            fleet.seed_celltowers()
+            metrics.reset()
+            client = InProcessClient()
+            latencies, errors, seconds = run(
+                lambda body: client.post("/update", body),
+                bodies,
+                options["concurrency"],
+                options["rate"],
+            )
+            if errors:
+                self.stderr.write(f"in-process: {errors[0]}")
+            self.stdout.write(
+                f"{'in-process':<40} {report(latencies, len(errors), seconds, client.queries)}"
+            )
+            for name, labels, count, mean, p50, p95, p99 in metrics.summary():
+                if name == "oat_stage_seconds":
+                    self.stdout.write(
+                        f"  {labels[0][1]:<20} p50 {p50 * 1000:7.2f} ms  p95 {p95 * 1000:7.2f} ms  "
+                        f"p99 {p99 * 1000:7.2f} ms"
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
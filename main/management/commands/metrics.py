@@ -0,0 +1,55 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+from django.core.management.base import BaseCommand
+
+from main import metrics
+
+
+class Command(BaseCommand):
+    help = "Zeigt die Perzentile der Laufzeitmetriken"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prometheus", action="store_true", help="Ausgabe im Prometheus Textformat"
+        )
+        parser.add_argument(
+            "--reset", action="store_true", help="Setzt alle Metriken zurück"
+        )
+
+    def handle(self, *args, **options):
+        if options["reset"]:
+            metrics.reset()
+            return "Metriken zurückgesetzt"
+        if options["prometheus"]:
+            return metrics.render_prometheus()
+        self.stdout.write(
+            f"{'Metrik':<40} {'Anzahl':>8} {'Mittel':>10} {'p50':>10} {'p95':>10} {'p99':>10}"
+        )
+        for name, labels, count, mean, p50, p95, p99 in metrics.summary():
+            label = ",".join(value for key, value in labels)
+            # Zeiten in ms, Zähler als Anzahl
+            scale, unit = (1000, "ms") if name.endswith("_seconds") else (1, "")
+            self.stdout.write(
+                f"{name.replace('oat_', '')}[{label}]".ljust(40)
+                + f" {count:>8} {mean * scale:>8.2f}{unit:2} {p50 * scale:>8.2f}{unit:2}"
+                + f" {p95 * scale:>8.2f}{unit:2} {p99 * scale:>8.2f}{unit:2}"
+            )
@@ -0,0 +1,51 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+from django.core.management.base import BaseCommand
+
+from main.jobs import get_position_queue
+from main.models import Status
+
+
+class Command(BaseCommand):
+    help = "Zeigt den Zustand der Positions-Warteschlange"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requeue",
+            action="store_true",
+            help="Reiht alle Status mit ausstehender Position neu ein",
+        )
+
+    def handle(self, *args, **options):
+        job_queue = get_position_queue()
+        if options["requeue"]:
+            for status_id in (
+                Status.objects.filter(position_pending=True)
+                .values_list("id", flat=True)
+                .iterator()
+            ):
+                job_queue.enqueue({"status": status_id})
+        return (
+            f"Wartend: {job_queue.depth()}\n"
+            f"In Bearbeitung: {job_queue.in_progress()}\n"
+            f"Status mit ausstehender Position: {Status.objects.filter(position_pending=True).count()}"
+        )
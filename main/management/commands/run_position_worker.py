@@ -0,0 +1,72 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import threading
+from django.core.management.base import BaseCommand
+
+from main.jobs import get_position_queue
+from main.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = "Berechnet Positionen, Städte und Benachrichtigungen für neue Status aus der Warteschlange"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Anzahl paralleler Worker Threads",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Beendet sich, sobald die Warteschlange leer ist",
+        )
+
+    def handle(self, *args, **options):
+        job_queue = get_position_queue()
+        recovered = job_queue.recover()
+        if recovered:
+            self.stdout.write(f"{recovered} unterbrochene Jobs wieder eingereiht")
+        stop = threading.Event()
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    run_worker(job_queue, stop=stop, burst=options["burst"])
+                ),
+                name=f"position-worker-{i}",
+                daemon=True,
+            )
+            for i in range(options["concurrency"])
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        return f"{sum(results)} Jobs bearbeitet, {job_queue.depth()} wartend"
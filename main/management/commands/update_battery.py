@@ -0,0 +1,34 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+from django.core.management.base import BaseCommand
+
+from main.models import Device
+from main.models import Status
+
+
+class Command(BaseCommand):
+    help = "Berechnet Spannung und Ladezustand aller Status mit der aktuellen Kalibrierung ihres Geräts neu"
+
+    def handle(self, *args, **options):
+        for device in Device.objects.all():
+            updated = Status.update_battery(device.status_set.all(), device)
+            self.stdout.write(f"{device}: {updated} Status")
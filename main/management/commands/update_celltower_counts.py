@@ -0,0 +1,56 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+from django.core.management.base import BaseCommand
+
+from main.models import Status
+
+
+class Command(BaseCommand):
+    help = (
+        "Setzt celltower_count und celltower_ids bestehender Status aus ihren Messungen"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Berechnet auch bereits gesetzte Status neu",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=2000, help="Anzahl Status pro bulk_update"
+        )
+
+    def handle(self, *args, **options):
+        status_collection = (
+            Status.objects.all()
+            if options["all"]
+            else Status.objects.filter(celltower_count=0)
+        )
+        status_ids = list(status_collection.order_by("id").values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        updated = 0
+        for i in range(0, len(status_ids), batch_size):
+            statuses = Status.update_celltowers(
+                Status.objects.filter(id__in=status_ids[i : i + batch_size])
+            )
+            updated += len(statuses)
+            self.stdout.write(f"{updated} / {len(status_ids)}")
@@ -21,6 +21,7 @@ __license__ = "GPLv3"
 
 from django.core.management.base import BaseCommand
 
+from main.models import DeviceSummary
 from main.models import Status
 
 
@@ -37,6 +38,7 @@ class Command(BaseCommand):
             Status.objects.all()
             if options["all"]
             else Status.objects.filter(city__isnull=True).all()
-        )
+        ).filter(position_pending=False)
         for s in status_collection:
             s.set_city()
+            DeviceSummary.update_position(s)
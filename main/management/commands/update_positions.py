@@ -21,7 +21,9 @@ __license__ = "GPLv3"
 
 from django.core.management.base import BaseCommand
 
+from main.models import DeviceSummary
 from main.models import Status
+from main.utils import batch_calc_locations
 
 
 class Command(BaseCommand):
@@ -31,6 +33,17 @@ class Command(BaseCommand):
         parser.add_argument(
             "--all", action="store_true", help="Aktualisiert alle Positionen"
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=2000,
+            help="Anzahl Status, die gemeinsam lateriert werden",
+        )
+        parser.add_argument(
+            "--single",
+            action="store_true",
+            help="Berechnet jeden Status einzeln mit calc_location",
+        )
 
     def handle(self, *args, **options):
         status_collection = (
@@ -38,5 +51,23 @@ class Command(BaseCommand):
             if options["all"]
             else Status.objects.filter(lat=0.0, lon=0.0).all()
         )
-        for s in status_collection:
-            s.calc_location()
+        if options["single"]:
+            for s in status_collection:
+                s.calc_location()
+                DeviceSummary.update_position(s)
+            return
+
+        status_ids = list(status_collection.order_by("id").values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        updated = 0
+        for i in range(0, len(status_ids), batch_size):
+            statuses = Status.objects.filter(
+                id__in=status_ids[i : i + batch_size]
+            ).prefetch_related("measurements")
+            statuses = batch_calc_locations(statuses)
+            Status.objects.bulk_update(
+                statuses, ["lat", "lon", "radius", "position_source"]
+            )
+            DeviceSummary.update_positions(statuses)
+            updated += len(statuses)
+            self.stdout.write(f"{updated} / {len(status_ids)}")
@@ -0,0 +1,416 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import contextvars
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS = {
+    "ENABLED": True,
+    "REDIS": False,
+    "PREFIX": "oat:metrics",
+    "FLUSH_INTERVAL": 10,
+}
+
+# Sekunden, feste Grenzen wie bei Prometheus, damit sich Histogramme mehrerer Prozesse addieren lassen
+TIME_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    math.inf,
+)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, math.inf)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # (labels) -> [Anzahl je Bucket..., Summe]
+        self.values: Dict[Labels, List[float]] = {}
+        self._flushed: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        values = self.values.get(labels)
+        if values is None:
+            values = self.values.setdefault(labels, [0] * len(self.buckets) + [0.0])
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def delta(self) -> Dict[Labels, List[float]]:
+        """Änderungen seit dem letzten Aufruf, für das Zusammenführen in Redis."""
+        changes = {}
+        for labels, values in self.values.items():
+            flushed = self._flushed.get(labels)
+            current = list(values)
+            diff = (
+                current
+                if flushed is None
+                else [a - b for a, b in zip(current, flushed)]
+            )
+            if any(diff):
+                changes[labels] = diff
+            self._flushed[labels] = current
+        return changes
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self._flushed: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, labels: Labels = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def delta(self) -> Dict[Labels, float]:
+        changes = {}
+        for labels, value in list(self.values.items()):
+            diff = value - self._flushed.get(labels, 0)
+            if diff:
+                changes[labels] = diff
+            self._flushed[labels] = value
+        return changes
+
+
+stage_seconds = Histogram("oat_stage_seconds", "Dauer einzelner Verarbeitungsschritte")
+scope_seconds = Histogram("oat_scope_seconds", "Dauer eines Uploads bzw. Jobs")
+scope_queries = Histogram(
+    "oat_scope_queries", "Datenbankabfragen pro Upload bzw. Job", COUNT_BUCKETS
+)
+scope_cache_calls = Histogram(
+    "oat_scope_cache_calls", "Cache Aufrufe pro Upload bzw. Job", COUNT_BUCKETS
+)
+events = Counter("oat_events_total", "Ereignisse, z.B. Cache Treffer")
+
+HISTOGRAMS = (stage_seconds, scope_seconds, scope_queries, scope_cache_calls)
+COUNTERS = (events,)
+
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_config: Optional[dict] = None
+
+
+def get_config() -> dict:
+    global _config
+    if _config is None:
+        _config = {**DEFAULT_METRICS, **getattr(settings, "METRICS", {})}
+    return _config
+
+
+@receiver(setting_changed)
+def _reset_config(setting, **kwargs):
+    global _config
+    if setting == "METRICS":
+        _config = None
+
+
+@dataclass
+class Scope:
+    name: str
+    queries: int = 0
+    cache_calls: int = 0
+
+
+_scope: contextvars.ContextVar[Optional[Scope]] = contextvars.ContextVar(
+    "oat_metrics_scope", default=None
+)
+
+
+def _count_query(execute, sql, params, many, context):
+    scope = _scope.get()
+    if scope is not None:
+        scope.queries += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def _install_query_counter(connection, **kwargs):
+    # Einmal pro Verbindung statt pro Upload, die Zuordnung zum Upload läuft über die ContextVar
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def count_cache_call():
+    scope = _scope.get()
+    if scope is not None:
+        scope.cache_calls += 1
+
+
+def inc(event: str, amount: float = 1):
+    if get_config()["ENABLED"]:
+        with _lock:
+            events.inc(amount, (("event", event),))
+
+
+@contextmanager
+def timed(stage: str):
+    if not get_config()["ENABLED"]:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        with _lock:
+            stage_seconds.observe(duration, (("stage", stage),))
+
+
+@contextmanager
+def scope(name: str):
+    """Misst Dauer, Datenbankabfragen und Cache Aufrufe eines Uploads bzw. Jobs."""
+    if not get_config()["ENABLED"]:
+        yield None
+        return
+    current = Scope(name)
+    token = _scope.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        duration = time.perf_counter() - start
+        _scope.reset(token)
+        labels = (("scope", name),)
+        with _lock:
+            scope_seconds.observe(duration, labels)
+            scope_queries.observe(current.queries, labels)
+            scope_cache_calls.observe(current.cache_calls, labels)
+        maybe_flush()
+
+
+def _redis():
+    from django_redis import get_redis_connection
+
+    return get_redis_connection("default")
+
+
+def _field(labels: Labels, suffix: str) -> str:
+    return ",".join(f"{k}={v}" for k, v in labels) + f"|{suffix}"
+
+
+def _parse_field(field: str) -> Tuple[Labels, str]:
+    labels, suffix = field.rsplit("|", 1)
+    return (
+        tuple(tuple(label.split("=", 1)) for label in labels.split(",") if label),
+        suffix,
+    )
+
+
+def maybe_flush(force: bool = False):
+    global _last_flush
+    config = get_config()
+    if not config["REDIS"]:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < config["FLUSH_INTERVAL"]:
+        return
+    with _lock:
+        _last_flush = now
+        histograms = [(h, h.delta()) for h in HISTOGRAMS]
+        counters = [(c, c.delta()) for c in COUNTERS]
+    try:
+        pipeline = _redis().pipeline(transaction=False)
+        prefix = config["PREFIX"]
+        for histogram, changes in histograms:
+            for labels, values in changes.items():
+                for bucket, count in zip(histogram.buckets, values):
+                    if count:
+                        pipeline.hincrby(
+                            f"{prefix}:{histogram.name}",
+                            _field(labels, str(bucket)),
+                            int(count),
+                        )
+                pipeline.hincrbyfloat(
+                    f"{prefix}:{histogram.name}", _field(labels, "sum"), values[-1]
+                )
+        for counter, changes in counters:
+            for labels, value in changes.items():
+                pipeline.hincrbyfloat(
+                    f"{prefix}:{counter.name}", _field(labels, "value"), value
+                )
+        pipeline.execute()
+    except Exception:
+        logger.warning(
+            "Metriken konnten nicht nach Redis geschrieben werden", exc_info=True
+        )
+
+
+def collect() -> Tuple[
+    Dict[str, Dict[Labels, List[float]]], Dict[str, Dict[Labels, float]]
+]:
+    """Aktueller Stand aller Metriken, mit REDIS über alle Prozesse zusammengeführt."""
+    config = get_config()
+    if not config["REDIS"]:
+        with _lock:
+            return (
+                {h.name: {k: list(v) for k, v in h.values.items()} for h in HISTOGRAMS},
+                {c.name: dict(c.values) for c in COUNTERS},
+            )
+    maybe_flush(force=True)
+    connection = _redis()
+    prefix = config["PREFIX"]
+    histograms = {}
+    for histogram in HISTOGRAMS:
+        values: Dict[Labels, List[float]] = {}
+        index = {str(bucket): i for i, bucket in enumerate(histogram.buckets)}
+        for field, value in connection.hgetall(f"{prefix}:{histogram.name}").items():
+            labels, suffix = _parse_field(field.decode())
+            row = values.setdefault(labels, [0] * len(histogram.buckets) + [0.0])
+            if suffix == "sum":
+                row[-1] = float(value)
+            else:
+                row[index[suffix]] = int(value)
+        histograms[histogram.name] = values
+    counters = {}
+    for counter in COUNTERS:
+        counters[counter.name] = {
+            _parse_field(field.decode())[0]: float(value)
+            for field, value in connection.hgetall(f"{prefix}:{counter.name}").items()
+        }
+    return histograms, counters
+
+
+def reset():
+    config = get_config()
+    with _lock:
+        for metric in HISTOGRAMS + COUNTERS:
+            metric.values.clear()
+            metric._flushed.clear()
+    if config["REDIS"]:
+        _redis().delete(
+            *[f"{config['PREFIX']}:{metric.name}" for metric in HISTOGRAMS + COUNTERS]
+        )
+
+
+def percentile(buckets, values: List[float], q: float) -> float:
+    """Schätzung wie histogram_quantile: lineare Interpolation innerhalb des Buckets."""
+    total = sum(values[:-1])
+    if not total:
+        return math.nan
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for bucket, count in zip(buckets, values):
+        if count and seen + count >= rank:
+            if math.isinf(bucket):
+                return lower
+            return lower + (bucket - lower) * (rank - seen) / count
+        seen += count
+        if not math.isinf(bucket):
+            lower = bucket
+    return lower
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render_prometheus() -> str:
+    histograms, counters = collect()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.append(f"# HELP {histogram.name} {histogram.help}")
+        lines.append(f"# TYPE {histogram.name} histogram")
+        for labels, values in sorted(histograms[histogram.name].items()):
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, values):
+                cumulative += count
+                le = "+Inf" if math.isinf(bucket) else repr(bucket)
+                lines.append(
+                    f"{histogram.name}_bucket{_format_labels(labels, (('le', le),))} {cumulative}"
+                )
+            lines.append(f"{histogram.name}_sum{_format_labels(labels)} {values[-1]}")
+            lines.append(f"{histogram.name}_count{_format_labels(labels)} {cumulative}")
+    for counter in COUNTERS:
+        lines.append(f"# HELP {counter.name} {counter.help}")
+        lines.append(f"# TYPE {counter.name} counter")
+        for labels, value in sorted(counters[counter.name].items()):
+            lines.append(f"{counter.name}{_format_labels(labels)} {value}")
+    try:
+        from .jobs import get_position_queue
+
+        job_queue = get_position_queue()
+        lines.append("# HELP oat_position_queue_depth Wartende Positionsjobs")
+        lines.append("# TYPE oat_position_queue_depth gauge")
+        lines.append(f"oat_position_queue_depth {job_queue.depth()}")
+        lines.append(
+            "# HELP oat_position_queue_in_progress Positionsjobs in Bearbeitung"
+        )
+        lines.append("# TYPE oat_position_queue_in_progress gauge")
+        lines.append(f"oat_position_queue_in_progress {job_queue.in_progress()}")
+    except Exception:
+        logger.warning("Positionswarteschlange nicht erreichbar", exc_info=True)
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> List[Tuple[str, Labels, int, float, float, float, float]]:
+    """(Name, Labels, Anzahl, Mittelwert, p50, p95, p99) je Histogramm und Label."""
+    histograms, counters = collect()
+    rows = []
+    for histogram in HISTOGRAMS:
+        for labels, values in sorted(histograms[histogram.name].items()):
+            count = int(sum(values[:-1]))
+            rows.append(
+                (
+                    histogram.name,
+                    labels,
+                    count,
+                    values[-1] / count if count else math.nan,
+                    percentile(histogram.buckets, values, 0.5),
+                    percentile(histogram.buckets, values, 0.95),
+                    percentile(histogram.buckets, values, 0.99),
+                )
+            )
+    return rows
@@ -20,16 +20,25 @@ __copyright__ = "Copyright 2021, Patrick Frontzek"
 __license__ = "GPLv3"
 
 import math
+import operator
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.template import Template
 from django.utils import timezone
+from functools import reduce
+from typing import Callable
+from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
 
 import geopy
@@ -39,6 +48,10 @@ from geopy import Point
 from geopy import distance as gd
 from geopy.distance import Distance
 
+from . import propagation
+from .cache import TowerInfo
+from .cache import tower_index
+
 # User = settings.AUTH_USER_MODEL
 
 
@@ -108,16 +121,28 @@ class Device(models.Model):
     vcc_arduino = models.FloatField(verbose_name="Arduino VCC", default=4.46)
 
     battery = property(
-        lambda self: self.get_last_position().voltage
-        if self.get_last_position()
-        else None
+        lambda self: self.get_summary().voltage if self.get_summary() else None
     )
     battery_percentage = property(
-        lambda self: self.get_last_position().battery_percentage
-        if self.get_last_position()
+        lambda self: self.get_summary().battery_percentage
+        if self.get_summary()
         else None
     )
 
+    def get_summary(self) -> Optional["DeviceSummary"]:
+        try:
+            return self.summary
+        except DeviceSummary.DoesNotExist:
+            return None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Zum Erkennen einer geänderten Kalibrierung in save()
+        if not {"voltage_offset", "vcc_arduino"} & instance.get_deferred_fields():
+            instance._calibration = (instance.voltage_offset, instance.vcc_arduino)
+        return instance
+
     def get_next_waketime(self):
         from django.utils import timezone
 
@@ -151,7 +176,35 @@ class Device(models.Model):
             if kwargs["update_position"]:
                 self.last_position = self.get_last_position()
             del kwargs["update_position"]
+        adding = self._state.adding
         super(Device, self).save(*args, **kwargs)
+        if adding:
+            # Neue Status schreiben die Übersicht dann nur noch mit einem UPDATE fort
+            DeviceSummary.objects.create(device=self)
+        calibration = (self.voltage_offset, self.vcc_arduino)
+        if getattr(self, "_calibration", calibration) != calibration:
+            Status.update_battery(self.status_set.all(), self)
+            last = Status.objects.filter(
+                id=models.OuterRef("last_status_id")
+            ).order_by()
+            DeviceSummary.objects.filter(device=self).update(
+                voltage=models.Subquery(last.values("voltage")[:1]),
+                battery_percentage=models.Subquery(
+                    last.values("battery_percentage")[:1]
+                ),
+                revision=F("revision") + 1,
+            )
+            # Nur bereits geladene Werte sind veraltet
+            if (
+                self._meta.get_field("last_position").is_cached(self)
+                and self.last_position is not None
+            ):
+                self.last_position.refresh_from_db(
+                    fields=["voltage", "battery_percentage"]
+                )
+            if self._meta.get_field("summary").is_cached(self):
+                self._meta.get_field("summary").delete_cached_value(self)
+        self._calibration = calibration
 
     def get_last_position(self) -> Optional["Status"]:
         if self.status_set.exists():
@@ -172,14 +225,134 @@ class Device(models.Model):
         return data
 
 
+# Entladekurve des Akkus: Spannung (V) bei verbrauchtem Anteil, aufsteigend nach Spannung
+BATTERY_VOLTAGES = np.array(
+    [
+        5.35,
+        5.80406871795654,
+        6.25654283523559,
+        6.66138807296752,
+        6.81618181228637,
+        7.10195461273193,
+        7.28056255340576,
+        7.69731489181518,
+        7.98308769226074,
+        8.23313919067382,
+        8.35221210479736,
+    ]
+)
+BATTERY_PERCENTAGES = (
+    100
+    * (3708 - np.array([3708, 3680, 3634, 3542, 3427, 2760, 1817, 966, 483, 115, 0]))
+    / 3708
+)
+
+
+def calibrated_voltage(
+    voltage_raw: float, voltage_ref: int, vcc_arduino: float, voltage_offset: float
+) -> float:
+    if voltage_ref > -1:
+        return (
+            11 * (1.1 * vcc_arduino / (1.10 * 1023 / voltage_ref)) / 1023 * voltage_raw
+        ) + voltage_offset
+    return voltage_raw + voltage_offset
+
+
+def battery_percentage(voltage):
+    """Ladezustand in Prozent, linear zwischen den Punkten der Entladekurve, außerhalb 0 bzw. 100."""
+    return np.interp(voltage, BATTERY_VOLTAGES, BATTERY_PERCENTAGES)
+
+
+def battery_percentage_expression(voltage):
+    """Wie battery_percentage, als Datenbankausdruck für Sortierung, Filter und update()."""
+    from django.db.models import Value
+    from django.db.models.lookups import GreaterThanOrEqual
+
+    whens = [
+        models.When(
+            GreaterThanOrEqual(voltage, float(BATTERY_VOLTAGES[-1])), then=Value(100.0)
+        )
+    ]
+    for i in range(len(BATTERY_VOLTAGES) - 1, 0, -1):
+        u0, u1 = float(BATTERY_VOLTAGES[i - 1]), float(BATTERY_VOLTAGES[i])
+        p0, p1 = float(BATTERY_PERCENTAGES[i - 1]), float(BATTERY_PERCENTAGES[i])
+        whens.append(
+            models.When(
+                GreaterThanOrEqual(voltage, u0),
+                then=Value(p0) + (voltage - Value(u0)) * Value((p1 - p0) / (u1 - u0)),
+            )
+        )
+    return models.Case(*whens, default=Value(0.0), output_field=models.FloatField())
+
+
+# Funkmasten mit weniger Abstand (Meter) gelten als derselbe Standort, z.B. Sektoren einer Station
+DUPLICATE_TOWER_DISTANCE = 1
+# Kleinste Länge eines Breitengrads in Metern (am Äquator), die Gitterzellen sind damit mindestens so groß
+_METERS_PER_DEGREE = 110_000
+
+
+def deduplicate_measurements(
+    measurements: Iterable["Measurement"],
+    min_distance: float = DUPLICATE_TOWER_DISTANCE,
+) -> List["Measurement"]:
+    """Je Standort die Messung mit dem stärksten Pegel, absteigend nach rxl sortiert.
+
+    Die Funkmasten werden in ein Gitter mit ``min_distance`` großen Zellen einsortiert, geodätisch verglichen
+    werden nur Funkmasten aus benachbarten Zellen.
+    """
+    step = min_distance / _METERS_PER_DEGREE
+    grid: Dict[Tuple[int, int], List[int]] = {}
+    kept: List[Measurement] = []
+    for m in measurements:
+        point = m.tower.point if m.tower is not None else None
+        if point is None:
+            kept.append(m)
+            continue
+        cell = (math.floor(point.latitude / step), math.floor(point.longitude / step))
+        # Längengrade werden zu den Polen kürzer, entsprechend mehr Spalten durchsuchen
+        columns = math.ceil(1 / max(math.cos(math.radians(point.latitude)), 1e-3))
+        match = next(
+            (
+                i
+                for row in range(cell[0] - 1, cell[0] + 2)
+                for column in range(cell[1] - columns, cell[1] + columns + 1)
+                for i in grid.get((row, column), ())
+                if gd.distance(point, kept[i].tower.point).meters < min_distance
+            ),
+            None,
+        )
+        if match is None:
+            grid.setdefault(cell, []).append(len(kept))
+            kept.append(m)
+        elif m.rxl > kept[match].rxl:
+            # Auch unter der neuen Position auffindbar, die alte Zelle bleibt eingetragen
+            grid.setdefault(cell, []).append(match)
+            kept[match] = m
+    return sorted(kept, key=lambda obj: obj.rxl, reverse=True)
+
+
 class Status(models.Model):
+    class PositionSource(models.TextChoices):
+        pending = "", "Ausstehend"
+        solved = "solved", "Lateration"
+        warm = "warm", "Lateration ab vorheriger Position"
+        reused = "reused", "Vorherige Position, Pegel nahezu gleich"
+        copied = "copied", "Vorherige Position, Zellen unverändert gemeldet"
+        tower = "tower", "Einzelner Funkmast"
+
+    # Maximale Änderung des Empfangspegels einer Zelle, bis zu der die vorherige Position übernommen wird
+    REUSE_RXL_DELTA = 3
+    # Tatsächlich laterierte Positionen, nur diese dienen als Vergleich für die Übernahme
+    SOLVED_SOURCES = (PositionSource.solved, PositionSource.warm)
+    # Bis zu diesem Alter dient die vorherige Position als Startwert der Lateration
+    WARM_START_MAX_AGE = timezone.timedelta(hours=6)
+
     device = models.ForeignKey("Device", on_delete=models.CASCADE, null=False)
     lat = models.FloatField(verbose_name="Latitude")
     lon = models.FloatField(verbose_name="Longitude")
     radius = models.FloatField(verbose_name="Radius")
     timestamp = models.DateTimeField(verbose_name="Timestamp", db_index=True)
-    raw_data = models.TextField(max_length=1024, blank=True, default=str)
-    parsed_data = models.TextField(max_length=4096, blank=True, default=str)
+    raw_data = models.BinaryField(max_length=1024, blank=True, default=bytes)
     voltage_raw = models.FloatField(verbose_name="Spannung", default=0.0)
     city = models.ForeignKey(City, models.SET_NULL, null=True, blank=True)
     celltower = models.ManyToManyField(
@@ -187,29 +360,74 @@ class Status(models.Model):
     )
     temp = models.FloatField(verbose_name="Temperatur", default=-math.inf)
     voltage_ref = models.IntegerField(default=-1)
+    position_pending = models.BooleanField(
+        verbose_name="Position ausstehend", default=False, db_index=True
+    )
+    position_source = models.CharField(
+        verbose_name="Positionsquelle",
+        max_length=8,
+        choices=PositionSource.choices,
+        default=PositionSource.pending,
+        blank=True,
+    )
+    solver_nit = models.PositiveIntegerField(verbose_name="Iterationen", default=0)
+    solver_nfev = models.PositiveIntegerField(
+        verbose_name="Funktionsauswertungen", default=0
+    )
+    # Aus cleaned_measurements, beim Speichern der Messungen gesetzt
+    celltower_count = models.PositiveSmallIntegerField(
+        verbose_name="Funkmasten", default=0, db_index=True
+    )
+    celltower_ids = models.JSONField(
+        verbose_name="Verwendete Funkmasten", default=list, blank=True
+    )
+    # Mit der Kalibrierung des Geräts, beim Speichern gesetzt und bei deren Änderung neu berechnet
+    voltage = models.FloatField(verbose_name="Kalibrierte Spannung (V)", default=0.0)
+    battery_percentage = models.FloatField(verbose_name="Akku (%)", default=0.0)
     measurements: models.Manager
+    _cleaned_measurements: Optional[List["Measurement"]] = None
 
     @property
     def cleaned_measurements(self) -> List["Measurement"]:
-        from geopy import distance
-
-        measurements: List[Measurement] = []
-        min_distance = 1
-        for m in self.measurements.all():
-            found = False
-            for i in range(len(measurements)):
-                if (
-                    distance.distance(
-                        m.celltower.point, measurements[i].celltower.point
-                    ).meters
-                    < min_distance
-                ):
-                    found = True
-                    if m.rxl > measurements[i].rxl:
-                        measurements[i] = m
-            if not found:
-                measurements.append(m)
-        return sorted(measurements, key=lambda obj: obj.rxl, reverse=True)
+        # Pro Instanz gemerkt, calc_location und TabledataView greifen mehrfach zu
+        if self._cleaned_measurements is None:
+            Status.clean_measurements([self])
+        return self._cleaned_measurements
+
+    @staticmethod
+    def clean_measurements(statuses: Iterable["Status"]) -> List[List["Measurement"]]:
+        """``cleaned_measurements`` vieler Status, mit je einer Abfrage für alle Messungen und Funkmasten."""
+        from django.db.models import prefetch_related_objects
+
+        statuses = list(statuses)
+        prefetch_related_objects(statuses, "measurements")
+        all_measurements = [list(s.measurements.all()) for s in statuses]
+        towers = tower_index.by_ids(
+            m.celltower_id for ms in all_measurements for m in ms
+        )
+        for status, measurements in zip(statuses, all_measurements):
+            for m in measurements:
+                m.tower = towers[m.celltower_id]
+            status.set_cleaned_measurements(deduplicate_measurements(measurements))
+        return [s._cleaned_measurements for s in statuses]
+
+    def set_cleaned_measurements(self, measurements: List["Measurement"]):
+        self._cleaned_measurements = measurements
+        self.celltower_count = len(measurements)
+        self.celltower_ids = [m.celltower_id for m in measurements]
+
+    @staticmethod
+    def update_celltowers(statuses: Iterable["Status"]) -> List["Status"]:
+        """Berechnet celltower_count und celltower_ids aus den gespeicherten Messungen neu, mit einem bulk_update."""
+        statuses = list(statuses)
+        for status in statuses:
+            # Vorher geladene Messungen könnten veraltet sein
+            status._cleaned_measurements = None
+            getattr(status, "_prefetched_objects_cache", {}).pop("measurements", None)
+        Status.clean_measurements(statuses)
+        Status.objects.bulk_update(statuses, ["celltower_count", "celltower_ids"])
+        DeviceSummary.touch({status.device_id for status in statuses})
+        return statuses
 
     @property
     def country(self):
@@ -219,49 +437,75 @@ class Status(models.Model):
             return Country.objects.get_or_create(name="UNKNOWN", code="???")[0]
 
     @property
-    def voltage(self):
-        if self.voltage_ref > -1:
-            return (
-                11
-                * (1.1 * self.device.vcc_arduino / (1.10 * 1023 / (self.voltage_ref)))
-                / 1023
-                * self.voltage_raw
-            ) + self.device.voltage_offset
-        return self.voltage_raw + self.device.voltage_offset
+    def payload(self) -> bytes:
+        from .replay import payload_bytes
+
+        return payload_bytes(self.raw_data)
 
     @property
-    def battery_percentage(self):
-        n = 3708
-        abschnitte = {
-            0: 8.35221210479736,
-            115: 8.23313919067382,
-            483: 7.98308769226074,
-            966: 7.69731489181518,
-            1817: 7.28056255340576,
-            2760: 7.10195461273193,
-            3427: 6.81618181228637,
-            3542: 6.66138807296752,
-            3634: 6.25654283523559,
-            3680: 5.80406871795654,
-            n: 5.35,
+    def parsed_data(self) -> dict:
+        # Wird nicht mehr gespeichert, sondern bei Bedarf aus raw_data dekodiert
+        from dataclasses import asdict
+        from .api import decode_update
+
+        payload = self.payload
+        if not payload:
+            return {}
+        decoded = decode_update(payload)
+        report = decoded.reports[0]
+        return {
+            "version": decoded.version,
+            "imei": decoded.imei,
+            "header": asdict(report.header),
+            "extras": asdict(report.extras) if report.extras else None,
+            "cells": [asdict(cell) for cell in report.cells],
+            "errors": [(flags.value, code) for flags, code in report.errors.values]
+            if report.errors
+            else [],
         }
-        last_u, last_base = 0.0, 0.0
-        for i, u in abschnitte.items():
-            base = (n - i) / n
-            if self.voltage >= u:
-                if i == 0:
-                    return 100
-                return (
-                    base + (last_base - base) * ((self.voltage - u) / (last_u - u))
-                ) * 100
-
-            last_u, last_base = u, base
-        # return 0
-        # 6.5V Minimum; 6.5 + 1.9 = 8.4
-        return min(max((round((self.voltage - 6.5) / 1.9 * 100)), 0.0), 100.0)
+
+    def calc_battery(self, device: Optional["Device"] = None):
+        """Setzt voltage und battery_percentage aus den Rohwerten und der Kalibrierung des Geräts."""
+        device = device or self.device
+        self.voltage = calibrated_voltage(
+            self.voltage_raw,
+            self.voltage_ref,
+            device.vcc_arduino,
+            device.voltage_offset,
+        )
+        self.battery_percentage = float(battery_percentage(self.voltage))
+
+    @staticmethod
+    def update_battery(statuses: models.QuerySet, device: "Device") -> int:
+        """Berechnet voltage und battery_percentage der ``statuses`` von ``device`` in der Datenbank neu."""
+        from django.db.models import Value
+
+        voltage = models.Case(
+            models.When(
+                voltage_ref__gt=-1,
+                then=11
+                * Value(float(device.vcc_arduino))
+                * F("voltage_ref")
+                * F("voltage_raw")
+                / Value(1023 * 1023)
+                + Value(float(device.voltage_offset)),
+            ),
+            default=F("voltage_raw") + Value(float(device.voltage_offset)),
+            output_field=models.FloatField(),
+        )
+        updated = statuses.update(voltage=voltage)
+        # Eigene Abfrage, damit F("voltage") den neuen Wert sieht
+        statuses.update(battery_percentage=battery_percentage_expression(F("voltage")))
+        return updated
 
     class Meta:
         ordering = ("-timestamp",)
+        # Seiten der Statustabelle eines Geräts über (timestamp, id), siehe views._status_page
+        indexes = [
+            models.Index(
+                fields=["device", "timestamp", "id"], name="status_device_timestamp"
+            )
+        ]
 
     @property
     def point(self):
@@ -275,13 +519,19 @@ class Status(models.Model):
         )
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding:
+            self.calc_battery()
         super(Status, self).save(*args, **kwargs)
+        newest = None
         if (
             self.device.last_position is None
             or self.device.last_position.timestamp < self.timestamp
         ):
-            self.device.last_position = self
+            self.device.last_position = newest = self
             self.device.save(update_position=False)
+        if adding:
+            DeviceSummary.record(self.device, 1, newest)
 
     def set_city(self, geolocator: Nominatim = None):
         if not geolocator:
@@ -333,50 +583,121 @@ class Status(models.Model):
 
     def calc_location(self):
         from .utils import ErrorFunction
-        from .utils import Measurement
         from .utils import OptimizationAlgorithm
+        from .utils import lateration_inputs
         from .utils import lateration_new
 
         if len(self.cleaned_measurements) > 1:
             point, distance = lateration_new(
-                [
-                    Measurement(m.celltower.point, m.distance.kilometers)
-                    for m in self.cleaned_measurements
-                ],
+                lateration_inputs(self.cleaned_measurements),
                 error_function=ErrorFunction.MAE,
                 method=OptimizationAlgorithm.NELDER_MEAD,
             )
+            self.position_source = Status.PositionSource.solved
         else:
             cell = self.measurements.first().celltower
             point = cell.point
             distance = self.measurements.first().distance
+            self.position_source = Status.PositionSource.tower
         self.lat = point.latitude
         self.lon = point.longitude
         self.radius = distance.kilometers
         self.save()
 
-    def new_calc_location(self):
+    def previous_status(self, solved: bool = False) -> Optional["Status"]:
+        statuses = Status.objects.filter(
+            device_id=self.device_id, timestamp__lt=self.timestamp
+        )
+        if solved:
+            statuses = statuses.filter(
+                position_source__in=Status.SOLVED_SOURCES, position_pending=False
+            )
+        return statuses.order_by("-timestamp").first()
+
+    def new_calc_location(self, method=None):
         from .utils import ErrorFunction
-        from .utils import Measurement
         from .utils import OptimizationAlgorithm
-        from .utils import lateration_new
+        from .utils import cached_lateration
+        from .utils import lateration_inputs
 
-        if len(self.cleaned_measurements) > 1:
-            point, distance = lateration_new(
-                [
-                    Measurement(m.celltower.point, m.distance.kilometers)
-                    for m in self.cleaned_measurements
-                ],
-                error_function=ErrorFunction.ME,
-                method=OptimizationAlgorithm.NELDER_MEAD,
+        if method is None:
+            # Geschlossene Lösung, Nelder-Mead mit RMSE nur bei schlechtem Residuum
+            method = OptimizationAlgorithm.LINEAR_LSQ
+            error_function = ErrorFunction.RMSE
+        else:
+            error_function = ErrorFunction.ME
+        cleaned = self.cleaned_measurements
+        self.solver_nit = self.solver_nfev = 0
+        if len(cleaned) > 1:
+            initial = None
+            self.position_source = Status.PositionSource.solved
+            previous = self.previous_status()
+            reference = previous
+            if (
+                previous is not None
+                and previous.position_source not in Status.SOLVED_SOURCES
+            ):
+                # Mit der zuletzt berechneten Position vergleichen, sonst wandern die Pegel über eine Kette
+                # übernommener Positionen beliebig weit, ohne dass je neu gerechnet wird
+                reference = self.previous_status(solved=True)
+            if (
+                reference is not None
+                and not reference.position_pending
+                and reference.radius
+            ):
+                rxl = {m.celltower_id: m.rxl for m in cleaned}
+                reference_rxl = {
+                    m.celltower_id: m.rxl for m in reference.cleaned_measurements
+                }
+                # Stehender Tracker: gleiche Zellen, nur leicht schwankende Pegel
+                if (
+                    rxl.keys() == reference_rxl.keys()
+                    and max(abs(rxl[i] - reference_rxl[i]) for i in rxl)
+                    <= self.REUSE_RXL_DELTA
+                ):
+                    self.lat, self.lon, self.radius = (
+                        reference.lat,
+                        reference.lon,
+                        reference.radius,
+                    )
+                    self.position_source = Status.PositionSource.reused
+                    self.save()
+                    return
+            if (
+                previous is not None
+                and not previous.position_pending
+                and previous.radius
+            ):
+                if self.timestamp - previous.timestamp <= self.WARM_START_MAX_AGE:
+                    initial = (previous.lat, previous.lon)
+            result = cached_lateration(
+                lateration_inputs(cleaned),
+                error_function=error_function,
+                method=method,
+                initial=initial,
+            )
+            # Die geschlossene Lösung braucht keinen Startwert, nur scipy nutzt ihn
+            if (
+                initial is not None
+                and not result.cached
+                and result.method != OptimizationAlgorithm.LINEAR_LSQ
+            ):
+                self.position_source = Status.PositionSource.warm
+            self.solver_nit, self.solver_nfev = result.nit, result.nfev
+            self.lat, self.lon, self.radius = (
+                result.latitude,
+                result.longitude,
+                result.radius,
             )
         else:
             cell = self.measurements.first().celltower
-            point = cell.point
             distance = self.measurements.first().distance
-        self.lat = point.latitude
-        self.lon = point.longitude
-        self.radius = distance.kilometers
+            self.lat, self.lon, self.radius = (
+                cell.point.latitude,
+                cell.point.longitude,
+                distance.kilometers,
+            )
+            self.position_source = Status.PositionSource.tower
         self.save()
 
     def get_point(
@@ -438,6 +759,128 @@ class Error(models.Model):
         return f"{self.nr}: {repr(ErrorFlags(self.flags))} - {self.code}"
 
 
+class DeviceSummary(models.Model):
+    """Übersicht je Gerät für Geräteliste, Admin und Karte, beim Speichern neuer Status fortgeschrieben."""
+
+    device = models.OneToOneField(
+        Device, models.CASCADE, primary_key=True, related_name="summary"
+    )
+    last_status = models.ForeignKey(
+        Status, models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    timestamp = models.DateTimeField(verbose_name="Timestamp", null=True, blank=True)
+    lat = models.FloatField(verbose_name="Latitude", null=True, blank=True)
+    lon = models.FloatField(verbose_name="Longitude", null=True, blank=True)
+    radius = models.FloatField(verbose_name="Radius", null=True, blank=True)
+    voltage = models.FloatField(
+        verbose_name="Kalibrierte Spannung (V)", null=True, blank=True
+    )
+    battery_percentage = models.FloatField(
+        verbose_name="Akku (%)", null=True, blank=True
+    )
+    city = models.ForeignKey(
+        City, models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    status_count = models.PositiveIntegerField(verbose_name="Anzahl Status", default=0)
+    last_error = models.ForeignKey(
+        Error, models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    # Zählt jede Änderung an den Status des Geräts, Teil des Schlüssels der zwischengespeicherten Statustabelle
+    revision = models.PositiveIntegerField(verbose_name="Änderungen", default=0)
+
+    def __str__(self):
+        return f"{self.device}: {self.timestamp}"
+
+    @staticmethod
+    def status_fields(status: Optional[Status]) -> dict:
+        return {
+            "last_status": status,
+            "timestamp": status.timestamp if status else None,
+            "lat": status.lat if status else None,
+            "lon": status.lon if status else None,
+            "radius": status.radius if status else None,
+            "voltage": status.voltage if status else None,
+            "battery_percentage": status.battery_percentage if status else None,
+            "city_id": status.city_id if status else None,
+        }
+
+    @classmethod
+    def record(
+        cls,
+        device: Device,
+        count: int,
+        newest: Optional[Status] = None,
+        errors: List[Error] = (),
+    ):
+        """Nach ``count`` neuen Status, ``newest`` falls dieser die letzte Position des Geräts geworden ist."""
+        fields = {
+            "status_count": F("status_count") + count,
+            "revision": F("revision") + 1,
+        }
+        if newest is not None:
+            fields.update(cls.status_fields(newest))
+        if errors:
+            fields["last_error"] = errors[-1]
+        if not cls.objects.filter(device=device).update(**fields):
+            cls.rebuild(device)
+
+    @classmethod
+    def update_position(cls, status: Status):
+        """Position und Stadt übernehmen, falls ``status`` noch der letzte des Geräts ist."""
+        if not cls.objects.filter(
+            device_id=status.device_id, last_status_id=status.id
+        ).update(
+            lat=status.lat,
+            lon=status.lon,
+            radius=status.radius,
+            city_id=status.city_id,
+            revision=F("revision") + 1,
+        ):
+            cls.touch([status.device_id])
+
+    @classmethod
+    def update_positions(cls, statuses: Iterable[Status]):
+        """Wie update_position für viele Status, mit einer Abfrage und einem bulk_update."""
+        statuses = {s.id: s for s in statuses}
+        summaries = list(cls.objects.filter(last_status_id__in=statuses))
+        for summary in summaries:
+            status = statuses[summary.last_status_id]
+            summary.lat, summary.lon, summary.radius = (
+                status.lat,
+                status.lon,
+                status.radius,
+            )
+            summary.city_id = status.city_id
+        cls.objects.bulk_update(summaries, ["lat", "lon", "radius", "city"])
+        cls.touch({status.device_id for status in statuses.values()})
+
+    @classmethod
+    def touch(cls, device_ids: Iterable[int]):
+        """Status der Geräte wurden geändert, ohne dass sich die Übersicht sonst ändert."""
+        cls.objects.filter(device_id__in=device_ids).update(revision=F("revision") + 1)
+
+    @classmethod
+    def rebuild(cls, device: Device) -> "DeviceSummary":
+        """Berechnet die Übersicht vollständig aus den Status und Fehlern des Geräts."""
+        statuses = Status.objects.filter(device_id=device.pk)
+        last_error = (
+            Error.objects.filter(status__device_id=device.pk)
+            .order_by("-status__timestamp", "-nr")
+            .first()
+        )
+        summary, created = cls.objects.update_or_create(
+            device_id=device.pk,
+            defaults={
+                **cls.status_fields(statuses.order_by("-timestamp").first()),
+                "status_count": statuses.count(),
+                "last_error": last_error,
+            },
+        )
+        if not created:
+            cls.touch([device.pk])
+        return summary
+
+
 class Measurement(models.Model):
     status = models.ForeignKey(Status, models.CASCADE, related_name="measurements")
     celltower = models.ForeignKey(
@@ -448,47 +891,31 @@ class Measurement(models.Model):
     )
     rxl = models.IntegerField()
     arfcn = models.IntegerField(default=None, null=True, blank=True)
+    _tower: Optional[TowerInfo] = None
+
+    @property
+    def tower(self) -> Optional[TowerInfo]:
+        # Koordinaten aus dem prozesslokalen Index statt einer Abfrage pro Messung
+        if self._tower is None or self._tower.id != self.celltower_id:
+            self._tower = tower_index.get_by_id(self.celltower_id)
+        return self._tower
+
+    @tower.setter
+    def tower(self, info: TowerInfo):
+        self._tower = info
 
     @property
     def frequency_uplink(self):
-        arfcn = self.arfcn if self.arfcn and self.arfcn != (2 ** 16) - 1 else 0
-        if 0 <= arfcn <= 124:
-            return 890.0 + 0.2 * (arfcn - 0)
-        elif 128 <= arfcn <= 251:
-            return 824.2 + 0.2 * (arfcn - 128)
-        elif 259 <= arfcn <= 293:
-            return 450.6 + 0.2 * (arfcn - 259)
-        elif 306 <= arfcn <= 340:
-            return 479.0 + 0.2 * (arfcn - 306)
-        elif 438 <= arfcn <= 511:
-            return 747.2 + 0.2 * (arfcn - 438)
-        elif 512 <= arfcn <= 885:
-            return 1710.2 + 0.2 * (arfcn - 512)
-        elif 955 <= arfcn <= 1023:
-            return 890.0 + 0.2 * (arfcn - 1024)
+        return propagation.uplink_frequency(propagation.normalize_arfcn(self.arfcn))
 
     @property
     def frequency_downlink(self):
         # return 900
-        arfcn = self.arfcn if self.arfcn and self.arfcn != (2 ** 16) - 1 else 0
-        if 0 <= arfcn <= 124:
-            return self.frequency_uplink + 45
-        elif 128 <= arfcn <= 251:
-            return self.frequency_uplink + 45
-        elif 259 <= arfcn <= 293:
-            return self.frequency_uplink + 10
-        elif 306 <= arfcn <= 340:
-            return self.frequency_uplink + 10
-        elif 438 <= arfcn <= 511:
-            return self.frequency_uplink + 30
-        elif 512 <= arfcn <= 885:
-            return self.frequency_uplink + 95
-        elif 955 <= arfcn <= 1023:
-            return self.frequency_uplink + 45
+        return propagation.downlink_frequency(propagation.normalize_arfcn(self.arfcn))
 
     @property
     def frequency_band(self):
-        arfcn = self.arfcn if self.arfcn and self.arfcn != (2 ** 16) - 1 else 0
+        arfcn = propagation.normalize_arfcn(self.arfcn)
         if 0 <= arfcn <= 124:
             return "GSM 900"
         elif 128 <= arfcn <= 251:
@@ -506,7 +933,7 @@ class Measurement(models.Model):
 
     @property
     def dbm(self) -> int:
-        return -(113 - self.rxl)
+        return propagation.rxl_to_dbm(self.rxl)
 
     @property
     def mw(self) -> float:
@@ -519,14 +946,7 @@ class Measurement(models.Model):
     ) -> float:
         if dbm is None:
             dbm = self.dbm
-        key = f"path_loss_dbm{max_tx_mw}{max_tx_dbm}{dbm}"
-        PL = cache.get(key)
-        if PL:
-            return PL
-        TX = max_tx_dbm if max_tx_dbm else 10 * np.log10(max_tx_mw)
-        PL = TX - dbm
-        cache.set(key, PL, None)
-        return PL
+        return propagation.path_loss(dbm, max_tx_mw, max_tx_dbm)
 
     def path_loss(
         self, v: float = 2, C: float = 0, dbm: float = None, frequency: float = None
@@ -535,43 +955,10 @@ class Measurement(models.Model):
             dbm = self.dbm
         if frequency is None:
             frequency = self.frequency_downlink
-        key = f"path_loss_new{v}{C}{dbm}{frequency}"
-        distance = cache.get(key)
-        if distance:
-            return Distance(distance)
-
-        # v = 2: Free Space (vacuum)
-        # v = 2.5: Outdoor - rural
-        # v = 3-4: Outdoor - urban
-        # v = 4-5: Outdoor - dense urban
-        # v = 1.6 - 1.8: Indoor - large open areas
-        # v = 4-6: Indoor - no line of sight
-
-        # PL = 10 * v * np.log10(d) + C
-        # PL - C = 10 * v * np.log10(d)
-        # (PL - C) / (10 * v) = np.log10(d)
-        # np.float_power(10, (PL - C) / (10 * v)) = d
-        # distance = np.float_power(10, (self.get_path_loss() - C) / (10 * v))
-
-        # lambda = c / f
-        # PL = 10 * v * np.log10((4 * pi * d) / lambda)
-        # PL / (10 * v) = np.log10((4 * pi * d) / lambda)
-        # np.power(10, PL / (10 * v)) = (4 * pi * d) / lambda
-        # np.power(10, PL / (10 * v)) / lambda = 4 * pi * d
-        # (np.power(10, PL / (10 * v)) / lambda) / 4 * pi = d
-        from scipy.constants import c
-        from scipy.constants import kilo
-        from scipy.constants import mega
-        from scipy.constants import pi
-
-        f = frequency * mega
-        _lambda = c / f
-        distance = (
-            (np.power(10, self.get_path_loss(dbm=dbm) / (10 * v)) / _lambda) / 4 * pi
+        distance = propagation.path_loss_distance(
+            self.get_path_loss(dbm=dbm), frequency, v=v
         )
-
-        cache.set(key, distance, None)
-        return Distance(distance * kilo)
+        return Distance(distance)
 
     def hata(
         self,
@@ -585,83 +972,9 @@ class Measurement(models.Model):
             dbm = self.dbm
         if frequency is None:
             frequency = self.frequency_downlink
-        key = f"hata{enviroment}{h_B}{h_M}{dbm}{frequency}"
-        distance = cache.get(key)
-        if distance:
-            return gd.distance(distance)
-
-        if not enviroment.startswith("urban") or (
-            enviroment.endswith("small") or enviroment.endswith("medium")
-        ):
-            # Small / medium city
-            C_H = (
-                0.8
-                + (1.1 * np.log10(frequency) - 0.7) * h_M
-                - 1.56 * np.log10(frequency)
-            )
-        else:
-            # large city
-            C_H = 3.2 * np.power(np.log10(11.75 * h_M), 2) - 4.97
-
-        # L_U = 69.55 + 26.16 * np.log10(self.frequency_downlink) - 13.82 * np.log10(h_B) - C_H + (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-
-        if enviroment == "open":
-            # L_O = L_U - 4.78 * np.power(np.log10(self.frequency_downlink), 2) + 18.33 * np.log10(self.frequency_downlink) - 40.94
-            # L_O + 4.78 * np.power(np.log10(self.frequency_downlink), 2) - 18.33 * np.log10(self.frequency_downlink) + 40.94 = 69.55 + 26.16 * np.log10(self.frequency_downlink) - 13.82 * np.log10(h_B) - C_H + (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-            # L_O + 4.78 * np.power(np.log10(self.frequency_downlink), 2) - 18.33 * np.log10(self.frequency_downlink) + 40.94 - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H = (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-            # (L_O + 4.78 * np.power(np.log10(self.frequency_downlink), 2) - 18.33 * np.log10(self.frequency_downlink) + 40.94 - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H) / (44.9 - 6.55 * np.log10(h_B)) = np.log10(d)
-            # np.power(10, (L_O + 4.78 * np.power(np.log10(self.frequency_downlink), 2) - 18.33 * np.log10(self.frequency_downlink) + 40.94 - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H) / (44.9 - 6.55 * np.log10(h_B))) = d
-            distance = np.float_power(
-                10,
-                (
-                    self.get_path_loss(dbm=dbm)
-                    + 4.78 * np.power(np.log10(frequency), 2)
-                    - 18.33 * np.log10(frequency)
-                    + 40.94
-                    - 69.55
-                    - 26.16 * np.log10(frequency)
-                    + 13.82 * np.log10(h_B)
-                    + C_H
-                )
-                / (44.9 - 6.55 * np.log10(h_B)),
-            )
-        elif enviroment == "suburban":
-            # L_SU = L_U - 2 * np.power(np.log10(self.frequency_downlink/28), 2) - 5.4
-            # L_SU + 2 * np.power(np.log10(self.frequency_downlink/28), 2) + 5.4 = 69.55 + 26.16 * np.log10(self.frequency_downlink) - 13.82 * np.log10(h_B) - C_H + (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-            # L_SU + 2 * np.power(np.log10(self.frequency_downlink/28), 2) + 5.4 - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H = (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-            # (L_SU + 2 * np.power(np.log10(self.frequency_downlink/28), 2) + 5.4 - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H) / (44.9 - 6.55 * np.log10(h_B)) = np.log10(d)
-            # np.power(10, (L_SU + 2 * np.power(np.log10(self.frequency_downlink/28), 2) + 5.4 - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H) / (44.9 - 6.55 * np.log10(h_B))) = d
-            distance = np.float_power(
-                10,
-                (
-                    self.get_path_loss(dbm=dbm)
-                    + 2 * np.power(np.log10(frequency / 28), 2)
-                    + 5.4
-                    - 69.55
-                    - 26.16 * np.log10(frequency)
-                    + 13.82 * np.log10(h_B)
-                    + C_H
-                )
-                / (44.9 - 6.55 * np.log10(h_B)),
-            )
-        elif enviroment.startswith("urban"):
-            # L_U = 69.55 + 26.16 * np.log10(self.frequency_downlink) - 13.82 * np.log10(h_B) - C_H + (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-            # L_U - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H = (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
-            # (L_U - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H) / (44.9 - 6.55 * np.log10(h_B)) = np.log10(d)
-            # np.power(10, (L_U - 69.55 - 26.16 * np.log10(self.frequency_downlink) + 13.82 * np.log10(h_B) + C_H) / (44.9 - 6.55 * np.log10(h_B))) = d
-            distance = np.float_power(
-                10,
-                (
-                    self.get_path_loss(dbm=dbm)
-                    - 69.55
-                    - 26.16 * np.log10(frequency)
-                    + 13.82 * np.log10(h_B)
-                    + C_H
-                )
-                / (44.9 - 6.55 * np.log10(h_B)),
-            )
-
-        cache.set(key, distance, None)
+        distance = propagation.hata_distance(
+            self.get_path_loss(dbm=dbm), frequency, enviroment, h_M=h_M, h_B=h_B
+        )
         return gd.distance(distance)
 
     def hata_cost_231(
@@ -676,42 +989,9 @@ class Measurement(models.Model):
             dbm = self.dbm
         if frequency is None:
             frequency = self.frequency_downlink
-        key = f"hataCost{urban}{h_b}{h_r}{dbm}{frequency}"
-        distance = cache.get(key)
-        if distance:
-            return Distance(distance)
-
-        f = frequency
-        ah_m: float
-        c_m: float = 3.0 if urban else 0.0
-
-        # COST-231 Hata
-        # PL = 46.3 + 33.9 log10(f) - 13.82 log10(hb) - ahm + (44.9 - 6.55 log10(hb)) log10(d) + cm
-        # PL = TX - self.dbm = 46.3 + 33.9 log10(f) - 13.82 log10(hb) - ahm + (44.9 - 6.55 log10(hb)) log10(d) + cm
-        # TX - self.dbm - cm - 46.4 - 33.9 log10(f) + 13.82 log10(hb) + ahm = (44.9 - 6.55 log10(hb)) log10(d)
-        # log10(d) = (TX - self.dbm - cm - 46.4 - 33.9 log10(f) + 13.82 log10(hb) + ahm) / (44.9 - 6.55 log10(hb))
-        # d = 10 ^ ((TX - self.dbm - cm - 46.4 - 33.9 log10(f) + 13.82 log10(hb) + ahm) / (44.9 - 6.55 log10(hb)))
-
-        if urban:
-            ah_m = 3.20 * np.power(np.log10(11.75 * h_r), 2) - 4.97  # urban
-        else:
-            ah_m = (1.1 * np.log10(f) - 0.7) * h_r - (
-                1.56 * np.log10(f) - 0.8
-            )  # suburban / rural
-        distance = np.float_power(
-            10,
-            (
-                self.get_path_loss(dbm=dbm)
-                - c_m
-                - 46.4
-                - 33.9 * np.log10(f)
-                + 13.82 * np.log10(h_b)
-                + ah_m
-            )
-            / (44.9 - 6.55 * np.log10(h_b)),
+        distance = propagation.hata_cost_231_distance(
+            self.get_path_loss(dbm=dbm), frequency, urban, h_b=h_b, h_r=h_r
         )
-
-        cache.set(key, distance, None)
         return Distance(distance)
 
     def get_distance(
@@ -719,6 +999,15 @@ class Measurement(models.Model):
     ):
         from .utils import DistanceFunction
 
+        if (dbm is None or dbm == self.dbm) and (
+            frequency is None or frequency == self.frequency_downlink
+        ):
+            # Standardparameter: Tabellenwert statt Berechnung
+            distance = propagation.table_distances(
+                distance_function, self.rxl, propagation.normalize_arfcn(self.arfcn)
+            )
+            if not np.isnan(distance):
+                return Distance(float(distance))
         if distance_function == DistanceFunction.path_loss_free:
             return self.path_loss(v=2, dbm=dbm, frequency=frequency)
         elif distance_function == DistanceFunction.path_loss_outdoor:
@@ -744,6 +1033,23 @@ class Measurement(models.Model):
 
         return self.get_distance(DistanceFunction.hata_urban_small)
 
+    @staticmethod
+    def distances(measurements, distance_function=None) -> np.ndarray:
+        """Abstände in km aller ``measurements`` mit einem Tabellenzugriff, wie ``get_distance``."""
+        from .utils import DistanceFunction
+
+        if distance_function is None:
+            distance_function = DistanceFunction.hata_urban_small
+        measurements = list(measurements)
+        distances = propagation.table_distances(
+            distance_function,
+            [m.rxl for m in measurements],
+            [propagation.normalize_arfcn(m.arfcn) for m in measurements],
+        )
+        for i in np.flatnonzero(np.isnan(distances)):
+            distances[i] = measurements[i].get_distance(distance_function).kilometers
+        return distances
+
 
 class Radio(models.Model):
     name = models.CharField(max_length=7, db_index=True)
@@ -776,6 +1082,64 @@ class BaseTransceiverStation(models.Model):
         self.longitude = sum([c.lon for c in self.cells.all()]) / self.cells.count()
         self.save()
 
+    @classmethod
+    def calc_locations(cls, ids: Iterable[int]):
+        # Wie calc_location, aber mit einer Aggregat-Abfrage und einem bulk_update für alle BTS
+        from django.db.models import Avg
+
+        ids = set(ids)
+        if not ids:
+            return
+        locations = (
+            Celltower.objects.filter(bts_id__in=ids)
+            .order_by()
+            .values("bts_id")
+            .annotate(latitude=Avg("lat"), longitude=Avg("lon"))
+        )
+        stations = [
+            cls(id=l["bts_id"], latitude=l["latitude"], longitude=l["longitude"])
+            for l in locations
+        ]
+        cls.objects.bulk_update(stations, ["latitude", "longitude"])
+
+    @classmethod
+    def by_keys(
+        cls, keys: Iterable[Tuple[int, int, int, int]]
+    ) -> Dict[Tuple[int, int, int, int], int]:
+        # (mcc, mnc, lac, bsic) -> id, fehlende BTS werden mit einem bulk_create angelegt
+        keys = set(keys)
+        if not keys:
+            return {}
+
+        def fetch(keys):
+            query = reduce(
+                operator.or_,
+                (
+                    Q(mcc=mcc, mnc=mnc, lac=lac, bsic=bsic)
+                    for mcc, mnc, lac, bsic in keys
+                ),
+            )
+            return {
+                (mcc, mnc, lac, bsic): id
+                for id, mcc, mnc, lac, bsic in cls.objects.filter(query).values_list(
+                    "id", "mcc", "mnc", "lac", "bsic"
+                )
+            }
+
+        found = fetch(keys)
+        missing = keys - found.keys()
+        if missing:
+            # ignore_conflicts liefert keine ids, parallel angelegte BTS werden so ebenfalls gefunden
+            cls.objects.bulk_create(
+                [
+                    cls(mcc=mcc, mnc=mnc, lac=lac, bsic=bsic)
+                    for mcc, mnc, lac, bsic in missing
+                ],
+                ignore_conflicts=True,
+            )
+            found.update(fetch(missing))
+        return found
+
     def __str__(self):
         return f"LAC: {self.lac} BSIC: {self.bsic} Cells: {self.cells.count()}"
 
@@ -816,12 +1180,31 @@ class Celltower(models.Model):
     def point(self):
         return Point(self.lat, self.lon)
 
+    @property
+    def key(self) -> Tuple[int, int, int, int]:
+        return self.mcc, self.mnc, self.lac, self.cid
+
+    @classmethod
+    def by_keys(
+        cls, keys: Iterable[Tuple[int, int, int, int]]
+    ) -> Dict[Tuple[int, int, int, int], "Celltower"]:
+        # Eine Abfrage für alle (mcc, mnc, lac, cid) Schlüssel, nutzt den unique_together Index
+        keys = set(keys)
+        if not keys:
+            return {}
+        query = reduce(
+            operator.or_,
+            (Q(mcc=mcc, mnc=mnc, lac=lac, cid=cid) for mcc, mnc, lac, cid in keys),
+        )
+        return {c.key: c for c in cls.objects.filter(query)}
+
     def __str__(self):
         return f"mcc: {self.mcc}, mnc: {self.mnc}, lac: {hex(self.lac)}, cid: {hex(self.cid)}"
 
 
 @receiver(post_save, sender=Celltower)
 def on_celltower_update(sender, instance: Celltower, created: bool, **kwargs):
+    tower_index.invalidate(instance)
     if instance.bts is None and instance.bsic:
         instance.bts, bts_created = BaseTransceiverStation.objects.get_or_create(
             mcc=instance.mcc, mnc=instance.mnc, lac=instance.lac, bsic=instance.bsic
@@ -829,3 +1212,102 @@ def on_celltower_update(sender, instance: Celltower, created: bool, **kwargs):
         instance.save()
     if instance.bts:
         instance.bts.calc_location()
+
+
+@receiver(post_delete, sender=Celltower)
+def on_celltower_delete(sender, instance: Celltower, **kwargs):
+    tower_index.invalidate(instance)
+
+
+class _CommitBatch:
+    """Sammelt Werte bis zum Commit der laufenden Transaktion und ruft ``func`` dann einmal mit allen auf."""
+
+    def __init__(self, func: Callable[[Set], None]):
+        self.func = func
+        self.attr = f"_commit_batch_{id(self)}"
+
+    def add(self, value):
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            self.func({value})
+            return
+        values, run = getattr(connection, self.attr, (None, None))
+        # Nach einem Rollback ist der Rückruf verworfen, dann beginnt eine neue Sammlung
+        if run is None or not any(
+            entry[1] is run for entry in connection.run_on_commit
+        ):
+            values = set()
+
+            def run():
+                setattr(connection, self.attr, (None, None))
+                self.func(values)
+
+            setattr(connection, self.attr, (values, run))
+            transaction.on_commit(run)
+        values.add(value)
+
+
+def _rebuild_summaries(device_ids: Set[int]):
+    # Inzwischen gelöschte Geräte haben keine Übersicht mehr
+    for device in Device.objects.filter(id__in=device_ids).only(
+        "id", "last_position_id"
+    ):
+        summary = DeviceSummary.rebuild(device)
+        if device.last_position_id is None:
+            Device.objects.filter(id=device.id, last_position_id=None).update(
+                last_position_id=summary.last_status_id
+            )
+
+
+_summary_rebuilds = _CommitBatch(_rebuild_summaries)
+
+
+def _update_celltowers(status_ids: Set[int]):
+    Status.update_celltowers(Status.objects.filter(id__in=status_ids))
+
+
+_celltower_updates = _CommitBatch(_update_celltowers)
+
+
+@receiver(post_save, sender=Measurement)
+@receiver(post_delete, sender=Measurement)
+def on_measurement_change(sender, instance: Measurement, origin=None, **kwargs):
+    # Beim Löschen eines Status oder Geräts über die Kaskade ist nichts mehr zu aktualisieren
+    if (
+        origin is not None
+        and not isinstance(origin, Measurement)
+        and getattr(origin, "model", None) is not Measurement
+    ):
+        return
+    # Einmal je Status nach dem Commit, auch wenn sich mehrere Messungen ändern
+    _celltower_updates.add(instance.status_id)
+
+
+@receiver(post_delete, sender=Status)
+def on_status_delete(sender, instance: Status, origin=None, **kwargs):
+    # Beim Löschen des Geräts entfällt auch die Übersicht
+    if isinstance(origin, Device) or getattr(origin, "model", None) is Device:
+        return
+    # last_position hat DO_NOTHING, der Verweis muss noch in der Transaktion weg, der Nachfolger folgt nach dem Commit
+    Device.objects.filter(id=instance.device_id, last_position_id=instance.id).update(
+        last_position_id=None
+    )
+    _summary_rebuilds.add(instance.device_id)
+
+
+def update_celltower_bsics(celltowers: List[Celltower]):
+    """Wie on_celltower_update, aber für viele Celltower mit einem bulk_update statt save() pro Celltower."""
+    if not celltowers:
+        return
+    stations = BaseTransceiverStation.by_keys(
+        (c.mcc, c.mnc, c.lac, c.bsic) for c in celltowers if c.bts_id is None and c.bsic
+    )
+    for celltower in celltowers:
+        if celltower.bts_id is None and celltower.bsic:
+            celltower.bts_id = stations[
+                (celltower.mcc, celltower.mnc, celltower.lac, celltower.bsic)
+            ]
+    Celltower.objects.bulk_update(celltowers, ["bsic", "bts"])
+    # bulk_update löst kein post_save aus, die Marken für andere Prozesse folgen gesammelt nach dem Commit
+    tower_index.invalidate_many(celltowers)
+    BaseTransceiverStation.calc_locations(c.bts_id for c in celltowers if c.bts_id)
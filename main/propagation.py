@@ -0,0 +1,242 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+from scipy.constants import c
+from scipy.constants import kilo
+from scipy.constants import mega
+from scipy.constants import pi
+
+from .cache import memoize
+
+# Tabellen für alle rxl (0-63) und arfcn (0-1023) Kombinationen
+RXL_COUNT = 64
+ARFCN_COUNT = 1024
+
+
+def normalize_arfcn(arfcn: Optional[int]) -> int:
+    return arfcn if arfcn and arfcn != (2 ** 16) - 1 else 0
+
+
+def uplink_frequency(arfcn: int) -> Optional[float]:
+    if 0 <= arfcn <= 124:
+        return 890.0 + 0.2 * (arfcn - 0)
+    elif 128 <= arfcn <= 251:
+        return 824.2 + 0.2 * (arfcn - 128)
+    elif 259 <= arfcn <= 293:
+        return 450.6 + 0.2 * (arfcn - 259)
+    elif 306 <= arfcn <= 340:
+        return 479.0 + 0.2 * (arfcn - 306)
+    elif 438 <= arfcn <= 511:
+        return 747.2 + 0.2 * (arfcn - 438)
+    elif 512 <= arfcn <= 885:
+        return 1710.2 + 0.2 * (arfcn - 512)
+    elif 955 <= arfcn <= 1023:
+        return 890.0 + 0.2 * (arfcn - 1024)
+
+
+def downlink_frequency(arfcn: int) -> Optional[float]:
+    if 0 <= arfcn <= 124:
+        return uplink_frequency(arfcn) + 45
+    elif 128 <= arfcn <= 251:
+        return uplink_frequency(arfcn) + 45
+    elif 259 <= arfcn <= 293:
+        return uplink_frequency(arfcn) + 10
+    elif 306 <= arfcn <= 340:
+        return uplink_frequency(arfcn) + 10
+    elif 438 <= arfcn <= 511:
+        return uplink_frequency(arfcn) + 30
+    elif 512 <= arfcn <= 885:
+        return uplink_frequency(arfcn) + 95
+    elif 955 <= arfcn <= 1023:
+        return uplink_frequency(arfcn) + 45
+
+
+def rxl_to_dbm(rxl):
+    return -(113 - rxl)
+
+
+@memoize()
+def path_loss(dbm, max_tx_mw: float = 20_000, max_tx_dbm=None):
+    TX = max_tx_dbm if max_tx_dbm else 10 * np.log10(max_tx_mw)
+    return TX - dbm
+
+
+# Die Abstandsmodelle rechnen elementweise, ``path_loss`` und ``frequency`` (MHz) dürfen Arrays sein,
+# Ergebnis ist jeweils der Abstand in km. Skalare Aufrufe werden prozesslokal memoisiert.
+
+
+@memoize()
+def path_loss_distance(path_loss, frequency, v: float = 2):
+    # v = 2: Free Space (vacuum)
+    # v = 2.5: Outdoor - rural
+    # v = 3-4: Outdoor - urban
+    # v = 4-5: Outdoor - dense urban
+    # v = 1.6 - 1.8: Indoor - large open areas
+    # v = 4-6: Indoor - no line of sight
+
+    # lambda = c / f
+    # PL = 10 * v * np.log10((4 * pi * d) / lambda)
+    # PL / (10 * v) = np.log10((4 * pi * d) / lambda)
+    # np.power(10, PL / (10 * v)) = (4 * pi * d) / lambda
+    # np.power(10, PL / (10 * v)) / lambda = 4 * pi * d
+    # (np.power(10, PL / (10 * v)) / lambda) / 4 * pi = d
+    f = frequency * mega
+    _lambda = c / f
+    distance = (np.power(10, path_loss / (10 * v)) / _lambda) / 4 * pi
+    return distance * kilo
+
+
+@memoize()
+def hata_distance(
+    path_loss, frequency, enviroment: str = "open", h_M: float = 3.0, h_B: float = 80.0
+):
+    if not enviroment.startswith("urban") or (
+        enviroment.endswith("small") or enviroment.endswith("medium")
+    ):
+        # Small / medium city
+        C_H = 0.8 + (1.1 * np.log10(frequency) - 0.7) * h_M - 1.56 * np.log10(frequency)
+    else:
+        # large city
+        C_H = 3.2 * np.power(np.log10(11.75 * h_M), 2) - 4.97
+
+    # L_U = 69.55 + 26.16 * np.log10(f) - 13.82 * np.log10(h_B) - C_H + (44.9 - 6.55 * np.log10(h_B)) * np.log10(d)
+    if enviroment == "open":
+        # L_O = L_U - 4.78 * np.power(np.log10(f), 2) + 18.33 * np.log10(f) - 40.94
+        return np.float_power(
+            10,
+            (
+                path_loss
+                + 4.78 * np.power(np.log10(frequency), 2)
+                - 18.33 * np.log10(frequency)
+                + 40.94
+                - 69.55
+                - 26.16 * np.log10(frequency)
+                + 13.82 * np.log10(h_B)
+                + C_H
+            )
+            / (44.9 - 6.55 * np.log10(h_B)),
+        )
+    elif enviroment == "suburban":
+        # L_SU = L_U - 2 * np.power(np.log10(f / 28), 2) - 5.4
+        return np.float_power(
+            10,
+            (
+                path_loss
+                + 2 * np.power(np.log10(frequency / 28), 2)
+                + 5.4
+                - 69.55
+                - 26.16 * np.log10(frequency)
+                + 13.82 * np.log10(h_B)
+                + C_H
+            )
+            / (44.9 - 6.55 * np.log10(h_B)),
+        )
+    elif enviroment.startswith("urban"):
+        return np.float_power(
+            10,
+            (
+                path_loss
+                - 69.55
+                - 26.16 * np.log10(frequency)
+                + 13.82 * np.log10(h_B)
+                + C_H
+            )
+            / (44.9 - 6.55 * np.log10(h_B)),
+        )
+
+
+@memoize()
+def hata_cost_231_distance(
+    path_loss, frequency, urban: bool = False, h_b: float = 80.0, h_r: float = 3.0
+):
+    # COST-231 Hata
+    # PL = 46.3 + 33.9 log10(f) - 13.82 log10(hb) - ahm + (44.9 - 6.55 log10(hb)) log10(d) + cm
+    # log10(d) = (PL - cm - 46.4 - 33.9 log10(f) + 13.82 log10(hb) + ahm) / (44.9 - 6.55 log10(hb))
+    f = frequency
+    c_m = 3.0 if urban else 0.0
+    if urban:
+        ah_m = 3.20 * np.power(np.log10(11.75 * h_r), 2) - 4.97  # urban
+    else:
+        ah_m = (1.1 * np.log10(f) - 0.7) * h_r - (
+            1.56 * np.log10(f) - 0.8
+        )  # suburban / rural
+    return np.float_power(
+        10,
+        (path_loss - c_m - 46.4 - 33.9 * np.log10(f) + 13.82 * np.log10(h_b) + ah_m)
+        / (44.9 - 6.55 * np.log10(h_b)),
+    )
+
+
+def distance_model(distance_function):
+    """(Abstandsfunktion, Parameter) eines utils.DistanceFunction, wie von Measurement.get_distance verwendet."""
+    from .utils import DistanceFunction
+
+    return {
+        DistanceFunction.path_loss_free: (path_loss_distance, {"v": 2}),
+        DistanceFunction.path_loss_outdoor: (path_loss_distance, {"v": 3.5}),
+        DistanceFunction.path_loss_indoor: (path_loss_distance, {"v": 6}),
+        DistanceFunction.hata_open: (hata_distance, {"enviroment": "open"}),
+        DistanceFunction.hata_suburban: (hata_distance, {"enviroment": "suburban"}),
+        DistanceFunction.hata_urban_small: (
+            hata_distance,
+            {"enviroment": "urban_small"},
+        ),
+        DistanceFunction.hata_urban_big: (hata_distance, {"enviroment": "urban_big"}),
+        DistanceFunction.hata_cost_urban: (hata_cost_231_distance, {"urban": True}),
+        DistanceFunction.hata_cost_rural: (hata_cost_231_distance, {"urban": False}),
+    }[distance_function]
+
+
+@lru_cache(maxsize=None)
+def downlink_frequencies() -> np.ndarray:
+    """Downlink Frequenz in MHz je arfcn, NaN für nicht belegte Kanäle."""
+    return np.array(
+        [
+            np.nan if f is None else f
+            for f in map(downlink_frequency, range(ARFCN_COUNT))
+        ]
+    )
+
+
+@lru_cache(maxsize=None)
+def distance_table(distance_function) -> np.ndarray:
+    """Abstand in km je (rxl, arfcn) für die Standardparameter von ``distance_function``, einmal pro Prozess."""
+    function, parameters = distance_model(distance_function)
+    pl = path_loss(rxl_to_dbm(np.arange(RXL_COUNT, dtype=float)))
+    with np.errstate(invalid="ignore"):
+        table = function(pl[:, None], downlink_frequencies()[None, :], **parameters)
+    table.setflags(write=False)
+    return table
+
+
+def table_distances(distance_function, rxl, arfcn) -> np.ndarray:
+    """Abstände in km für Arrays von rxl und normalisierten arfcn, NaN außerhalb der Tabelle."""
+    rxl = np.asarray(rxl, dtype=np.int64)
+    arfcn = np.asarray(arfcn, dtype=np.int64)
+    inside = (rxl >= 0) & (rxl < RXL_COUNT) & (arfcn >= 0) & (arfcn < ARFCN_COUNT)
+    table = distance_table(distance_function)
+    return np.where(
+        inside, table[np.where(inside, rxl, 0), np.where(inside, arfcn, 0)], np.nan
+    )
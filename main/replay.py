@@ -0,0 +1,245 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import binascii
+from base64 import b64decode
+from dataclasses import dataclass
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+import numpy as np
+
+from .api import VERSION_OFFSET
+from .api import BatchHeader
+from .api import CengResult
+from .api import Errors
+from .api import Extras
+from .api import ExtrasFlags
+from .api import ReportHeader
+from .api import TrackerUpdate
+from .api import UpdateHeader
+
+# Entspricht Cell ("< 4H 2B") bzw. CellV2 ("< 4H 2B H"), ohne Padding
+CELL_DTYPE = np.dtype(
+    [
+        ("mcc", "<u2"),
+        ("mnc", "<u2"),
+        ("lac", "<u2"),
+        ("cid", "<u2"),
+        ("bsic", "u1"),
+        ("rxl", "u1"),
+    ]
+)
+CELL_V2_DTYPE = np.dtype(CELL_DTYPE.descr + [("arfcn", "<u2")])
+
+# v3 überträgt keine ARFCN, wie bei der Firmware steht 0xFFFF für "unbekannt"
+ARFCN_UNKNOWN = (2 ** 16) - 1
+
+# Version -> (Offset der Zellanzahl, Offset des Zellblocks, dtype)
+_CELL_BLOCKS = {
+    3: (
+        VERSION_OFFSET + 1,
+        TrackerUpdate.struct_size() + CengResult.struct_size(),
+        CELL_DTYPE,
+    ),
+    4: (VERSION_OFFSET + 1, UpdateHeader.struct_size(), CELL_V2_DTYPE),
+}
+
+_BATCH_VERSION = 5
+
+
+@dataclass
+class CellColumns:
+    status: np.ndarray
+    mcc: np.ndarray
+    mnc: np.ndarray
+    lac: np.ndarray
+    cid: np.ndarray
+    bsic: np.ndarray
+    rxl: np.ndarray
+    arfcn: np.ndarray
+
+    def __len__(self):
+        return len(self.status)
+
+
+def payload_bytes(payload: Union[bytes, memoryview, str]) -> bytes:
+    """Rohdaten eines Status als bytes.
+
+    Ältere Status enthalten den base64 kodierten Body als str(bytes), also "b'...'", entweder
+    noch als Text oder nach der Umstellung auf BinaryField als dessen Bytes.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    payload = bytes(payload)
+    if len(payload) > 3 and payload.startswith(b"b'") and payload.endswith(b"'"):
+        try:
+            return b64decode(payload[2:-1], validate=True)
+        except binascii.Error:
+            pass
+    return payload
+
+
+def _batch_cell_block(payload: bytes) -> Optional[np.ndarray]:
+    # Die Reports sind unterschiedlich lang, daher nur die Header ablaufen und die Zellblöcke zusammenfügen
+    header = BatchHeader.from_struct(payload)
+    offset = BatchHeader.struct_size()
+    blocks: List[np.ndarray] = []
+    for _ in range(header.reports_length):
+        if len(payload) < offset + ReportHeader.struct_size():
+            return None
+        report = ReportHeader.from_struct(payload, offset)
+        offset += ReportHeader.struct_size()
+        if len(payload) < offset + report.cells_length * CELL_V2_DTYPE.itemsize:
+            return None
+        blocks.append(
+            np.frombuffer(
+                payload, dtype=CELL_V2_DTYPE, count=report.cells_length, offset=offset
+            )
+        )
+        offset += report.cells_length * CELL_V2_DTYPE.itemsize + Extras.struct_size()
+        if ExtrasFlags.ERROR_CODE in report.extras_flags:
+            if len(payload) <= offset:
+                return None
+            offset += (
+                Errors._length_struct.size + payload[offset] * Errors._value_struct.size
+            )
+    return np.concatenate(blocks) if blocks else np.empty(0, dtype=CELL_V2_DTYPE)
+
+
+def cell_block(payload: bytes) -> Optional[np.ndarray]:
+    """Zellblock eines Payloads als strukturiertes Array, ohne die Zellen einzeln zu dekodieren."""
+    if len(payload) <= VERSION_OFFSET + 1:
+        return None
+    if payload[VERSION_OFFSET] == _BATCH_VERSION:
+        if len(payload) < BatchHeader.struct_size():
+            return None
+        return _batch_cell_block(payload)
+    layout = _CELL_BLOCKS.get(payload[VERSION_OFFSET])
+    if layout is None:
+        return None
+    length_offset, offset, dtype = layout
+    count = payload[length_offset]
+    if len(payload) < offset + count * dtype.itemsize:
+        return None
+    return np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+
+
+def decode_cell_columns(
+    payloads: Iterable[Union[bytes, memoryview, str]],
+    ids: Optional[Sequence[int]] = None,
+    drop_empty: bool = True,
+) -> CellColumns:
+    """Dekodiert die Zellen vieler Payloads spaltenweise.
+
+    ``status`` enthält für jede Zelle die Position des Payloads in ``payloads`` bzw. die passende
+    Id aus ``ids``. Unbekannte Versionen und abgeschnittene Payloads werden übersprungen.
+    """
+    blocks: List[np.ndarray] = []
+    owners: List[int] = []
+    counts: List[int] = []
+    for i, payload in enumerate(payloads):
+        block = cell_block(payload_bytes(payload))
+        if block is None or len(block) == 0:
+            continue
+        blocks.append(block)
+        owners.append(ids[i] if ids is not None else i)
+        counts.append(len(block))
+
+    total = sum(counts)
+    columns = CellColumns(
+        status=np.repeat(np.asarray(owners, dtype=np.int64), counts),
+        mcc=np.empty(total, dtype=np.uint16),
+        mnc=np.empty(total, dtype=np.uint16),
+        lac=np.empty(total, dtype=np.uint16),
+        cid=np.empty(total, dtype=np.uint16),
+        bsic=np.empty(total, dtype=np.uint8),
+        rxl=np.empty(total, dtype=np.uint8),
+        arfcn=np.full(total, ARFCN_UNKNOWN, dtype=np.uint16),
+    )
+    start = 0
+    for block in blocks:
+        end = start + len(block)
+        for name in block.dtype.names:
+            getattr(columns, name)[start:end] = block[name]
+        start = end
+
+    if drop_empty:
+        keep = (columns.mcc != 0) & (columns.mnc != 0)
+        if not keep.all():
+            columns = CellColumns(
+                **{name: values[keep] for name, values in columns.__dict__.items()}
+            )
+    return merge_duplicate_cells(columns)
+
+
+def merge_duplicate_cells(columns: CellColumns) -> CellColumns:
+    """Fasst Zellen mit gleichem (status, mcc, mnc, lac, cid) zusammen wie api._add_cell.
+
+    Die Zelle bleibt an der Stelle ihres ersten Auftretens, rxl und arfcn kommen von der stärksten.
+    """
+    if len(columns) < 2:
+        return columns
+    keys = np.stack(
+        [columns.status, columns.mcc, columns.mnc, columns.lac, columns.cid], axis=1
+    )
+    _, first, group = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    if len(first) == len(columns):
+        return columns
+    group = group.reshape(-1)
+    # Je Gruppe zuerst die stärkste Zelle, bei Gleichstand die frühere
+    order = np.lexsort((np.arange(len(columns)), -columns.rxl.astype(np.int16), group))
+    strongest = order[np.r_[0, np.flatnonzero(np.diff(group[order])) + 1]]
+    rows = np.argsort(first, kind="stable")
+    first, strongest = first[rows], strongest[rows]
+    merged = {name: values[first] for name, values in columns.__dict__.items()}
+    merged["rxl"] = columns.rxl[strongest]
+    merged["arfcn"] = columns.arfcn[strongest]
+    return CellColumns(**merged)
+
+
+def concat_cell_columns(parts: Sequence[CellColumns]) -> CellColumns:
+    return CellColumns(
+        **{
+            name: np.concatenate([getattr(p, name) for p in parts])
+            for name in CellColumns.__dataclass_fields__
+        }
+    )
+
+
+def decode_status_cells(statuses, chunk_size: int = 10_000) -> CellColumns:
+    """Spaltenweise Zellen für ein Status QuerySet, ``status`` enthält die Status Ids."""
+    parts: List[CellColumns] = []
+    ids: List[int] = []
+    payloads: List[bytes] = []
+    for status_id, raw_data in statuses.values_list("id", "raw_data").iterator(
+        chunk_size=chunk_size
+    ):
+        ids.append(status_id)
+        payloads.append(raw_data)
+        if len(ids) >= chunk_size:
+            parts.append(decode_cell_columns(payloads, ids=ids))
+            ids, payloads = [], []
+    parts.append(decode_cell_columns(payloads, ids=ids))
+    return concat_cell_columns(parts)
@@ -0,0 +1,348 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import math
+import struct
+from dataclasses import dataclass
+from typing import Iterator
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+
+from .api import BatchHeader
+from .api import Cell
+from .api import CellV2
+from .api import CengResult
+from .api import ErrorFlags
+from .api import Errors
+from .api import Extras
+from .api import ExtrasFlags
+from .api import ReportHeader
+from .api import TrackerUpdate
+from .api import UpdateHeader
+
+IMEI_BASE = 867530900000000
+
+
+def encode_v3(
+    imei: int,
+    cells: Sequence[Cell],
+    spannung: float = 7.9,
+    temp: float = 20.0,
+    uplink=(12, 11),
+) -> bytes:
+    # Die v3 IMEI wird serverseitig als f"{imei_high}{imei_low}" zusammengesetzt
+    imei = str(imei)
+    body = TrackerUpdate._struct.pack(
+        int(imei[:-7] or 0), int(imei[-7:]), spannung, *uplink
+    )
+    body += CengResult._struct.pack(3, len(cells))
+    for cell in cells:
+        body += Cell._struct.pack(
+            cell.mcc, cell.mnc, cell.lac, cell.cellid, cell.bsic, cell.rxl
+        )
+    return body + Extras._struct.pack(round(temp * 4))
+
+
+def encode_v4(
+    imei: int,
+    cells: Sequence[CellV2],
+    voltage: Tuple[int, int] = (1024, 700),
+    temp: float = 20.0,
+    errors: Sequence[Tuple[ErrorFlags, int]] = (),
+    flags: ExtrasFlags = ExtrasFlags.VOLTAGE
+    | ExtrasFlags.VOLTAGE_RAW
+    | ExtrasFlags.TEMPERATURE,
+    uplink=(12, 11),
+) -> bytes:
+    """``voltage`` ist (Referenz, Rohwert), mit ExtrasFlags.VOLTAGE_RAW wie von der Firmware gesendet."""
+    if errors:
+        flags |= ExtrasFlags.ERROR_CODE
+    body = struct.pack(
+        UpdateHeader.get_struct_format_string(voltage_raw=True),
+        imei,
+        *voltage,
+        *uplink,
+        4,
+        len(cells),
+        flags,
+    )
+    for cell in cells:
+        body += CellV2._struct.pack(
+            cell.mcc, cell.mnc, cell.lac, cell.cellid, cell.bsic, cell.rxl, cell.arfcn
+        )
+    body += Extras._struct.pack(round(temp * 4))
+    if errors:
+        body += Errors._length_struct.pack(len(errors))
+        for error_flags, code in errors:
+            body += Errors._value_struct.pack((int(error_flags) << 10) | code)
+    return body
+
+
+def sample_payload(
+    version: int, cells: int, imei: int = None, reports: int = 4
+) -> bytes:
+    if version == 3:
+        # Die v3 IMEI wird serverseitig als f"{imei_high}{imei_low}" zusammengesetzt
+        imei = str(imei or 8675309)
+        body = struct.pack(
+            TrackerUpdate.get_struct_format_string(),
+            int(imei[:-7] or 0),
+            int(imei[-7:]),
+            7.9,
+            12,
+            11,
+        )
+        body += struct.pack(CengResult.get_struct_format_string(), 3, cells)
+        for i in range(cells):
+            body += struct.pack(
+                Cell.get_struct_format_string(),
+                262,
+                1,
+                0x1234,
+                0x100 + i,
+                20 + i,
+                30 - i,
+            )
+        return body + struct.pack("< h", 80)
+    elif version == 4:
+        flags = (
+            ExtrasFlags.VOLTAGE
+            | ExtrasFlags.VOLTAGE_RAW
+            | ExtrasFlags.TEMPERATURE
+            | ExtrasFlags.ERROR_CODE
+        )
+        body = struct.pack(
+            UpdateHeader.get_struct_format_string(voltage_raw=True),
+            imei or 867530900000001,
+            1024,
+            700,
+            12,
+            11,
+            4,
+            cells,
+            flags,
+        )
+        for i in range(cells):
+            body += struct.pack(
+                CellV2.get_struct_format_string(),
+                262,
+                1,
+                0x1234,
+                0x100 + i,
+                20 + i,
+                30 - i,
+                10 * i,
+            )
+        return body + struct.pack("< h B 2H", 80, 2, (1 << 13) | 5, (1 << 12) | 17)
+    elif version == 5:
+        flags = ExtrasFlags.VOLTAGE | ExtrasFlags.TEMPERATURE
+        body = struct.pack(
+            BatchHeader.get_struct_format_string(),
+            imei or 867530900000001,
+            12,
+            11,
+            5,
+            reports,
+            0,
+        )
+        for r in range(reports):
+            # Ältester Report zuerst, im Abstand von 15 Minuten
+            report_flags = flags | ExtrasFlags.ERROR_CODE if r == 0 else flags
+            body += struct.pack(
+                ReportHeader.get_struct_format_string(),
+                (reports - 1 - r) * 900,
+                1024,
+                700,
+                cells,
+                report_flags,
+            )
+            for i in range(cells):
+                body += struct.pack(
+                    CellV2.get_struct_format_string(),
+                    262,
+                    1,
+                    0x1234,
+                    0x100 + i,
+                    20 + i,
+                    30 - i - r,
+                    10 * i,
+                )
+            body += struct.pack("< h", 80)
+            if report_flags & ExtrasFlags.ERROR_CODE:
+                body += struct.pack("< B H", 1, (1 << 13) | 5)
+        return body
+    raise ValueError(f"Unknown payload version {version}")
+
+
+@dataclass
+class SimulatedTower:
+    mcc: int
+    mnc: int
+    lac: int
+    cid: int
+    bsic: int
+    arfcn: int
+    lat: float
+    lon: float
+
+
+class Fleet:
+    """Reproduzierbare Tracker, die sich zufällig durch ein Gebiet mit zufällig verteilten Funkmasten bewegen."""
+
+    def __init__(
+        self,
+        devices: int = 100,
+        towers: int = 500,
+        seed: int = 0,
+        center: Tuple[float, float] = (52.52, 13.40),
+        size_km: float = 30.0,
+        cells: int = 7,
+        version: int = 4,
+        step_km: float = 0.5,
+        error_rate: float = 0.02,
+    ):
+        self.rng = np.random.default_rng(seed)
+        self.cells = cells
+        self.version = version
+        self.step_km = step_km
+        self.error_rate = error_rate
+        self._km_per_degree = (111.32, 111.32 * math.cos(math.radians(center[0])))
+        half = size_km / 2
+        north = self.rng.uniform(-half, half, towers)
+        east = self.rng.uniform(-half, half, towers)
+        self.tower_lat = center[0] + north / self._km_per_degree[0]
+        self.tower_lon = center[1] + east / self._km_per_degree[1]
+        self.towers: List[SimulatedTower] = [
+            SimulatedTower(
+                mcc=262,
+                mnc=1 + i % 3,
+                lac=0x1000 + i // 64,
+                cid=0x100 + i,
+                bsic=int(self.rng.integers(0, 64)),
+                arfcn=int(
+                    self.rng.choice(
+                        [self.rng.integers(1, 125), self.rng.integers(512, 886)]
+                    )
+                ),
+                lat=float(self.tower_lat[i]),
+                lon=float(self.tower_lon[i]),
+            )
+            for i in range(towers)
+        ]
+        self.imeis = [IMEI_BASE + i for i in range(devices)]
+        self.device_lat = (
+            center[0] + self.rng.uniform(-half, half, devices) / self._km_per_degree[0]
+        )
+        self.device_lon = (
+            center[1] + self.rng.uniform(-half, half, devices) / self._km_per_degree[1]
+        )
+
+    def seed_celltowers(self) -> int:
+        """Legt die simulierten Funkmasten in der Datenbank an, vorhandene bleiben unverändert."""
+        from .models import Celltower
+
+        created = Celltower.objects.bulk_create(
+            [
+                Celltower(
+                    mcc=t.mcc,
+                    mnc=t.mnc,
+                    lac=t.lac,
+                    cid=t.cid,
+                    bsic=t.bsic,
+                    lat=t.lat,
+                    lon=t.lon,
+                )
+                for t in self.towers
+            ],
+            ignore_conflicts=True,
+        )
+        return len(created)
+
+    def _move(self, device: int):
+        angle = self.rng.uniform(0, 2 * math.pi)
+        distance = self.rng.exponential(self.step_km)
+        self.device_lat[device] += distance * math.cos(angle) / self._km_per_degree[0]
+        self.device_lon[device] += distance * math.sin(angle) / self._km_per_degree[1]
+
+    def visible_cells(self, device: int) -> List[CellV2]:
+        """Die ``cells`` nächsten Funkmasten, Empfangspegel nach einem einfachen log-distance Modell."""
+        d_north = (self.tower_lat - self.device_lat[device]) * self._km_per_degree[0]
+        d_east = (self.tower_lon - self.device_lon[device]) * self._km_per_degree[1]
+        distance_m = np.maximum(np.hypot(d_north, d_east) * 1000, 10.0)
+        nearest = np.argsort(distance_m)[: self.cells]
+        dbm = (
+            -40
+            - 35 * np.log10(distance_m[nearest] / 10)
+            + self.rng.normal(0, 4, len(nearest))
+        )
+        rxl = np.clip(np.round(dbm + 113), 0, 63).astype(int)
+        return [
+            CellV2(t.mcc, t.mnc, t.lac, t.cid, t.bsic, int(r), t.arfcn)
+            for t, r in zip((self.towers[i] for i in nearest), rxl)
+        ]
+
+    def payload(self, device: int) -> bytes:
+        self._move(device)
+        cells = self.visible_cells(device)
+        imei = self.imeis[device]
+        temp = float(self.rng.normal(18, 6))
+        if self.version == 3:
+            return encode_v3(
+                imei, cells, spannung=float(self.rng.uniform(6.5, 8.4)), temp=temp
+            )
+        errors = []
+        if self.rng.random() < self.error_rate:
+            errors.append(
+                (ErrorFlags.GSM | ErrorFlags.TIMEOUT, int(self.rng.integers(0, 1024)))
+            )
+        return encode_v4(
+            imei,
+            cells,
+            voltage=(1024, int(self.rng.integers(600, 760))),
+            temp=temp,
+            errors=errors,
+        )
+
+    def payloads(self, count: int) -> Iterator[bytes]:
+        """``count`` Uploads, reihum von allen Trackern."""
+        for i in range(count):
+            yield self.payload(i % len(self.imeis))
+
+    def measurements(self, device: int, noise: float = 0.1):
+        """Lateration Eingabe für die aktuelle Position, Abstände mit ``noise`` relativem log-normalen Rauschen."""
+        from geopy import Point
+
+        from .utils import Measurement
+
+        d_north = (self.tower_lat - self.device_lat[device]) * self._km_per_degree[0]
+        d_east = (self.tower_lon - self.device_lon[device]) * self._km_per_degree[1]
+        distance_km = np.hypot(d_north, d_east)
+        nearest = np.argsort(distance_km)[: self.cells]
+        measured = np.maximum(
+            distance_km[nearest] * self.rng.lognormal(0, noise, len(nearest)), 0.01
+        )
+        return [
+            Measurement(Point(self.tower_lat[i], self.tower_lon[i]), float(d))
+            for i, d in zip(nearest, measured)
+        ]
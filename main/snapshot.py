@@ -0,0 +1,258 @@
+""" Copyright (C) 2021 Patrick Frontzek
+This file is part of OpenAssetTracker-Server.
+
+OpenAssetTracker-Server is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenAssetTracker-Server is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenAssetTracker-Server.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Patrick Frontzek"
+__copyright__ = "Copyright 2021, Patrick Frontzek"
+__license__ = "GPLv3"
+
+import logging
+import os
+import threading
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from .cache import CelltowerKey
+from .cache import TowerInfo
+
+logger = logging.getLogger(__name__)
+
+# Eine Zeile pro Funkmast, sortiert nach key. Die Datei enthält zwei .npy Arrays hintereinander: die
+# Schlüssel als zusammenhängendes uint64 Array für searchsorted und die vollständigen Zeilen. Beide
+# werden nur eingeblendet: alle Worker teilen sich die Seiten im Page Cache, nichts wird deserialisiert.
+SNAPSHOT_DTYPE = np.dtype(
+    [
+        ("key", "<u8"),
+        ("id", "<i8"),
+        ("lat", "<f8"),
+        ("lon", "<f8"),
+        ("range", "<f4"),
+        ("bsic", "<i2"),
+        ("bts_id", "<i8"),
+    ]
+)
+NONE = -1
+
+# Bits je Schlüsselteil: mcc < 1024, mnc < 1024, lac/tac < 2^16, cid < 2^28 (UMTS/LTE)
+_MCC_SHIFT = 54
+_MNC_SHIFT = 44
+_LAC_SHIFT = 28
+_CID_BITS = 28
+_LIMITS = (
+    1 << (64 - _MCC_SHIFT),
+    1 << (_MCC_SHIFT - _MNC_SHIFT),
+    1 << (_MNC_SHIFT - _LAC_SHIFT),
+    1 << _CID_BITS,
+)
+
+
+def key_in_range(mcc, mnc, lac, cid) -> np.ndarray:
+    """Maske der Schlüssel, die pack_key ohne Überschneidung packen kann."""
+    mask = np.ones(len(mcc), dtype=bool)
+    for values, limit in zip((mcc, mnc, lac, cid), _LIMITS):
+        values = np.asarray(values, dtype=np.int64)
+        mask &= (values >= 0) & (values < limit)
+    return mask
+
+
+def pack_key(mcc, mnc, lac, cid):
+    """(mcc, mnc, lac, cid) als ein uint64, funktioniert für Zahlen und NumPy Arrays.
+
+    Nur für Schlüssel, für die key_in_range gilt, sonst überschneiden sich die Teile.
+    """
+    if isinstance(mcc, np.ndarray):
+        mcc, mnc, lac, cid = (
+            np.asarray(v, dtype=np.uint64) for v in (mcc, mnc, lac, cid)
+        )
+        return (
+            (mcc << np.uint64(_MCC_SHIFT))
+            | (mnc << np.uint64(_MNC_SHIFT))
+            | (lac << np.uint64(_LAC_SHIFT))
+            | (cid & np.uint64((1 << _CID_BITS) - 1))
+        )
+    return (
+        (mcc << _MCC_SHIFT)
+        | (mnc << _MNC_SHIFT)
+        | (lac << _LAC_SHIFT)
+        | (cid & ((1 << _CID_BITS) - 1))
+    )
+
+
+def export_snapshot(
+    path: str, queryset=None, chunk_size: int = 100_000
+) -> Tuple[int, int]:
+    """Schreibt die Funkmasten sortiert nach key nach ``path`` und ersetzt die Datei atomar.
+
+    Funkmasten, deren Schlüssel nicht in 64 Bit passt, fehlen im Snapshot und werden weiter aus der Datenbank
+    gelesen. Liefert (exportiert, übersprungen).
+    """
+    from .models import Celltower
+
+    queryset = queryset if queryset is not None else Celltower.objects.all()
+    parts = []
+    rows = []
+    skipped = 0
+    fields = ("mcc", "mnc", "lac", "cid", "id", "lat", "lon", "range", "bsic", "bts_id")
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            array, count = _to_array(rows)
+            parts.append(array)
+            skipped += count
+            rows = []
+    array, count = _to_array(rows)
+    parts.append(array)
+    skipped += count
+    snapshot = np.concatenate(parts)
+    snapshot = snapshot[np.argsort(snapshot["key"], kind="stable")]
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as file:
+        np.save(file, np.ascontiguousarray(snapshot["key"]), allow_pickle=False)
+        np.save(file, snapshot, allow_pickle=False)
+    # Laufende Worker behalten ihre Einblendung der alten Datei, bis sie neu laden
+    os.replace(tmp, path)
+    return len(snapshot), skipped
+
+
+def _to_array(rows) -> Tuple[np.ndarray, int]:
+    if rows:
+        in_range = key_in_range(*(np.array(values) for values in list(zip(*rows))[:4]))
+        rows = [row for row, keep in zip(rows, in_range) if keep]
+        skipped = len(in_range) - len(rows)
+    else:
+        skipped = 0
+    array = np.empty(len(rows), dtype=SNAPSHOT_DTYPE)
+    if not rows:
+        return array, skipped
+    mcc, mnc, lac, cid, ids, lat, lon, range_, bsic, bts_id = zip(*rows)
+    array["key"] = pack_key(np.array(mcc), np.array(mnc), np.array(lac), np.array(cid))
+    array["id"] = ids
+    array["lat"] = np.array(lat, dtype=float)
+    array["lon"] = np.array(lon, dtype=float)
+    array["range"] = range_
+    array["bsic"] = [NONE if b is None else b for b in bsic]
+    array["bts_id"] = [NONE if b is None else b for b in bts_id]
+    return array, skipped
+
+
+def _map_next_array(path: str, file) -> np.ndarray:
+    # Wie np.load(mmap_mode="r"), aber für das Array ab der aktuellen Position in der Datei
+    version = np.lib.format.read_magic(file)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+    offset = file.tell()
+    size = int(np.prod(shape)) * dtype.itemsize
+    file.seek(offset + size)
+    if not size:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+class CelltowerSnapshot:
+    """Nur lesender Zugriff auf eine mit export_snapshot geschriebene Datei per Binärsuche."""
+
+    def __init__(self, path: str, check_interval: float = 60):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        self._mtime = os.stat(self.path).st_mtime
+        self._checked = time.monotonic()
+        with open(self.path, "rb") as file:
+            self.keys = _map_next_array(self.path, file)
+            self.data = _map_next_array(self.path, file)
+
+    def refresh(self):
+        """Blendet die Datei neu ein, wenn sie seit dem Laden ersetzt wurde."""
+        if time.monotonic() - self._checked < self.check_interval:
+            return
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self._load()
+            except OSError:
+                logger.warning(
+                    "Snapshot %s nicht lesbar, der bisherige bleibt eingeblendet",
+                    self.path,
+                    exc_info=True,
+                )
+
+    @property
+    def mtime(self) -> float:
+        return self._mtime
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """Zeilenindex je gepacktem Schlüssel, -1 wenn nicht enthalten."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        if not len(self.keys):
+            return np.full(len(keys), -1)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, positions, -1)
+
+    def get_many(self, keys: Iterable[CelltowerKey]) -> Dict[CelltowerKey, TowerInfo]:
+        self.refresh()
+        keys = list(keys)
+        if not keys:
+            return {}
+        mcc, mnc, lac, cid = (np.array(v) for v in zip(*keys))
+        # Nicht packbare Schlüssel stehen nicht im Snapshot und dürfen keinen anderen Funkmast treffen
+        rows = np.where(
+            key_in_range(mcc, mnc, lac, cid),
+            self.find(pack_key(mcc, mnc, lac, cid)),
+            -1,
+        )
+        result = {}
+        for key, row in zip(keys, rows):
+            if row >= 0:
+                result[key] = self._info(key, self.data[row])
+        return result
+
+    def get(self, key: CelltowerKey) -> Optional[TowerInfo]:
+        return self.get_many([key]).get(key)
+
+    @staticmethod
+    def _info(key: Tuple[int, int, int, int], row) -> TowerInfo:
+        from geopy import Point
+
+        lat = None if np.isnan(row["lat"]) else float(row["lat"])
+        lon = None if np.isnan(row["lon"]) else float(row["lon"])
+        return TowerInfo(
+            id=int(row["id"]),
+            mcc=key[0],
+            mnc=key[1],
+            lac=key[2],
+            cid=key[3],
+            lat=lat,
+            lon=lon,
+            bsic=None if row["bsic"] == NONE else int(row["bsic"]),
+            bts_id=None if row["bts_id"] == NONE else int(row["bts_id"]),
+            point=Point(lat, lon) if lat is not None else None,
+            range=float(row["range"]),
+        )
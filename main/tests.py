@@ -1,3 +1,1478 @@
-from django.test import TestCase
+import re
+import struct
+from dataclasses import astuple
+from datetime import timedelta
+from django.db import connection
+from django.test import TestCase as DjangoTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
 
-# Create your tests here.
+from . import metrics
+from . import models
+from .api import VERSION_OFFSET
+from .api import BatchHeader
+from .api import Cell
+from .api import CellV2
+from .api import CengResult
+from .api import Extras
+from .api import ExtrasFlags
+from .api import ReportHeader
+from .api import TrackerUpdate
+from .api import UpdateHeader
+from .api import _decoders
+from .api import _encode_v4
+from .api import decode_update
+from .api import store_reports
+from .api import store_update
+from .cache import LRUCache
+from .cache import TowerIndex
+from .cache import _configure_tower_index
+from .cache import lateration_cache
+from .cache import tower_index
+from .jobs import MAX_POSITION_ATTEMPTS
+from .jobs import get_position_queue
+from .jobs import run_worker
+from .replay import ARFCN_UNKNOWN
+from .replay import cell_block
+from .replay import decode_cell_columns
+from .replay import decode_status_cells
+from .replay import payload_bytes
+from .simulation import Fleet
+from .simulation import sample_payload
+from .utils import ErrorFunction
+from .utils import LaterationResult
+from .utils import Measurement
+from .utils import OptimizationAlgorithm
+from .utils import batch_lateration
+from .utils import cached_lateration
+from .utils import lateration_new
+from .utils import linear_lateration
+from .utils import pad_measurements
+from .utils import solve_lateration
+from .utils import vectorized_error_function
+
+IMEI = 867530900000001
+
+
+class TestCase(DjangoTestCase):
+    # Die Datenbank wird nach jedem Test zurückgerollt, der prozesslokale Index nicht
+    @classmethod
+    def setUpClass(cls):
+        tower_index.clear()
+        lateration_cache.clear()
+        super().setUpClass()
+
+    def setUp(self):
+        tower_index.clear()
+        lateration_cache.clear()
+
+
+def v4_payload(
+    cells,
+    flags=ExtrasFlags.VOLTAGE | ExtrasFlags.VOLTAGE_RAW | ExtrasFlags.TEMPERATURE,
+    errors=(),
+    keep=None,
+    voltage=(1024, 700),
+):
+    if errors:
+        flags |= ExtrasFlags.ERROR_CODE
+    if keep is not None:
+        flags |= ExtrasFlags.CELL_DELTA
+    body = struct.pack(
+        UpdateHeader.get_struct_format_string(True),
+        IMEI,
+        *voltage,
+        1,
+        1,
+        4,
+        len(cells),
+        flags,
+    )
+    if keep is not None:
+        body += struct.pack("< H", keep)
+    for cell in cells:
+        body += struct.pack(CellV2.get_struct_format_string(), *cell)
+    body += struct.pack("< h", 80)
+    if errors:
+        body += struct.pack(f"< B {len(errors)}H", len(errors), *errors)
+    return body
+
+
+def v3_payload(cells, imei=(8675309, 1)):
+    body = struct.pack(TrackerUpdate.get_struct_format_string(), *imei, 3.9, 1, 1)
+    body += struct.pack(CengResult.get_struct_format_string(), 3, len(cells))
+    for cell in cells:
+        body += struct.pack(Cell.get_struct_format_string(), *cell)
+    return body + struct.pack("< h", 80)
+
+
+class StoreUpdateTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(7):
+            models.Celltower.objects.create(
+                mcc=262,
+                mnc=1,
+                lac=0x1234,
+                cid=0x100 + i,
+                bsic=20 + i,
+                lat=52.5 + 0.01 * i,
+                lon=13.4,
+            )
+        device = models.Device.objects.create(sn=IMEI)
+        store_update(
+            device,
+            decode_update(v4_payload([(262, 1, 0x1234, 0x100, 20, 30, 10)])),
+            b"",
+        )
+
+    def store(self, cells, queries=None, **kwargs):
+        body = v4_payload(cells, **kwargs)
+        device = models.Device.objects.get(sn=IMEI)
+        if queries is None:
+            return store_update(device, decode_update(body), body)
+        with self.assertNumQueries(queries):
+            return store_update(device, decode_update(body), body)
+
+    def test_query_count_is_independent_of_cell_count(self):
+        for length in (1, 4, 7):
+            tower_index.clear()
+            cells = [
+                (262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i, 10 * i)
+                for i in range(length)
+            ]
+            # Savepoint, Celltower SELECT, Status INSERT, letzte Position, Device UPDATE, Übersicht UPDATE,
+            # Measurement INSERT, Release
+            status = self.store(cells, queries=8)
+            self.assertEqual(status.measurements.count(), length)
+            # Bekannte Funkmasten kommen aus dem Index
+            self.store(cells, queries=7)
+
+        status = self.store(cells, queries=8, errors=((1 << 13) | 5, (1 << 12) | 17))
+        self.assertEqual(status.errors.count(), 2)
+
+    def test_raw_data_is_stored_binary(self):
+        from base64 import b64encode
+
+        body = v4_payload(
+            [(262, 1, 0x1234, 0x100, 20, 30, 10)], errors=((1 << 13) | 5,)
+        )
+        status = self.store(
+            [(262, 1, 0x1234, 0x100, 20, 30, 10)], errors=((1 << 13) | 5,)
+        )
+        status.refresh_from_db()
+        self.assertEqual(bytes(status.raw_data), body)
+        self.assertEqual(status.parsed_data["cells"][0]["cellid"], 0x100)
+        self.assertEqual(status.parsed_data["errors"], [(8, 5)])
+        # Vor der Umstellung als Text abgelegt
+        self.assertEqual(payload_bytes(str(b64encode(body))), body)
+        self.assertEqual(payload_bytes(str(b64encode(body)).encode()), body)
+
+    def test_unknown_celltowers_are_skipped(self):
+        status = self.store(
+            [(262, 1, 0x1234, 0x100, 20, 30, 10), (262, 2, 0x1, 0x1, 1, 30, 10)]
+        )
+        self.assertEqual(
+            list(status.measurements.values_list("celltower__cid", flat=True)), [0x100]
+        )
+
+        # Unbekannte Schlüssel werden gemerkt, bis der Funkmast angelegt wird
+        self.store([(262, 2, 0x1, 0x1, 1, 30, 10)], queries=6)
+        models.Celltower.objects.create(
+            mcc=262, mnc=2, lac=0x1, cid=0x1, bsic=1, lat=52.5, lon=13.4
+        )
+        status = self.store([(262, 2, 0x1, 0x1, 1, 30, 10)], queries=8)
+        self.assertEqual(status.measurements.count(), 1)
+
+    def test_tower_index_is_invalidated_on_save(self):
+        status = self.store(
+            [(262, 1, 0x1234, 0x100 + i, 20 + i, 30, 10) for i in range(3)]
+        )
+        celltower = models.Celltower.objects.get(cid=0x101)
+        celltower.lat = 53.0
+        celltower.save()
+        # Die beim Speichern gemerkten Messungen gehören zur Instanz aus store_update
+        status = models.Status.objects.get(id=status.id)
+        self.assertEqual(status.celltower_count, 3)
+        with self.assertNumQueries(2):
+            measurements = status.cleaned_measurements
+        self.assertEqual({m.tower.lat for m in measurements}, {52.5, 53.0, 52.52})
+        with self.assertNumQueries(0):
+            self.assertIs(status.cleaned_measurements, measurements)
+        with self.assertNumQueries(1):
+            models.Status(id=status.id).cleaned_measurements
+
+    def test_celltower_count_follows_measurements(self):
+        from django.core.management import call_command
+
+        # Zwei Zellen desselben Funkmasts zählen einmal
+        status = self.store(
+            [(262, 1, 0x1234, 0x100 + i, 20 + i, 30 + i, 10) for i in (0, 1, 1)]
+        )
+        self.assertEqual((status.celltower_count, len(status.celltower_ids)), (2, 2))
+        status.refresh_from_db()
+        self.assertEqual(
+            status.celltower_ids, [m.celltower_id for m in status.cleaned_measurements]
+        )
+
+        celltower = models.Celltower.objects.get(cid=0x102)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            models.Measurement.objects.create(
+                status=status, celltower=celltower, rxl=50
+            )
+            measurement = models.Measurement.objects.get(
+                status=status, celltower=celltower
+            )
+            measurement.rxl = 55
+            measurement.save()
+        # Eine Neuberechnung für beide Änderungen
+        self.assertEqual(len(callbacks), 1)
+        status.refresh_from_db()
+        self.assertEqual(
+            (status.celltower_count, status.celltower_ids[0]), (3, celltower.id)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            status.measurements.get(celltower=celltower).delete()
+        status.refresh_from_db()
+        self.assertEqual(status.celltower_count, 2)
+
+        models.Status.objects.update(celltower_count=0, celltower_ids=[])
+        call_command(
+            "update_celltower_counts", "--batch-size", "1", stdout=mock.MagicMock()
+        )
+        status.refresh_from_db()
+        self.assertEqual(status.celltower_count, 2)
+        self.assertFalse(models.Status.objects.filter(celltower_count=0).exists())
+
+    def test_cleaned_measurements_match_pairwise(self):
+        import random
+
+        from geopy import Point
+        from geopy import distance
+
+        from .cache import TowerInfo
+
+        def pairwise(measurements):
+            # Bisherige Implementierung mit geodätischem Vergleich aller Paare
+            result = []
+            for m in measurements:
+                found = False
+                for i in range(len(result)):
+                    if (
+                        distance.distance(m.tower.point, result[i].tower.point).meters
+                        < 1
+                    ):
+                        found = True
+                        if m.rxl > result[i].rxl:
+                            result[i] = m
+                if not found:
+                    result.append(m)
+            return sorted(result, key=lambda obj: obj.rxl, reverse=True)
+
+        rng = random.Random(0)
+        for lat in (0.0, 52.52, 78.2, -45.0):
+            sites = [
+                (lat + rng.uniform(-0.01, 0.01), 13.4 + rng.uniform(-0.01, 0.01))
+                for _ in range(5)
+            ]
+            # Sektoren derselben Station, knapp innerhalb und knapp außerhalb eines Meters
+            sites += [
+                (sites[0][0], sites[0][1]),
+                (sites[1][0] + 0.5 / 111_000, sites[1][1]),
+            ]
+            sites += [(sites[2][0] + 2 / 111_000, sites[2][1])]
+            measurements = []
+            for i, (tower_lat, tower_lon) in enumerate(sites * 2):
+                m = models.Measurement(celltower_id=i, rxl=rng.randrange(64))
+                m.tower = TowerInfo(
+                    i,
+                    262,
+                    1,
+                    1,
+                    i,
+                    tower_lat,
+                    tower_lon,
+                    None,
+                    None,
+                    Point(tower_lat, tower_lon),
+                )
+                measurements.append(m)
+            rng.shuffle(measurements)
+            cleaned = models.deduplicate_measurements(measurements)
+            self.assertEqual(
+                [m.celltower_id for m in cleaned],
+                [m.celltower_id for m in pairwise(measurements)],
+            )
+            self.assertEqual(len(cleaned), 6)
+
+    def test_lru_cache(self):
+        lru = LRUCache(maxsize=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+        self.assertIn("a", lru)
+        lru = LRUCache(maxsize=2, ttl=-1)
+        lru.set("a", 1)
+        self.assertIsNone(lru.get("a"))
+
+    def test_bsic_change_is_batched_and_assigns_bts(self):
+        for i in range(5):
+            models.Celltower.objects.create(
+                mcc=262, mnc=1, lac=0x1234, cid=0x200 + i, lat=52.5, lon=13.4 + 0.01 * i
+            )
+        # Zusätzlich zum normalen Upload: BTS SELECT, BTS INSERT, BTS SELECT, Celltower UPDATE,
+        # BTS Position SELECT, BTS UPDATE - unabhängig von der Zahl geänderter Zellen
+        for cids in ((0,), (1, 2, 3, 4)):
+            tower_index.clear()
+            # Die Marken für andere Prozesse erst nach dem Commit und gesammelt in einem Cache Aufruf
+            with mock.patch("main.cache.cache.set_many") as set_many:
+                with self.captureOnCommitCallbacks() as callbacks:
+                    status = self.store(
+                        [(262, 1, 0x1234, 0x200 + i, 40 + i, 30, 10) for i in cids],
+                        queries=14,
+                    )
+                set_many.assert_not_called()
+                for callback in callbacks:
+                    callback()
+            self.assertEqual(set_many.call_count, 1)
+            self.assertEqual(len(set_many.call_args[0][0]), len(cids))
+            self.assertEqual(status.measurements.count(), len(cids))
+        for i in range(5):
+            celltower = models.Celltower.objects.get(cid=0x200 + i)
+            self.assertEqual(celltower.bsic, 40 + i)
+            self.assertEqual(celltower.bts.bsic, 40 + i)
+            self.assertEqual(celltower.bts.latitude, celltower.lat)
+
+
+class BatchUploadTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            models.Celltower.objects.create(
+                mcc=262,
+                mnc=1,
+                lac=0x1234,
+                cid=0x100 + i,
+                bsic=20 + i,
+                lat=52.5,
+                lon=13.4,
+            )
+        models.Device.objects.create(sn=IMEI)
+
+    def test_reports_are_stored_with_fixed_query_count(self):
+        body = sample_payload(5, 3, imei=IMEI, reports=4)
+        decoded = decode_update(body)
+        self.assertEqual(
+            [report.age for report in decoded.reports], [2700, 1800, 900, 0]
+        )
+        device = models.Device.objects.get(sn=IMEI)
+        # Savepoint, Celltower SELECT, Status INSERT, Device UPDATE, Error INSERT, Übersicht UPDATE, Measurement INSERT,
+        # Release
+        with self.assertNumQueries(8):
+            statuses = store_reports(device, decoded.reports, body)
+
+        self.assertEqual(models.Status.objects.count(), 4)
+        self.assertEqual(models.Measurement.objects.count(), 12)
+        self.assertEqual(statuses[0].errors.count(), 1)
+        self.assertEqual(
+            statuses[2].timestamp - statuses[0].timestamp, timedelta(minutes=30)
+        )
+        device.refresh_from_db()
+        self.assertEqual(device.last_position_id, statuses[-1].id)
+
+    def test_report_raw_data_is_a_standalone_payload(self):
+        decoded = decode_update(sample_payload(5, 3, imei=IMEI, reports=2))
+        for report in decoded.reports:
+            (single,) = decode_update(report.raw).reports
+            self.assertEqual(single.cells, report.cells)
+            self.assertEqual(single.age, report.age)
+            self.assertEqual(len(cell_block(report.raw)), 3)
+
+
+class DecodeTest(TestCase):
+    def test_struct_layouts(self):
+        for cls in (
+            TrackerUpdate,
+            UpdateHeader,
+            BatchHeader,
+            ReportHeader,
+            CengResult,
+            Extras,
+            Cell,
+            CellV2,
+        ):
+            self.assertEqual(cls._struct.format, cls.struct_format)
+            self.assertEqual(cls.struct_size(), struct.calcsize(cls.struct_format))
+        self.assertEqual(sorted(_decoders), [3, 4, 5])
+        # Die Version steht bei allen Headern an derselben Stelle
+        self.assertEqual(VERSION_OFFSET, 20)
+        self.assertEqual(sample_payload(3, 1)[VERSION_OFFSET], 3)
+        self.assertEqual(UpdateHeader.from_struct(sample_payload(4, 1)).version, 4)
+        self.assertEqual(BatchHeader.from_struct(sample_payload(5, 1)).version, 5)
+
+    def test_round_trip_v3(self):
+        body = sample_payload(3, 4)
+        decoded = decode_update(body)
+        self.assertEqual(
+            (decoded.version, decoded.imei, len(decoded.cells)), (3, 8675309, 4)
+        )
+        encoded = TrackerUpdate._struct.pack(*astuple(decoded.header))
+        encoded += CengResult._struct.pack(3, len(decoded.cells))
+        encoded += b"".join(Cell._struct.pack(*astuple(cell)) for cell in decoded.cells)
+        encoded += Extras._struct.pack(round(decoded.temp * 4))
+        self.assertEqual(encoded, body)
+
+    def test_round_trip_v4(self):
+        body = sample_payload(4, 3)
+        decoded = decode_update(body)
+        self.assertEqual(
+            (decoded.version, decoded.imei, len(decoded.cells)), (4, IMEI, 3)
+        )
+        self.assertEqual(
+            (decoded.voltage_ref, decoded.voltage_raw, decoded.temp), (1024, 700, 20.0)
+        )
+        self.assertEqual(decoded.errors.length, 2)
+        self.assertEqual(_encode_v4(decoded), body)
+
+    def test_round_trip_v5(self):
+        body = sample_payload(5, 3, imei=IMEI, reports=3)
+        batch = decode_update(body)
+        self.assertEqual((batch.version, batch.imei, len(batch.reports)), (5, IMEI, 3))
+        encoded = BatchHeader._struct.pack(*astuple(batch.header))
+        encoded += b"".join(
+            report.raw[BatchHeader.struct_size() :] for report in batch.reports
+        )
+        self.assertEqual(encoded, body)
+
+    def test_unknown_version_is_rejected(self):
+        for version in (0, 2, 6, 255):
+            body = bytearray(sample_payload(4, 2))
+            body[VERSION_OFFSET] = version
+            with self.assertRaisesMessage(
+                ValueError, f"Unknown payload version {version}"
+            ):
+                decode_update(bytes(body))
+            self.assertIsNone(cell_block(bytes(body)))
+
+
+class ReplayTest(TestCase):
+    def test_columns_match_decode_update(self):
+        # Leere Zellen (mcc/mnc 0) verwerfen beide Wege, doppelte Zellen behalten den stärksten Pegel
+        payloads = [
+            v3_payload(
+                [(262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i) for i in range(3)]
+                + [(0, 0, 0, 0, 0, 0), (262, 1, 0x1234, 0x100, 20, 45)]
+            ),
+            v4_payload(
+                [(262, 2, 0x4321, 0x200 + i, 30 + i, 20 + i, 5 * i) for i in range(4)]
+                + [(0, 0, 0, 0, 0, 0, 0), (262, 2, 0x4321, 0x201, 31, 10, 99)]
+            ),
+        ]
+        device = models.Device.objects.create(sn=IMEI)
+        statuses = [
+            store_update(device, decode_update(payload), payload)
+            for payload in payloads
+        ]
+        for columns, owners in (
+            (decode_cell_columns(payloads), range(len(payloads))),
+            (
+                decode_status_cells(models.Status.objects.all(), chunk_size=1),
+                [status.id for status in statuses],
+            ),
+        ):
+            self.assertEqual(len(columns), 7)
+            for owner, payload in zip(owners, payloads):
+                rows = columns.status == owner
+                decoded = decode_update(payload)
+                self.assertEqual(
+                    list(
+                        zip(
+                            *(
+                                getattr(columns, name)[rows].tolist()
+                                for name in ("mcc", "mnc", "lac", "cid", "rxl")
+                            )
+                        )
+                    ),
+                    [
+                        (cell.mcc, cell.mnc, cell.lac, cell.cellid, cell.rxl)
+                        for cell in decoded.cells
+                    ],
+                )
+                arfcn = [
+                    getattr(cell, "arfcn", ARFCN_UNKNOWN) for cell in decoded.cells
+                ]
+                self.assertEqual(columns.arfcn[rows].tolist(), arfcn)
+
+
+@override_settings(
+    POSITION_QUEUE={"BACKEND": "main.jobs.LocalJobQueue"},
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class PositionQueueTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            models.Celltower.objects.create(
+                mcc=262, mnc=1, lac=0x1234, cid=0x100 + i, lat=52.5 + 0.01 * i, lon=13.4
+            )
+
+    def setUp(self):
+        super().setUp()
+        # Die Warteschlange ist prozessweit, Jobs vorheriger Tests verweisen auf zurückgerollte Status
+        run_worker(burst=True)
+
+    @mock.patch("main.models.Nominatim")
+    def test_update_defers_position_to_worker(self, nominatim):
+        nominatim.return_value.reverse.return_value.raw = {
+            "address": {"country": "Deutschland", "city": "Berlin"}
+        }
+        body = v4_payload(
+            [(262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i, 10 * i) for i in range(3)]
+        )
+
+        response = self.client.post(
+            "/update", body, content_type="application/octet-stream"
+        )
+        self.assertEqual(len(response.content), 12)
+        status = models.Status.objects.get()
+        self.assertTrue(status.position_pending)
+        self.assertEqual((status.lat, status.lon), (0.0, 0.0))
+        self.assertEqual(get_position_queue().depth(), 1)
+
+        self.assertEqual(run_worker(burst=True), 1)
+        status.refresh_from_db()
+        self.assertFalse(status.position_pending)
+        self.assertAlmostEqual(status.lat, 52.51, delta=0.02)
+        self.assertEqual(status.city.name, "Berlin")
+        self.assertEqual(get_position_queue().depth(), 0)
+
+    @mock.patch("main.models.Nominatim")
+    def test_failed_solve_stays_pending(self, nominatim):
+        from django.core.management import call_command
+
+        nominatim.return_value.reverse.return_value.raw = {
+            "address": {"country": "Deutschland", "city": "Berlin"}
+        }
+        body = v4_payload(
+            [(262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i, 10 * i) for i in range(3)]
+        )
+        self.client.post("/update", body, content_type="application/octet-stream")
+        metrics.reset()
+        with override_settings(METRICS={"ENABLED": True, "REDIS": False}):
+            with mock.patch.object(
+                models.Status, "new_calc_location", side_effect=ValueError("solver")
+            ):
+                # Begrenzt wiederholt, danach als verloren gezählt
+                self.assertEqual(run_worker(burst=True), MAX_POSITION_ATTEMPTS)
+        self.assertEqual(metrics.events.values[(("event", "position_dead_letter"),)], 1)
+        self.assertEqual(get_position_queue().depth(), 0)
+        status = models.Status.objects.get()
+        self.assertTrue(status.position_pending)
+        self.assertIsNone(status.city)
+        nominatim.return_value.reverse.assert_not_called()
+
+        call_command("position_queue", "--requeue", stdout=mock.MagicMock())
+        self.assertEqual(run_worker(burst=True), 1)
+        status.refresh_from_db()
+        self.assertFalse(status.position_pending)
+        self.assertEqual(status.city.name, "Berlin")
+
+    async def test_async_update_endpoint(self):
+        from channels.testing import HttpCommunicator
+
+        from Server.routing import application
+
+        body = v4_payload(
+            [(262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i, 10 * i) for i in range(3)]
+        )
+        response = await HttpCommunicator(
+            application, "POST", "/update", body=body
+        ).get_response()
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(len(response["body"]), 12)
+        status = await models.Status.objects.select_related("device").aget()
+        self.assertEqual(status.device.sn, str(IMEI))
+        self.assertTrue(status.position_pending)
+        self.assertEqual(await status.measurements.acount(), 3)
+        self.assertEqual(get_position_queue().depth(), 1)
+
+        response = await HttpCommunicator(application, "GET", "/update").get_response()
+        self.assertEqual(response["status"], 405)
+
+    @mock.patch("main.models.Nominatim")
+    def test_delta_cells_reuse_previous_position(self, nominatim):
+        nominatim.return_value.reverse.return_value.raw = {
+            "address": {"country": "Deutschland", "city": "Berlin"}
+        }
+        cells = [(262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i, 10 * i) for i in range(3)]
+        ack = ExtrasFlags.VOLTAGE | ExtrasFlags.TEMPERATURE | ExtrasFlags.CELL_ACK
+        unknown = (262, 2, 0x1, 0x1, 1, 30, 10)
+
+        response = self.client.post(
+            "/update", v4_payload(cells + [unknown], flags=ack), content_type=""
+        )
+        self.assertEqual(struct.unpack_from("< H", response.content, 12), (0b0111,))
+        run_worker(burst=True)
+        first = models.Status.objects.latest("id")
+
+        # Keine Änderung: Zellen werden aus dem letzten Status übernommen, die Position ebenfalls
+        response = self.client.post(
+            "/update", v4_payload([], flags=ack, keep=0b111), content_type=""
+        )
+        self.assertEqual(struct.unpack_from("< H", response.content, 12), (0b111,))
+        status = models.Status.objects.latest("id")
+        self.assertFalse(status.position_pending)
+        self.assertEqual(
+            (status.lat, status.lon, status.city_id),
+            (first.lat, first.lon, first.city_id),
+        )
+        self.assertEqual(status.measurements.count(), 3)
+        self.assertEqual(len(decode_update(status.payload).cells), 3)
+
+        # Eine Zelle entfällt, eine neue kommt hinzu
+        response = self.client.post(
+            "/update",
+            v4_payload([cells[0][:5] + (45, 0)], flags=ack, keep=0b110),
+            content_type="",
+        )
+        status = models.Status.objects.latest("id")
+        self.assertTrue(status.position_pending)
+        self.assertEqual(
+            list(
+                status.measurements.order_by("id").values_list("celltower__cid", "rxl")
+            ),
+            [(0x101, 39), (0x102, 38), (0x100, 45)],
+        )
+        self.assertEqual(run_worker(burst=True), 2)
+
+    def test_delta_keep_refers_to_acknowledged_list(self):
+        cells = [(262, 1, 0x1234, 0x100 + i, 20 + i, 40 - i, 10 * i) for i in range(3)]
+        ack = ExtrasFlags.VOLTAGE | ExtrasFlags.TEMPERATURE | ExtrasFlags.CELL_ACK
+        unknown = (262, 2, 0x1, 0x1, 1, 30, 10)
+
+        # Unbekannter Funkmast zuerst bzw. in der Mitte, die Bits zählen in der gesendeten Reihenfolge
+        for sent, acked in (
+            ([unknown] + cells, 0b1110),
+            (cells[:1] + [unknown] + cells[1:], 0b1101),
+        ):
+            response = self.client.post(
+                "/update", v4_payload(sent, flags=ack), content_type=""
+            )
+            self.assertEqual(struct.unpack_from("< H", response.content, 12), (acked,))
+            response = self.client.post(
+                "/update", v4_payload([], flags=ack, keep=acked), content_type=""
+            )
+            self.assertEqual(struct.unpack_from("< H", response.content, 12), (0b111,))
+            status = models.Status.objects.latest("id")
+            self.assertEqual(
+                list(
+                    status.measurements.order_by("id").values_list(
+                        "celltower__cid", flat=True
+                    )
+                ),
+                [0x100, 0x101, 0x102],
+            )
+            # Die Quittung bleibt stabil
+            response = self.client.post(
+                "/update", v4_payload([], flags=ack, keep=0b111), content_type=""
+            )
+            self.assertEqual(struct.unpack_from("< H", response.content, 12), (0b111,))
+            self.assertEqual(models.Status.objects.latest("id").measurements.count(), 3)
+
+    @mock.patch("main.models.Nominatim")
+    def test_stationary_device_reuses_position(self, nominatim):
+        nominatim.return_value.reverse.return_value.raw = {
+            "address": {"country": "Deutschland", "city": "Berlin"}
+        }
+        cells = [
+            (262, 1, 0x1234, 0x100 + i, 20 + i, 40 - 5 * i, 10 * i) for i in range(3)
+        ]
+        sources = []
+        for rxl_change in (0, 2, 4, 5, 10):
+            body = v4_payload(
+                [cell[:5] + (cell[5] + rxl_change, cell[6]) for cell in cells]
+            )
+            self.client.post("/update", body, content_type="")
+            with mock.patch(
+                "main.utils.solve_lateration", wraps=solve_lateration
+            ) as solve:
+                run_worker(burst=True)
+            status = models.Status.objects.latest("id")
+            sources.append((status.position_source, solve.call_count, status.lat))
+        P = models.Status.PositionSource
+        # Verglichen wird mit der zuletzt berechneten Position, nicht mit der übernommenen davor
+        self.assertEqual(
+            [s[:2] for s in sources],
+            [(P.solved, 1), (P.reused, 0), (P.solved, 1), (P.reused, 0), (P.solved, 1)],
+        )
+        self.assertEqual(sources[1][2], sources[0][2])
+        self.assertEqual(sources[3][2], sources[2][2])
+
+        # scipy Verfahren starten bei der vorherigen Position
+        status = models.Status.objects.latest("id")
+        status.new_calc_location(method=OptimizationAlgorithm.NELDER_MEAD)
+        status.refresh_from_db()
+        self.assertEqual(status.position_source, P.warm)
+        self.assertGreater(status.solver_nfev, status.solver_nit)
+
+
+class SnapshotTest(TestCase):
+    def test_export_and_lookup(self):
+        import os
+        import tempfile
+
+        import numpy as np
+
+        from .snapshot import CelltowerSnapshot
+        from .snapshot import export_snapshot
+        from .snapshot import pack_key
+
+        fleet = Fleet(devices=1, towers=200, seed=2)
+        fleet.seed_celltowers()
+        models.Celltower.objects.create(
+            mcc=262, mnc=1, lac=0xFFFF, cid=(1 << 28) - 1, lat=None, lon=None
+        )
+        # Beide würden gepackt mit (262, 7, 0x4242, 0x4242) zusammenfallen
+        wide = [
+            models.Celltower.objects.create(
+                mcc=262, mnc=7, lac=0x4242, cid=(1 << 28) + 0x4242, lat=1, lon=1
+            ),
+            models.Celltower.objects.create(
+                mcc=262, mnc=7, lac=0x14242, cid=0x4242, lat=1, lon=1
+            ),
+        ]
+        models.Celltower.objects.create(
+            mcc=262, mnc=7, lac=0x4242, cid=0x4242, lat=2, lon=2
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "celltowers.npy")
+            self.assertEqual(export_snapshot(path, chunk_size=64), (202, 2))
+            snapshot = CelltowerSnapshot(path)
+            self.assertTrue(np.all(np.diff(snapshot.keys.astype(np.int64)) > 0))
+
+            expected = {
+                c.key: c
+                for c in models.Celltower.objects.exclude(id__in=[c.id for c in wide])
+            }
+            found = snapshot.get_many(
+                list(expected) + [(262, 9, 1, 1)] + [c.key for c in wide]
+            )
+            self.assertEqual(set(found), set(expected))
+            for key, info in found.items():
+                self.assertEqual(
+                    (info.id, info.lat, info.bsic),
+                    (expected[key].id, expected[key].lat, expected[key].bsic),
+                )
+            self.assertEqual(
+                pack_key(262, 1, 0x1000, 0x100),
+                int(pack_key(*(np.array([v]) for v in (262, 1, 0x1000, 0x100)))[0]),
+            )
+
+            # Der Index fragt den Snapshot vor der Datenbank, geänderte Funkmasten wieder die Datenbank
+            tower_index.configure(100, 600, snapshot)
+            # Index eines anderen Prozesses, gemeinsam ist nur der Django Cache
+            other = TowerIndex()
+            other.configure(100, 600, snapshot, recheck=0)
+            try:
+                keys = [(t.mcc, t.mnc, t.lac, t.cid) for t in fleet.towers[:7]]
+                with self.assertNumQueries(0):
+                    self.assertEqual(len(tower_index.get_many(keys)), 7)
+                    self.assertEqual(len(other.get_many(keys)), 7)
+                celltower = models.Celltower.objects.get(
+                    cid=fleet.towers[0].cid, mnc=fleet.towers[0].mnc
+                )
+                with self.captureOnCommitCallbacks(execute=True):
+                    celltower.bsic = 63
+                    celltower.save()
+                self.assertEqual(tower_index.get_many(keys[:1])[keys[0]].bsic, 63)
+                # Nur der geänderte Funkmast wird neu gelesen, der Rest des Index bleibt erhalten
+                with self.assertNumQueries(1):
+                    self.assertEqual(other.get_many(keys)[keys[0]].bsic, 63)
+                self.assertEqual(len(other), 7)
+                with self.assertNumQueries(0):
+                    self.assertEqual(other.get_many(keys)[keys[0]].bsic, 63)
+                # Ohne fällige Prüfung kein Cache Aufruf
+                other.recheck = 600
+                metrics.reset()
+                with metrics.scope("lookup") as scope:
+                    other.get_many(keys)
+                self.assertEqual(scope.cache_calls, 0)
+            finally:
+                _configure_tower_index()
+
+
+class FleetTest(TestCase):
+    def test_fleet_is_reproducible_and_decodable(self):
+        for version in (3, 4):
+            fleet = Fleet(devices=5, towers=50, seed=1, version=version)
+            self.assertEqual(
+                list(fleet.payloads(10)),
+                list(Fleet(devices=5, towers=50, seed=1, version=version).payloads(10)),
+            )
+        fleet = Fleet(devices=5, towers=50, seed=1, cells=6, error_rate=1.0)
+        self.assertEqual(fleet.seed_celltowers(), 50)
+        known = set(
+            models.Celltower.by_keys(
+                t_key for t_key in ((t.mcc, t.mnc, t.lac, t.cid) for t in fleet.towers)
+            )
+        )
+        for body in fleet.payloads(10):
+            decoded = decode_update(body)
+            self.assertEqual(len(decoded.cells), 6)
+            self.assertTrue({cell.key for cell in decoded.cells} <= known)
+            self.assertEqual(decoded.errors.length, 1)
+
+
+@override_settings(
+    POSITION_QUEUE={"BACKEND": "main.jobs.LocalJobQueue"},
+    METRICS={"ENABLED": True, "REDIS": False},
+)
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_upload_stages_and_queries_are_recorded(self):
+        models.Celltower.objects.create(
+            mcc=262, mnc=1, lac=0x1234, cid=0x100, bsic=20, lat=52.5, lon=13.4
+        )
+        self.client.post(
+            "/update",
+            v4_payload([(262, 1, 0x1234, 0x100, 20, 30, 10)]),
+            content_type="",
+        )
+
+        rows = {
+            (name, labels): (count, p50)
+            for name, labels, count, mean, p50, p95, p99 in metrics.summary()
+        }
+        for stage in (
+            "decode",
+            "device",
+            "status_write",
+            "celltowers",
+            "measurement_write",
+            "enqueue",
+            "wake",
+        ):
+            self.assertEqual(rows["oat_stage_seconds", (("stage", stage),)][0], 1)
+        count, queries = rows["oat_scope_queries", (("scope", "upload"),)]
+        self.assertEqual(count, 1)
+        self.assertGreater(queries, 0)
+
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        text = metrics.render_prometheus()
+        self.assertIn('oat_stage_seconds_count{stage="decode"} 1', text)
+        self.assertIn("oat_position_queue_depth 1", text)
+        # Jede Serie mit eigener TYPE Zeile
+        names = {
+            line.split("{")[0].split()[0]
+            for line in text.splitlines()
+            if not line.startswith("#")
+        }
+        types = {
+            line.split()[2] for line in text.splitlines() if line.startswith("# TYPE")
+        }
+        self.assertEqual(
+            {re.sub("_(bucket|sum|count)$", "", name) for name in names} - types, set()
+        )
+
+
+class LaterationTest(TestCase):
+    # Haversine mit lokalem Erdradius gegen distance.geodesic, Toleranz 25 m bei Abständen bis ~20 km
+    TOLERANCE_M = 25
+
+    def test_vectorized_matches_geodesic(self):
+        from geopy import distance
+
+        fleet = Fleet(devices=5, towers=200, seed=2)
+        combinations = [
+            (e, OptimizationAlgorithm.NELDER_MEAD) for e in ErrorFunction
+        ] + [
+            (ErrorFunction.ME, OptimizationAlgorithm.L_BFGS_B),
+            (ErrorFunction.RMSE, OptimizationAlgorithm.BFGS),
+        ]
+        for device in range(5):
+            measurements = fleet.measurements(device)
+            for error_function, method in combinations:
+                exact = solve_lateration(
+                    measurements, error_function, method, geodesic=True
+                )
+                fast = solve_lateration(measurements, error_function, method)
+                self.assertLess(
+                    distance.geodesic(
+                        (exact.latitude, exact.longitude),
+                        (fast.latitude, fast.longitude),
+                    ).meters,
+                    self.TOLERANCE_M,
+                )
+                self.assertAlmostEqual(
+                    exact.error, fast.error, delta=self.TOLERANCE_M / 1000
+                )
+
+    def test_gradient_matches_finite_differences(self):
+        import numpy as np
+
+        measurements = Fleet(devices=1, towers=50, seed=4).measurements(0)
+        x = np.array(
+            (
+                measurements[0].point.latitude + 0.01,
+                measurements[0].point.longitude - 0.02,
+            )
+        )
+        h = 1e-7
+        for error_function in ErrorFunction:
+            fun = vectorized_error_function(error_function, measurements, gradient=True)
+            _, gradient = fun(x)
+            numeric = [
+                (fun(x + step)[0] - fun(x - step)[0]) / (2 * h)
+                for step in (np.array((h, 0)), np.array((0, h)))
+            ]
+            np.testing.assert_allclose(gradient, numeric, rtol=1e-4)
+
+    def test_linear_lateration(self):
+        from geopy import Point
+        from geopy import distance
+        from scipy.optimize import minimize
+
+        fleet = Fleet(devices=20, towers=300, seed=5)
+        for device in range(20):
+            truth = (fleet.device_lat[device], fleet.device_lon[device])
+            # Ohne Rauschen bleibt nur der Unterschied zur flachen Projektion der Simulation
+            latitude, longitude, error = linear_lateration(
+                fleet.measurements(device, noise=0.0)
+            )
+            self.assertLess(distance.geodesic((latitude, longitude), truth).meters, 20)
+            self.assertLess(error, 0.02)
+
+        # Zwei Funkmasten, deren Kreise sich nicht schneiden: Punkt auf der Verbindungslinie
+        towers = [
+            Measurement(Point(52.5, 13.4), 1.0),
+            Measurement(Point(52.5, 13.5), 1.0),
+        ]
+        latitude, longitude, error = linear_lateration(towers)
+        self.assertAlmostEqual(latitude, 52.5, places=3)
+        self.assertAlmostEqual(longitude, 13.45, places=3)
+
+        # Widersprüchliche Abstände fallen auf Nelder-Mead zurück
+        towers = [
+            Measurement(Point(52.5, 13.4), 0.1),
+            Measurement(Point(52.6, 13.4), 0.1),
+        ]
+        with mock.patch("scipy.optimize.minimize", wraps=minimize) as fallback:
+            solve_lateration(
+                towers, ErrorFunction.RMSE, OptimizationAlgorithm.LINEAR_LSQ
+            )
+        self.assertEqual(fallback.call_args.kwargs["method"], "Nelder-Mead")
+
+    def test_batch_lateration(self):
+        import numpy as np
+
+        problems = []
+        for cells in (1, 2, 3, 7):
+            fleet = Fleet(devices=10, towers=100, seed=cells, cells=cells)
+            problems += [fleet.measurements(device) for device in range(10)]
+        lat, lon, error = batch_lateration(*pad_measurements(problems + [[]]))
+        self.assertEqual(lat.shape, (41,))
+        self.assertTrue(np.isnan(lat[-1]))
+        for i, measurements in enumerate(problems):
+            if len(measurements) == 1:
+                tower = measurements[0]
+                self.assertEqual(
+                    (lat[i], lon[i], error[i]),
+                    (tower.point.latitude, tower.point.longitude, tower.dist),
+                )
+            else:
+                # Die Zeilen sind unabhängig von der Auffüllung auf die längste Messreihe
+                np.testing.assert_allclose(
+                    (lat[i], lon[i], error[i]),
+                    linear_lateration(measurements),
+                    rtol=1e-9,
+                    atol=1e-9,
+                )
+
+    @mock.patch("main.models.Nominatim")
+    def test_update_positions_command(self, nominatim):
+        import numpy as np
+        from django.core.management import call_command
+
+        fleet = Fleet(devices=4, towers=60, seed=6, cells=4)
+        fleet.seed_celltowers()
+        for body in fleet.payloads(8):
+            decoded = decode_update(body)
+            store_update(
+                models.Device.objects.get_or_create(sn=decoded.imei)[0], decoded, body
+            )
+        call_command(
+            "update_positions", "--all", "--batch-size", "3", stdout=mock.MagicMock()
+        )
+        for summary in models.DeviceSummary.objects.select_related("last_status"):
+            status = summary.last_status
+            self.assertEqual(
+                (summary.lat, summary.lon, summary.radius),
+                (status.lat, status.lon, status.radius),
+            )
+        for status in models.Status.objects.all():
+            solved = (status.lat, status.lon, status.radius)
+            self.assertNotEqual(solved[:2], (0.0, 0.0))
+            status.new_calc_location()
+            np.testing.assert_allclose(
+                solved, (status.lat, status.lon, status.radius), rtol=1e-6
+            )
+
+    @override_settings(
+        METRICS={"ENABLED": True, "REDIS": False}, LATERATION_CACHE={"MAXSIZE": 2}
+    )
+    def test_lateration_cache(self):
+        from django.core.cache import cache
+        from geopy import Point
+
+        metrics.reset()
+        cache.clear()
+        towers = [
+            Measurement(Point(52.5, 13.4), 1.0),
+            Measurement(Point(52.51, 13.41), 1.2),
+        ]
+        key = lateration_cache.key(
+            towers, ErrorFunction.RMSE, OptimizationAlgorithm.LINEAR_LSQ
+        )
+        self.assertLess(len(key), 100)
+        # Reihenfolge und Rauschen unterhalb von DISTANCE_STEP ändern den Schlüssel nicht
+        noisy = [
+            Measurement(towers[1].point, 1.2 + 1e-9),
+            Measurement(towers[0].point, 1.0 - 1e-4),
+        ]
+        self.assertEqual(
+            lateration_cache.key(
+                noisy, ErrorFunction.RMSE, OptimizationAlgorithm.LINEAR_LSQ
+            ),
+            key,
+        )
+        self.assertNotEqual(
+            lateration_cache.key(
+                towers, ErrorFunction.ME, OptimizationAlgorithm.LINEAR_LSQ
+            ),
+            key,
+        )
+
+        def solve(measurements):
+            point, radius = lateration_new(
+                measurements, ErrorFunction.RMSE, OptimizationAlgorithm.LINEAR_LSQ
+            )
+            return point.latitude, point.longitude, radius.kilometers
+
+        with mock.patch(
+            "main.utils.solve_lateration", wraps=solve_lateration
+        ) as solver:
+            first = solve(towers)
+            self.assertEqual(solve(noisy), first)
+            lateration_cache.clear()
+            self.assertEqual(solve(towers), first)
+        self.assertEqual(solver.call_count, 1)
+
+        # Ein Treffer meldet das Verfahren der ursprünglichen Lösung, auch nach einem Rückfall
+        fallback = LaterationResult(
+            52.5, 13.4, 0.3, method=OptimizationAlgorithm.NELDER_MEAD
+        )
+        far = [
+            Measurement(Point(53.5, 13.4), 1.0),
+            Measurement(Point(53.51, 13.41), 1.2),
+        ]
+        with mock.patch("main.utils.solve_lateration", return_value=fallback):
+            cached_lateration(far, ErrorFunction.RMSE, OptimizationAlgorithm.LINEAR_LSQ)
+        lateration_cache.clear()
+        result = cached_lateration(
+            far, ErrorFunction.RMSE, OptimizationAlgorithm.LINEAR_LSQ
+        )
+        self.assertTrue(result.cached)
+        self.assertEqual(result.method, OptimizationAlgorithm.NELDER_MEAD)
+        self.assertEqual(
+            (result.latitude, result.longitude, result.error), (52.5, 13.4, 0.3)
+        )
+
+        for i in range(3):
+            lateration_cache.set(
+                f"test{i}", (0.0, 0.0, 1.0, OptimizationAlgorithm.LINEAR_LSQ.value)
+            )
+        self.assertEqual(len(lateration_cache), 2)
+        counts = {
+            labels[0][1]: value for labels, value in metrics.events.values.items()
+        }
+        self.assertEqual(counts["lateration_cache_miss"], 2)
+        self.assertEqual(counts["lateration_cache_local_hit"], 1)
+        self.assertEqual(counts["lateration_cache_redis_hit"], 2)
+        self.assertEqual(counts["lateration_cache_evict"], 2)
+
+
+class DistanceTableTest(TestCase):
+    def test_tables_match_models(self):
+        import numpy as np
+
+        from . import propagation
+        from .utils import DistanceFunction
+
+        for distance_function in DistanceFunction:
+            function, parameters = propagation.distance_model(distance_function)
+            table = propagation.distance_table(distance_function)
+            self.assertEqual(table.shape, (64, 1024))
+            for rxl, arfcn in ((0, 0), (17, 62), (45, 130), (63, 700), (30, 1000)):
+                expected = function(
+                    propagation.path_loss(propagation.rxl_to_dbm(rxl)),
+                    propagation.downlink_frequency(arfcn),
+                    **parameters,
+                )
+                self.assertAlmostEqual(table[rxl, arfcn] / expected, 1.0, places=12)
+            # Nicht belegte Kanäle haben keine Frequenz
+            self.assertTrue(np.isnan(table[10, 300]))
+
+    def test_get_distance_uses_table(self):
+        import numpy as np
+
+        from . import propagation
+        from .utils import DistanceFunction
+
+        measurements = [
+            models.Measurement(rxl=rxl, arfcn=arfcn)
+            for rxl, arfcn in ((20, 10), (35, None), (50, 600))
+        ]
+        propagation.hata_distance.cache_clear()
+        with mock.patch("main.cache.cache") as cache:
+            for distance_function in DistanceFunction:
+                distances = models.Measurement.distances(
+                    measurements, distance_function
+                )
+                np.testing.assert_array_equal(
+                    distances,
+                    [
+                        m.get_distance(distance_function).kilometers
+                        for m in measurements
+                    ],
+                )
+            self.assertEqual(propagation.hata_distance.cache_info().misses, 0)
+            # Abweichende Parameter werden berechnet und prozesslokal memoisiert, ohne Django Cache
+            first = measurements[0].get_distance(DistanceFunction.hata_open, dbm=-60)
+            second = measurements[0].get_distance(DistanceFunction.hata_open, dbm=-60)
+        self.assertEqual(first.kilometers, second.kilometers)
+        info = propagation.hata_distance.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        self.assertFalse(cache.method_calls)
+
+
+class BatteryTest(TestCase):
+    def test_curve_matches_piecewise_definition(self):
+        def piecewise(voltage):
+            # Bisherige Status.battery_percentage
+            n = 3708
+            abschnitte = {
+                0: 8.35221210479736,
+                115: 8.23313919067382,
+                483: 7.98308769226074,
+                966: 7.69731489181518,
+            }
+            abschnitte.update(
+                {1817: 7.28056255340576, 2760: 7.10195461273193, 3427: 6.81618181228637}
+            )
+            abschnitte.update(
+                {
+                    3542: 6.66138807296752,
+                    3634: 6.25654283523559,
+                    3680: 5.80406871795654,
+                    n: 5.35,
+                }
+            )
+            last_u, last_base = 0.0, 0.0
+            for i, u in abschnitte.items():
+                base = (n - i) / n
+                if voltage >= u:
+                    if i == 0:
+                        return 100
+                    return (
+                        base + (last_base - base) * ((voltage - u) / (last_u - u))
+                    ) * 100
+                last_u, last_base = u, base
+            return min(max((round((voltage - 6.5) / 1.9 * 100)), 0.0), 100.0)
+
+        for voltage in [5.0 + 0.01 * i for i in range(401)]:
+            self.assertAlmostEqual(
+                float(models.battery_percentage(voltage)), piecewise(voltage), places=9
+            )
+
+    def test_calibration_change_recomputes_in_database(self):
+        device = models.Device.objects.create(sn=IMEI)
+        for raw in (600, 680, 760):
+            body = v4_payload([], voltage=(250, raw))
+            store_update(device, decode_update(body), body)
+        voltages = [s.voltage for s in models.Status.objects.order_by("voltage_raw")]
+        self.assertAlmostEqual(voltages[0], 11 * 4.46 * 250 * 600 / 1023 ** 2)
+
+        device = models.Device.objects.get(id=device.id)
+        device.voltage_offset = 0.4
+        device.vcc_arduino = 4.5
+        with self.assertNumQueries(4):
+            # UPDATE, zwei UPDATE für die Status, Übersicht
+            device.save()
+        self.assertAlmostEqual(device.battery, device.last_position.voltage)
+        for status in models.Status.objects.all():
+            voltage, percentage = status.voltage, status.battery_percentage
+            status.calc_battery()
+            self.assertAlmostEqual(voltage, status.voltage, places=9)
+            self.assertAlmostEqual(percentage, status.battery_percentage, places=9)
+        ordered = list(
+            models.Status.objects.order_by("battery_percentage").values_list(
+                "voltage_raw", flat=True
+            )
+        )
+        self.assertEqual(ordered, [600, 680, 760])
+        with self.assertNumQueries(1):
+            device.save(update_fields=["next_wake"])
+
+
+class TabledataTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from django.utils import timezone
+
+        cls.user = models.User.objects.create_user("tester")
+        device = models.Device.objects.create(sn=IMEI)
+        device.users.add(cls.user)
+        country = models.Country.objects.create(name="Deutschland", code="DE")
+        city = models.City.objects.create(name="Berlin", country=country)
+        now = timezone.now()
+        # Paare mit gleichem Zeitstempel, Städte nur teilweise bekannt
+        models.Status.objects.bulk_create(
+            models.Status(
+                device=device,
+                lat=52.5,
+                lon=13.4,
+                radius=0.5,
+                timestamp=now - timedelta(minutes=i // 2),
+                city=city if i % 3 else None,
+                celltower_count=i % 4,
+            )
+            for i in range(45)
+        )
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        super().setUp()
+        # Zählungen und Cursor liegen im Django Cache, der nicht mit der Datenbank zurückgerollt wird
+        cache.clear()
+
+    def post(self, start, length, queries=None, order=(0, "desc")):
+        import json
+
+        body = {
+            "draw": 1,
+            "type": "status",
+            "imei": IMEI,
+            "start": start,
+            "length": length,
+            "order": [{"column": order[0], "dir": order[1]}],
+            "search": {"value": ""},
+            "timespan": {"start": 0, "end": 0},
+        }
+        if queries is None:
+            return self.client.post(
+                "/map/tabledata", json.dumps(body), content_type="application/json"
+            ).json()
+        with self.assertNumQueries(queries) as context:
+            response = self.client.post(
+                "/map/tabledata", json.dumps(body), content_type="application/json"
+            ).json()
+        self.last_sql = context.captured_queries[-1]["sql"]
+        return response
+
+    def test_keyset_pages_match_offset_order(self):
+        self.client.force_login(self.user)
+        expected = list(
+            models.Status.objects.order_by("-timestamp", "id").values_list(
+                "id", flat=True
+            )
+        )
+        # Session, User, Device, Berechtigung, zwei Zählungen, Seite
+        first = self.post(0, 10, queries=7)
+        self.assertEqual((first["recordsTotal"], first["recordsFiltered"]), (45, 45))
+        ids = [row["id"] for row in first["data"]]
+        for start in range(10, 45, 10):
+            # Zählungen aus dem Cache, die Seite über den Cursor der vorherigen
+            page = self.post(start, 10, queries=5)
+            self.assertNotIn("OFFSET", self.last_sql)
+            ids += [row["id"] for row in page["data"]]
+        self.assertEqual(ids, expected)
+        self.assertEqual({row["country"] for row in first["data"]}, {"DE", "???"})
+        # Unabhängig von der Seitengröße
+        self.post(0, 40, queries=5)
+        self.assertEqual(len(self.post(40, 40, queries=5)["data"]), 5)
+
+    def test_pending_status_is_hidden(self):
+        from django.utils import timezone
+
+        self.client.force_login(self.user)
+        pending = models.Status.objects.create(
+            device=models.Device.objects.get(),
+            lat=0,
+            lon=0,
+            radius=0,
+            timestamp=timezone.now(),
+            position_pending=True,
+        )
+        page = self.post(0, 10)
+        self.assertEqual((page["recordsTotal"], page["recordsFiltered"]), (45, 45))
+        self.assertNotIn(pending.id, [row["id"] for row in page["data"]])
+        response = self.client.post("/detail", {"type": "status", "id": pending.id})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.get(
+            f"/device/{IMEI}/export/csv", {"start": "", "end": ""}
+        )
+        self.assertEqual(len(response.content.decode().splitlines()), 46)
+
+    def test_keyset_follows_sort_column(self):
+        self.client.force_login(self.user)
+        # Funkmasten mit vielen gleichen Werten, Spannung überall gleich
+        for order, fields in (
+            ((3, "asc"), ("celltower_count", "id")),
+            ((5, "desc"), ("-voltage", "id")),
+        ):
+            expected = list(
+                models.Status.objects.order_by(*fields).values_list("id", flat=True)
+            )
+            ids = [row["id"] for row in self.post(0, 10, order=order)["data"]]
+            for start in range(10, 45, 10):
+                ids += [
+                    row["id"]
+                    for row in self.post(start, 10, queries=5, order=order)["data"]
+                ]
+                self.assertNotIn("OFFSET", self.last_sql)
+            self.assertEqual(ids, expected)
+        # Spalten mit NULL Werten mit OFFSET
+        self.post(0, 10, order=(2, "asc"))
+        self.post(10, 10, queries=5, order=(2, "asc"))
+        self.assertIn("OFFSET", self.last_sql)
+
+    def test_status_changes_replace_cached_pages(self):
+        from django.utils import timezone
+
+        self.client.force_login(self.user)
+        device = models.Device.objects.get()
+        self.assertEqual(self.post(0, 10)["recordsTotal"], 45)
+        # Nachgereichter älterer Bericht
+        older = models.Status.objects.create(
+            device=device,
+            lat=52.5,
+            lon=13.4,
+            radius=0.5,
+            timestamp=timezone.now() - timedelta(days=1),
+        )
+        self.assertEqual(self.post(0, 10)["recordsTotal"], 46)
+        # Löschen eines Status, der nicht der letzte ist
+        with self.captureOnCommitCallbacks(execute=True):
+            older.delete()
+        self.assertEqual(self.post(0, 10)["recordsTotal"], 45)
+        # Neue Kalibrierung schreibt die Spannung, eine Sortierspalte, neu
+        self.post(0, 10, order=(5, "desc"))
+        device = models.Device.objects.get()
+        device.voltage_offset += 0.1
+        device.save()
+        with CaptureQueriesContext(connection) as context:
+            self.post(10, 10, order=(5, "desc"))
+        self.assertTrue(
+            any("OFFSET" in query["sql"] for query in context.captured_queries)
+        )
+
+
+class DeviceSummaryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = models.User.objects.create_superuser("tester")
+        for i in range(3):
+            models.Celltower.objects.create(
+                mcc=262,
+                mnc=1,
+                lac=0x1234,
+                cid=0x100 + i,
+                bsic=20,
+                lat=52.5,
+                lon=13.4 + i,
+            )
+
+    def test_summary_follows_ingest(self):
+        from .models import DeviceSummary
+
+        device = models.Device.objects.create(sn=IMEI)
+        body = v4_payload(
+            [(262, 1, 0x1234, 0x100, 20, 30, 10)], errors=((1 << 13) | 5,)
+        )
+        first = store_update(device, decode_update(body), body)
+        body = v4_payload([(262, 1, 0x1234, 0x101, 20, 30, 10)], voltage=(250, 700))
+        second = store_update(device, decode_update(body), body)
+        summary = DeviceSummary.objects.get(device=device)
+        self.assertEqual((summary.status_count, summary.last_status_id), (2, second.id))
+        self.assertEqual(
+            (summary.voltage, summary.last_error.status_id), (second.voltage, first.id)
+        )
+
+        # Position aus dem Worker
+        second.lat, second.lon, second.radius = 52.5, 13.45, 0.3
+        second.save()
+        DeviceSummary.update_position(second)
+        summary.refresh_from_db()
+        self.assertEqual((summary.lat, summary.lon), (52.5, 13.45))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+            self.assertEqual(models.Device.objects.get().last_position_id, None)
+        self.assertEqual(
+            DeviceSummary.objects.get(device=device).last_status_id, first.id
+        )
+        self.assertEqual(models.Device.objects.get().last_position_id, first.id)
+        models.DeviceSummary.objects.all().delete()
+        self.assertEqual(DeviceSummary.rebuild(device).status_count, 1)
+
+        # Mehrere Status eines Geräts: eine Neuberechnung nach dem Commit, keine für gelöschte Geräte
+        for cid in (0x101, 0x102):
+            body = v4_payload([(262, 1, 0x1234, cid, 20, 30, 10)])
+            store_update(device, decode_update(body), body)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            models.Status.objects.exclude(id=first.id).delete()
+        self.assertEqual(len(callbacks), 1)
+        summary = DeviceSummary.objects.get(device=device)
+        self.assertEqual((summary.status_count, summary.last_status_id), (1, first.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+            device.delete()
+        self.assertFalse(DeviceSummary.objects.exists())
+
+    def test_device_list_reads_one_row_per_device(self):
+        import json
+
+        self.client.force_login(self.user)
+        body = {
+            "draw": 1,
+            "type": "tracker",
+            "start": 0,
+            "length": 10,
+            "order": [{"column": 2, "dir": "desc"}],
+            "search": {"value": ""},
+        }
+        counts = []
+        for i in range(1, 6, 2):
+            for sn in range(IMEI + 10 * i, IMEI + 10 * i + 2):
+                device = models.Device.objects.create(sn=sn)
+                device.users.add(self.user)
+                payload = v4_payload(
+                    [(262, 1, 0x1234, 0x100, 20, 30, 10)], voltage=(250, 600 + sn % 100)
+                )
+                store_update(device, decode_update(payload), payload)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(
+                    "/map/tabledata", json.dumps(body), content_type="application/json"
+                ).json()
+            counts.append(len(context))
+            self.assertEqual(response["recordsTotal"], len(response["data"]))
+            voltages = [row["battery"]["voltage"] for row in response["data"]]
+            self.assertEqual(voltages, sorted(voltages, reverse=True))
+        self.assertEqual(len(set(counts)), 1)
+        self.assertEqual(self.client.get("/admin/main/device/").status_code, 200)
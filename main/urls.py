@@ -59,6 +59,7 @@ urlpatterns = [
     path("detail", views.DetailInfoView.as_view(), name="detail"),
     path("celltower/<int:stunden>", views.CelltowerView.as_view(), name="celltower"),
     path("update_bts", api.update_bts),
+    path("metrics", views.MetricsView.as_view(), name="metrics"),
     path("tracker/", lambda r: views.HttpResponseBadRequest(), name="trackerData_base"),
     path("tracker/<int:imei>", views.TrackerDataView.as_view(), name="trackerData"),
     path(
@@ -69,6 +70,11 @@ urlpatterns = [
 ]
 
 websocket_urlpatterns = [
-    path("ws/device/<int:imei>/", consumers.DeviceUpdateConsumer),
-    path("ws/user/<int:user_id>/", consumers.UserUpdateConsumer),
+    path("ws/device/<int:imei>/", consumers.DeviceUpdateConsumer.as_asgi()),
+    path("ws/user/<int:user_id>/", consumers.UserUpdateConsumer.as_asgi()),
+]
+
+# Vom ASGI Server (uvicorn) direkt bedient, alles andere geht an die Django Views
+http_urlpatterns = [
+    path("update", consumers.StatusConsumer.as_asgi(), name="update_async"),
 ]
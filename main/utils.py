@@ -20,12 +20,13 @@ __copyright__ = "Copyright 2021, Patrick Frontzek"
 __license__ = "GPLv3"
 
 from dataclasses import dataclass
-from django.core.cache import cache
 from django.utils import timezone
 from enum import Enum
 from enum import auto
 from multiprocessing import Value
 from typing import List
+from typing import Optional
+from typing import Sequence
 from typing import Tuple
 
 import geopy
@@ -33,6 +34,7 @@ import requests
 from geopy import distance
 
 from . import models
+from .cache import lateration_cache
 
 
 @dataclass
@@ -67,100 +69,487 @@ class OptimizationAlgorithm(Enum):
     # NEWTON_CG = "Newton-CG"
     SLSQP = "SLSQP"
     NELDER_MEAD = "Nelder-Mead"
+    # Geschlossene Lösung in der lokalen Tangentialebene, kein scipy Verfahren
+    LINEAR_LSQ = "linear"
 
 
-def lateration_new(
+# WGS84
+EARTH_A = 6378.137
+EARTH_E2 = 6.69437999014e-3
+
+# Verfahren, denen scipy einen Gradienten übergeben kann
+GRADIENT_METHODS = {
+    OptimizationAlgorithm.L_BFGS_B,
+    OptimizationAlgorithm.BFGS,
+    OptimizationAlgorithm.CG,
+    OptimizationAlgorithm.SLSQP,
+}
+
+
+def local_earth_radius(latitude: float) -> float:
+    """Gaußscher Krümmungsradius in km, sqrt(M * N) des WGS84 Ellipsoids an ``latitude`` (auch Arrays)."""
+    import numpy as np
+
+    w2 = 1 - EARTH_E2 * np.sin(np.radians(latitude)) ** 2
+    return EARTH_A * np.sqrt(1 - EARTH_E2) / w2
+
+
+def haversine(lat, lon, tower_lat, tower_lon, radius: float, gradient: bool = False):
+    """Abstände in km von (lat, lon) zu allen Funkmasten, optional mit Ableitungen nach lat und lon in km/Grad."""
+    import numpy as np
+
+    phi = np.radians(lat)
+    tower_phi = np.radians(tower_lat)
+    d_phi = phi - tower_phi
+    d_lambda = np.radians(lon - tower_lon)
+    cos_phi = np.cos(phi)
+    cos_tower_phi = np.cos(tower_phi)
+    sin2_lambda = np.sin(d_lambda / 2) ** 2
+    a = np.clip(
+        np.sin(d_phi / 2) ** 2 + cos_phi * cos_tower_phi * sin2_lambda, 0.0, 1.0
+    )
+    d = 2 * radius * np.arcsin(np.sqrt(a))
+    if not gradient:
+        return d
+    # dd/da ist im Funkmast selbst singulär, dort ist jede Richtung gleich gut
+    dd_da = radius / np.sqrt(np.maximum(a * (1 - a), 1e-18))
+    da_dphi = 0.5 * np.sin(d_phi) - np.sin(phi) * cos_tower_phi * sin2_lambda
+    da_dlambda = 0.5 * cos_phi * cos_tower_phi * np.sin(d_lambda)
+    scale = dd_da * (np.pi / 180)
+    return d, scale * da_dphi, scale * da_dlambda
+
+
+def _wrap(x) -> Tuple[float, float]:
+    return ((x[0] + 90) % 180) - 90, ((x[1] + 90) % 180) - 90
+
+
+def vectorized_error_function(
+    error_function: ErrorFunction,
     measurements: List[Measurement],
-    error_function: ErrorFunction = ErrorFunction.ME,
-    method: OptimizationAlgorithm = OptimizationAlgorithm.L_BFGS_B,
-) -> Tuple[geopy.Point, distance.Distance]:
-    key = f"lateration{measurements}{error_function.name}{method}"
-    result = cache.get(key)
-    if result:
-        return geopy.Point(result[0], result[1]), distance.distance(result[2])
+    gradient: bool = False,
+):
+    """Fehlerfunktion über NumPy Arrays, mit ``gradient`` liefert sie (Fehler, Gradient) für ``jac=True``.
+
+    Abstände werden per Haversine mit dem lokalen Erdradius am Schwerpunkt der Funkmasten berechnet,
+    für Abstände unter 100 km weicht das weniger als 0.2 % von ``distance.geodesic`` ab.
+    """
     import numpy as np
-    from scipy.optimize import Bounds
-    from scipy.optimize import minimize
+
+    tower_lat = np.array([m.point.latitude for m in measurements], dtype=float)
+    tower_lon = np.array([m.point.longitude for m in measurements], dtype=float)
+    dist = np.array([m.dist for m in measurements], dtype=float)
+    radius = local_earth_radius(tower_lat.mean())
+    n = len(measurements)
+
+    def residuals(x):
+        latitude, longitude = _wrap(x)
+        if not gradient:
+            return (
+                haversine(latitude, longitude, tower_lat, tower_lon, radius) - dist,
+                None,
+                None,
+            )
+        d, d_lat, d_lon = haversine(
+            latitude, longitude, tower_lat, tower_lon, radius, gradient=True
+        )
+        return d - dist, d_lat, d_lon
+
+    def gradient_of(weights, d_lat, d_lon):
+        return np.array((weights @ d_lat, weights @ d_lon)) / n
 
     if error_function == ErrorFunction.ME:
 
-        def me(x, measurements: List[Measurement]) -> float:
-            e = 0.0
-            latitude = ((x[0] + 90) % 180) - 90
-            longitude = ((x[1] + 90) % 180) - 90
-            p = geopy.Point(latitude=latitude, longitude=longitude)
-            for m in measurements:
-                distance_calculated = distance.geodesic(p, m.point).kilometers
-                e += distance_calculated - m.dist
-            return e / len(measurements)
-
-        error_function = me
+        def me(x):
+            r, d_lat, d_lon = residuals(x)
+            e = r.sum() / n
+            if not gradient:
+                return e
+            return e, gradient_of(np.ones(n), d_lat, d_lon)
+
+        return me
     elif error_function == ErrorFunction.MAE:
 
-        def mae(x, measurements: List[Measurement]) -> float:
-            e = 0.0
-            latitude = ((x[0] + 90) % 180) - 90
-            longitude = ((x[1] + 90) % 180) - 90
-            p = geopy.Point(latitude=latitude, longitude=longitude)
-            for m in measurements:
-                distance_calculated = distance.geodesic(p, m.point).kilometers
-                e += np.abs(distance_calculated - m.dist)
-            return e / len(measurements)
-
-        error_function = mae
-    elif error_function == ErrorFunction.MSE or ErrorFunction.RMSE:
-
-        def mse(x, measurements: List[Measurement]) -> float:
-            e = 0.0
-            latitude = ((x[0] + 90) % 180) - 90
-            longitude = ((x[1] + 90) % 180) - 90
-            p = geopy.Point(latitude=latitude, longitude=longitude)
-            for m in measurements:
-                distance_calculated = distance.geodesic(p, m.point).kilometers
-                e += np.power(distance_calculated - m.dist, 2)
-            return e / len(measurements)
-
-        if error_function == ErrorFunction.MSE:
-            error_function = mse
-        else:
-
-            def rmse(x, measurements: List[Measurement]) -> float:
-                return np.sqrt(mse(x=x, measurements=measurements))
-
-            error_function = rmse
-
-    initial_location = np.array(
+        def mae(x):
+            r, d_lat, d_lon = residuals(x)
+            e = np.abs(r).sum() / n
+            if not gradient:
+                return e
+            return e, gradient_of(np.sign(r), d_lat, d_lon)
+
+        return mae
+
+    def mse(x):
+        r, d_lat, d_lon = residuals(x)
+        e = (r @ r) / n
+        if not gradient:
+            return e
+        return e, gradient_of(2 * r, d_lat, d_lon)
+
+    if error_function == ErrorFunction.MSE:
+        return mse
+
+    def rmse(x):
+        if not gradient:
+            return np.sqrt(mse(x))
+        e, g = mse(x)
+        e = np.sqrt(e)
+        return e, g / (2 * max(e, 1e-12))
+
+    return rmse
+
+
+def geodesic_error_function(
+    error_function: ErrorFunction, measurements: List[Measurement]
+):
+    """Die ursprüngliche Fehlerfunktion mit ``distance.geodesic`` je Messung, Referenz für Tests und Benchmarks."""
+    import numpy as np
+
+    def errors(x):
+        latitude, longitude = _wrap(x)
+        p = geopy.Point(latitude=latitude, longitude=longitude)
+        return np.array(
+            [distance.geodesic(p, m.point).kilometers - m.dist for m in measurements]
+        )
+
+    if error_function == ErrorFunction.ME:
+        return lambda x: errors(x).sum() / len(measurements)
+    elif error_function == ErrorFunction.MAE:
+        return lambda x: np.abs(errors(x)).sum() / len(measurements)
+    elif error_function == ErrorFunction.MSE:
+        return lambda x: np.power(errors(x), 2).sum() / len(measurements)
+    return lambda x: np.sqrt(np.power(errors(x), 2).sum() / len(measurements))
+
+
+def pad_measurements(problems: List[List[Measurement]]):
+    """Messungen vieler Status als (lat, lon, dist, mask) Arrays der Form (Status, max. Funkmasten)."""
+    import numpy as np
+
+    shape = (len(problems), max((len(p) for p in problems), default=0))
+    lat = np.zeros(shape)
+    lon = np.zeros(shape)
+    dist = np.zeros(shape)
+    mask = np.zeros(shape, dtype=bool)
+    for i, measurements in enumerate(problems):
+        n = len(measurements)
+        lat[i, :n] = [m.point.latitude for m in measurements]
+        lon[i, :n] = [m.point.longitude for m in measurements]
+        dist[i, :n] = [m.dist for m in measurements]
+        mask[i, :n] = True
+    return lat, lon, dist, mask
+
+
+def batch_lateration(lat, lon, dist, mask, iterations: int = 10):
+    """Lateration für alle Zeilen gleichzeitig, gibt (lat, lon, RMS Fehler in km) Arrays zurück.
+
+    Die geschlossene Lösung dient als Startwert für Levenberg-Marquardt Schritte, die pro Status
+    nur angenommen werden, wenn sie den gewichteten Fehler verringern. Bei einem Funkmast ist die
+    Position der Funkmast und der Fehler dessen Abstand, ohne Funkmast ist das Ergebnis NaN.
+    """
+    return _batch_lateration(lat, lon, dist, mask, iterations)[:3]
+
+
+def _batch_lateration(lat, lon, dist, mask, iterations: int):
+    import numpy as np
+
+    count = mask.sum(axis=1)
+    lat0 = np.where(mask, lat, 0).sum(axis=1) / np.maximum(count, 1)
+    lon0 = np.where(mask, lon, 0).sum(axis=1) / np.maximum(count, 1)
+    km_north = np.radians(local_earth_radius(lat0))
+    km_east = km_north * np.cos(np.radians(lat0))
+    p = np.stack(
         (
-            np.sum([m.point.latitude for m in measurements]) / len(measurements),
-            np.sum([m.point.longitude for m in measurements]) / len(measurements),
+            (lon - lon0[:, None]) * km_east[:, None],
+            (lat - lat0[:, None]) * km_north[:, None],
+        ),
+        axis=-1,
+    )
+    w = np.where(mask, 1 / np.maximum(dist, 0.05) ** 2, 0)
+    w /= np.maximum(w.sum(axis=1, keepdims=True), 1e-300)
+    center = np.einsum("nk,nkc->nc", w, p)
+    q = np.where(mask[..., None], p - center[:, None], 0)
+
+    # Normalgleichungen der geschlossenen Lösung, pinv entspricht lstsq bei Rangabfall
+    c = dist ** 2 - (q ** 2).sum(axis=-1)
+    c -= (w * c).sum(axis=1, keepdims=True)
+    a = -2 * q
+    normal = np.einsum("nk,nki,nkj->nij", w, a, a)
+    x = np.einsum(
+        "nij,nj->ni",
+        np.linalg.pinv(normal, rcond=1e-10, hermitian=True),
+        np.einsum("nk,nki,nk->ni", w, a, c),
+    )
+
+    def residuals(x):
+        diff = x[:, None] - q
+        d = np.maximum(np.hypot(diff[..., 0], diff[..., 1]), 1e-6)
+        return np.where(mask, d - dist, 0), diff / d[..., None]
+
+    # Bei zwei Funkmasten gibt es zwei gleich gute Schnittpunkte, die geschlossene Lösung
+    # liegt zwischen ihnen auf der Verbindungslinie und wird nicht verfeinert
+    refine = count > 2
+
+    r, jacobian = residuals(x)
+    cost = (w * r ** 2).sum(axis=1)
+    damping = np.full(len(x), 1e-3)
+    identity = np.eye(2)
+    nit = 0
+    for nit in range(1, iterations + 1):
+        jtj = np.einsum("nk,nki,nkj->nij", w, jacobian, jacobian)
+        g = np.einsum("nk,nki,nk->ni", w, jacobian, r)
+        scale = damping * np.trace(jtj, axis1=1, axis2=2) / 2
+        step = -np.einsum(
+            "nij,nj->ni",
+            np.linalg.pinv(
+                jtj + scale[:, None, None] * identity, rcond=1e-10, hermitian=True
+            ),
+            g,
         )
+        new_r, new_jacobian = residuals(x + step)
+        new_cost = (w * new_r ** 2).sum(axis=1)
+        # Zeilen ohne nennenswerten Schritt (1 mm) gelten als konvergiert und bleiben stehen
+        refine &= np.hypot(step[:, 0], step[:, 1]) > 1e-6
+        accept = refine & (new_cost < cost)
+        x = np.where(accept[:, None], x + step, x)
+        r = np.where(accept[:, None], new_r, r)
+        jacobian = np.where(accept[:, None, None], new_jacobian, jacobian)
+        cost = np.where(accept, new_cost, cost)
+        damping = np.where(accept, damping / 3, damping * 4)
+        if not refine.any():
+            break
+
+    x += center
+    error = np.sqrt((r ** 2).sum(axis=1) / np.maximum(count, 1))
+    error = np.where(count == 1, dist[:, 0], error)
+    invalid = count == 0
+    return (
+        np.where(invalid, np.nan, lat0 + x[:, 1] / km_north),
+        np.where(invalid, np.nan, lon0 + x[:, 0] / km_east),
+        np.where(invalid, np.nan, error),
+        nit,
     )
 
-    # print(initial_location)
+
+# Rückfall auf minimize, wenn der RMS Abstandsfehler der geschlossenen Lösung größer ist
+LINEAR_FALLBACK_KM = 0.5
+LINEAR_FALLBACK_RATIO = 0.5
+
+
+def linear_lateration(
+    measurements: List[Measurement], iterations: int = 10
+) -> Tuple[float, float, float]:
+    """Gewichtete kleinste Quadrate in einer lokalen Tangentialebene, gibt (lat, lon, RMS Fehler in km) zurück.
+
+    Die Kreisgleichungen werden um den mit 1/r² gewichteten Schwerpunkt linearisiert und geschlossen gelöst,
+    danach verfeinern bis zu ``iterations`` Levenberg-Marquardt Schritte auf den tatsächlichen Abständen.
+    """
+    return _linear_lateration(measurements, iterations)[:3]
+
+
+def _linear_lateration(measurements: List[Measurement], iterations: int = 10):
+    lat, lon, error, nit = _batch_lateration(
+        *pad_measurements([measurements]), iterations=iterations
+    )
+    return float(lat[0]), float(lon[0]), float(error[0]), nit
+
+
+# Toleranzen für minimize, bei mehreren wird nacheinander ab dem letzten Ergebnis verfeinert
+TOLERANCE_SCHEDULE = (1e-6,)
+WARM_TOLERANCE_SCHEDULE = (1e-5,)
+# Nelder-Mead Startsimplex um einen Startwert in Grad, etwa ±1 km
+WARM_SIMPLEX = ((0.0, 0.0), (0.01, 0.0), (0.0, 0.015))
+
+
+@dataclass
+class LaterationResult:
+    latitude: float
+    longitude: float
+    # RMS bzw. Wert der Fehlerfunktion in km, Status.radius ist error + 0.1
+    error: float
+    # Tatsächlich verwendetes Verfahren, nach einem Rückfall NELDER_MEAD
+    method: OptimizationAlgorithm
+    nit: int = 0
+    nfev: int = 0
+    cached: bool = False
+
+    @property
+    def radius(self) -> float:
+        return self.error + 0.1
+
+
+def solve_lateration(
+    measurements: List[Measurement],
+    error_function: ErrorFunction = ErrorFunction.ME,
+    method: OptimizationAlgorithm = OptimizationAlgorithm.L_BFGS_B,
+    geodesic: bool = False,
+    initial: Optional[Tuple[float, float]] = None,
+    tol: Optional[Sequence[float]] = None,
+) -> LaterationResult:
+    """Ungecachte Lateration.
+
+    ``initial`` ersetzt den Schwerpunkt der Funkmasten als Startwert der scipy Verfahren, ``tol`` ist
+    der Toleranzplan, ohne Angabe TOLERANCE_SCHEDULE bzw. mit Startwert WARM_TOLERANCE_SCHEDULE.
+    """
+    import numpy as np
+    from scipy.optimize import Bounds
+    from scipy.optimize import minimize
+
+    from . import metrics
+
+    if method == OptimizationAlgorithm.LINEAR_LSQ:
+        latitude, longitude, error, nit = _linear_lateration(measurements)
+        mean_dist = sum(m.dist for m in measurements) / len(measurements)
+        if error <= max(LINEAR_FALLBACK_KM, LINEAR_FALLBACK_RATIO * mean_dist):
+            metrics.inc("lateration_nfev", nit + 1)
+            return LaterationResult(latitude, longitude, error, method, nit, nit + 1)
+        metrics.inc("lateration_fallback")
+        method = OptimizationAlgorithm.NELDER_MEAD
+
     minimize_extra_args = {
         "options": {"maxiter": 1e5},
     }
+    if geodesic:
+        fun = geodesic_error_function(error_function, measurements)
+    else:
+        gradient = method in GRADIENT_METHODS
+        fun = vectorized_error_function(error_function, measurements, gradient=gradient)
+        minimize_extra_args["jac"] = gradient
+
+    if initial is not None:
+        x = np.array(initial, dtype=float)
+    else:
+        x = np.array(
+            (
+                np.sum([m.point.latitude for m in measurements]) / len(measurements),
+                np.sum([m.point.longitude for m in measurements]) / len(measurements),
+            )
+        )
+    if tol is None:
+        tol = TOLERANCE_SCHEDULE if initial is None else WARM_TOLERANCE_SCHEDULE
+
     if method == OptimizationAlgorithm.L_BFGS_B:
         minimize_extra_args["bounds"] = Bounds(-90, 90)
 
     elif method == OptimizationAlgorithm.SLSQP:
         minimize_extra_args["bounds"] = Bounds(-90, 90)
 
-    result = minimize(
-        fun=error_function,
-        x0=initial_location,
-        args=(measurements,),
-        method=method.value,
-        tol=1e-6,
-        **minimize_extra_args,
+    simplex = np.array(WARM_SIMPLEX)
+    nit = nfev = 0
+    for step_tol in tol:
+        if initial is not None and method == OptimizationAlgorithm.NELDER_MEAD:
+            # Das Standard-Simplex (5 % von x0, bei 52° also ~300 km) würde den Startwert verschenken,
+            # jede weitere Stufe beginnt mit einem kleineren Simplex
+            minimize_extra_args["options"]["initial_simplex"] = x + simplex
+            simplex = simplex / 10
+        result = minimize(
+            fun=fun,
+            x0=x,
+            method=method.value,
+            tol=step_tol,
+            **minimize_extra_args,
+        )
+        x = result.x
+        nit += int(getattr(result, "nit", 0))
+        nfev += int(result.nfev)
+    metrics.inc("lateration_nfev", nfev)
+    latitude, longitude = _wrap(x)
+    return LaterationResult(
+        float(latitude), float(longitude), float(abs(result.fun)), method, nit, nfev
     )
-    # print(result)
-    latitude = ((result.x[0] + 90) % 180) - 90
-    longitude = ((result.x[1] + 90) % 180) - 90
-    cache.set(key, (latitude, longitude, abs(result.fun) + 0.1), None)
-    result_point = geopy.Point(latitude, longitude)
 
-    return result_point, distance.distance(abs(result.fun) + 0.1)
+
+def lateration_inputs(measurements: List["models.Measurement"]) -> List[Measurement]:
+    """Funkmast und Abstand (hata_urban_small) je Messung, die Abstände aus der Tabelle."""
+    distances = models.Measurement.distances(measurements)
+    return [
+        Measurement(m.tower.point, float(d)) for m, d in zip(measurements, distances)
+    ]
+
+
+def batch_calc_locations(statuses, fallback: bool = True) -> List["models.Status"]:
+    """Setzt lat, lon, radius und position_source vieler Status wie ``Status.new_calc_location``, ohne zu speichern.
+
+    Für Status ohne Messungen bleibt die Position unverändert, sie werden nicht zurückgegeben.
+    """
+    import numpy as np
+
+    statuses = list(statuses)
+    cleaned = list(zip(statuses, models.Status.clean_measurements(statuses)))
+    statuses = [s for s, measurements in cleaned if measurements]
+    problems = [
+        lateration_inputs(measurements) for _, measurements in cleaned if measurements
+    ]
+    if not problems:
+        return []
+    lat, lon, dist, mask = pad_measurements(problems)
+    lat, lon, error = batch_lateration(lat, lon, dist, mask)
+    # Wie in lateration_new, bei einem Funkmast bleibt es dessen Abstand
+    error = np.where(mask.sum(axis=1) > 1, error + 0.1, error)
+    for i, (status, measurements) in enumerate(zip(statuses, problems)):
+        mean_dist = sum(m.dist for m in measurements) / len(measurements)
+        if (
+            fallback
+            and len(measurements) > 1
+            and not error[i]
+            <= max(LINEAR_FALLBACK_KM, LINEAR_FALLBACK_RATIO * mean_dist) + 0.1
+        ):
+            from . import metrics
+
+            metrics.inc("lateration_fallback")
+            result = solve_lateration(
+                measurements, ErrorFunction.RMSE, OptimizationAlgorithm.NELDER_MEAD
+            )
+            lat[i], lon[i], error[i] = result.latitude, result.longitude, result.radius
+        status.lat, status.lon, status.radius = (
+            float(lat[i]),
+            float(lon[i]),
+            float(error[i]),
+        )
+        status.position_source = (
+            models.Status.PositionSource.solved
+            if len(measurements) > 1
+            else models.Status.PositionSource.tower
+        )
+    return statuses
+
+
+def cached_lateration(
+    measurements: List[Measurement],
+    error_function: ErrorFunction = ErrorFunction.ME,
+    method: OptimizationAlgorithm = OptimizationAlgorithm.L_BFGS_B,
+    initial: Optional[Tuple[float, float]] = None,
+    tol: Optional[Sequence[float]] = None,
+) -> LaterationResult:
+    key = lateration_cache.key(measurements, error_function, method)
+    result = lateration_cache.get(key)
+    if result:
+        latitude, longitude, error, actual = result
+        return LaterationResult(
+            latitude,
+            longitude,
+            error,
+            method=OptimizationAlgorithm(actual),
+            cached=True,
+        )
+    result = solve_lateration(
+        measurements, error_function, method, initial=initial, tol=tol
+    )
+    # Nach einem Rückfall auf Nelder-Mead das tatsächliche Verfahren merken
+    lateration_cache.set(
+        key, (result.latitude, result.longitude, result.error, result.method.value)
+    )
+    return result
+
+
+def lateration_new(
+    measurements: List[Measurement],
+    error_function: ErrorFunction = ErrorFunction.ME,
+    method: OptimizationAlgorithm = OptimizationAlgorithm.L_BFGS_B,
+    initial: Optional[Tuple[float, float]] = None,
+) -> Tuple[geopy.Point, distance.Distance]:
+    result = cached_lateration(measurements, error_function, method, initial=initial)
+    return geopy.Point(result.latitude, result.longitude), distance.distance(
+        result.radius
+    )
 
 
 def update_cell(cell: models.Celltower):
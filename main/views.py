@@ -20,13 +20,14 @@ __copyright__ = "Copyright 2021, Patrick Frontzek"
 __license__ = "GPLv3"
 
 import csv
+import hashlib
 import json
 import math
 from datetime import timedelta
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.paginator import Paginator
-from django.db.models import Count
 from django.db.models import F
 from django.db.models import Q
 from django.http import HttpRequest
@@ -46,6 +47,7 @@ from typing import List
 
 from .forms import UserCreationFormWithoutPassword
 from .models import Device
+from .models import DeviceSummary
 from .models import Measurement
 from .models import Status
 from .models import User
@@ -67,8 +69,9 @@ class UpdateStatuses(View):
         from geopy.geocoders import Nominatim
 
         geolocator = Nominatim(user_agent="open_asset_tracker_webserver")
-        for s in Status.objects.filter(city=None):
+        for s in Status.objects.filter(city=None, position_pending=False):
             s.set_city(geolocator)
+            DeviceSummary.update_position(s)
             import time
 
             time.sleep(1)
@@ -100,14 +103,17 @@ class DetailInfoView(View):
     def post(self, request: HttpRequest):
         if request.POST["type"] == "status":
             status = Status.objects.get(id=request.POST["id"])
+            if status.position_pending:
+                # Noch keine Position, (0, 0) wäre irreführend
+                return JsonResponse({"pending": True}, status=409)
             response = {"lat": status.lat, "lon": status.lon, "radius": status.radius}
 
             if request.session.get("debug"):
                 measurements: List[Measurement] = status.cleaned_measurements
                 response["cells"] = [
                     {
-                        "lat": m.celltower.lat,
-                        "lon": m.celltower.lon,
+                        "lat": m.tower.lat,
+                        "lon": m.tower.lon,
                         "radius": m.distance.meters,
                     }
                     for m in measurements
@@ -117,6 +123,79 @@ class DetailInfoView(View):
         return HttpResponseBadRequest()
 
 
+# Sekunden, ein neuer Status des Geräts macht die Einträge ohnehin ungültig (last_position_id im Schlüssel)
+TABLEDATA_CACHE_TTL = 300
+# Spalten der Statustabelle ohne NULL Werte, nach diesen wird über (Wert, id) statt OFFSET geblättert
+TABLEDATA_KEYSET_COLUMNS = {
+    0: "timestamp",
+    3: "celltower_count",
+    4: "temp",
+    5: "voltage",
+}
+
+
+def _tabledata_key(device: Device, data: dict) -> str:
+    # Jede Änderung an den Status des Geräts erhöht revision, ältere Zählungen und Cursor werden nicht mehr gelesen
+    try:
+        revision = device.summary.revision
+    except DeviceSummary.DoesNotExist:
+        revision = None
+    signature = json.dumps(
+        [
+            device.id,
+            revision,
+            data.get("timespan"),
+            data.get("search", {}).get("value"),
+            data.get("order"),
+        ],
+        sort_keys=True,
+    )
+    return f"tabledata:status:{hashlib.blake2b(signature.encode(), digest_size=16).hexdigest()}"
+
+
+def _cached_count(device: Device, data: dict, query) -> int:
+    key = f"{_tabledata_key(device, data)}:count"
+    count = cache.get(key)
+    if count is None:
+        count = query.count()
+        cache.set(key, count, TABLEDATA_CACHE_TTL)
+    return count
+
+
+def _status_page(device: Device, data: dict, status_query) -> List[Status]:
+    """Seite ab ``data["start"]``.
+
+    Bei Sortierung nach einer Spalte aus TABLEDATA_KEYSET_COLUMNS wird nach jeder Seite (Wert, id) ihres letzten
+    Status gemerkt, die direkt folgende Seite setzt dort statt mit OFFSET an. Sprünge auf andere Seiten nutzen OFFSET.
+    """
+    start = int(data["start"])
+    length = int(data["length"])
+    if length < 1:
+        # "Alle" in DataTables
+        return list(status_query[start:])
+    field = None
+    if len(data["order"]) == 1:
+        field = TABLEDATA_KEYSET_COLUMNS.get(int(data["order"][0]["column"]))
+    key = _tabledata_key(device, data)
+    cursor = cache.get(f"{key}:{start}") if field and start else None
+    if cursor is not None:
+        value, status_id = cursor
+        lookup = "lt" if data["order"][0]["dir"] == "desc" else "gt"
+        after = Q(**{f"{field}__{lookup}": value}) | Q(
+            **{field: value, "id__gt": status_id}
+        )
+        page = list(status_query.filter(after)[:length])
+    else:
+        page = list(status_query[start : start + length])
+    if field and len(page) == length:
+        cache.set(
+            f"{key}:{start + length}",
+            (getattr(page[-1], field), page[-1].id),
+            TABLEDATA_CACHE_TTL,
+        )
+    return page
+
+
 @method_decorator(login_required, "dispatch")
 class TabledataView(View):
     def post(self, request: HttpRequest):
@@ -134,9 +213,9 @@ class TabledataView(View):
                 F("timestamp"),
                 F("city__country__code"),
                 F("city__name"),
-                F("celltower__count"),
+                F("celltower_count"),
                 F("temp"),
-                F("voltage_raw"),
+                F("voltage"),
             ]
             device = None
 
@@ -146,17 +225,26 @@ class TabledataView(View):
                 response["recordsTotal"] = 0
             else:
                 try:
-                    device = Device.objects.get(sn=int(data["imei"]))
-                    if request.user not in device.users.all():
+                    device = Device.objects.select_related("summary").get(
+                        sn=int(data["imei"])
+                    )
+                    if not device.users.filter(id=request.user.id).exists():
                         return HttpResponseForbidden()
-                    status_query = Status.objects.filter(device=device).annotate(Count("celltower"))
+                    # Status ohne berechnete Position stehen bei (0, 0), sie erscheinen erst mit Position
+                    status_query = Status.objects.filter(
+                        device=device, position_pending=False
+                    )
                     if data["timespan"]["start"] != 0:
                         status_query = status_query.filter(
-                            timestamp__gt=timezone.datetime.fromtimestamp(data["timespan"]["start"])
+                            timestamp__gt=timezone.datetime.fromtimestamp(
+                                data["timespan"]["start"]
+                            )
                         )
                     if data["timespan"]["end"] != 0:
                         status_query = status_query.filter(
-                            timestamp__lt=timezone.datetime.fromtimestamp(data["timespan"]["end"])
+                            timestamp__lt=timezone.datetime.fromtimestamp(
+                                data["timespan"]["end"]
+                            )
                         )
                     if len(data["search"]["value"]) > 0:
                         status_query = status_query.filter(
@@ -164,20 +252,28 @@ class TabledataView(View):
                             | Q(city__country__code__contains=data["search"]["value"])
                             | Q(city__country__name__contains=data["search"]["value"])
                         )
-                    status_query = (
-                        status_query.all()
-                        .order_by(*[col_map[o["column"]].__getattribute__(o["dir"])() for o in data["order"]])
-                        .all()
-                    )
+                    order = [
+                        col_map[o["column"]].__getattribute__(o["dir"])()
+                        for o in data["order"]
+                    ]
+                    # id als letzte Sortierung, damit Seiten auch bei gleichen Werten stabil sind
+                    status_query = status_query.select_related(
+                        "city__country"
+                    ).order_by(*order, "id")
+                    page = _status_page(device, data, status_query)
                 except Exception as e:
                     response["error"] = str(e)
                     status_query = Status.objects.none()
+                    page = []
 
-                paginator = Paginator(status_query, data["length"])
                 response["data"] = [
                     {
                         "timestamp": {
-                            "display": str(timezone.localtime(s.timestamp).strftime("%d.%m.%Y %H:%M:%S")),
+                            "display": str(
+                                timezone.localtime(s.timestamp).strftime(
+                                    "%d.%m.%Y %H:%M:%S"
+                                )
+                            ),
                             "timestamp": int(s.timestamp.timestamp()),
                         },
                         "battery": {
@@ -190,11 +286,11 @@ class TabledataView(View):
                         "id": s.id,
                         "radius": s.radius * 1000,
                         "city": s.city.name if s.city else "???",
-                        "celltower": len(s.cleaned_measurements),
-                        "country": s.country.code if s.country else "???",
+                        "celltower": s.celltower_count,
+                        "country": s.city.country.code if s.city else "???",
                         "temp": s.temp if s.temp != -math.inf else "???",
                     }
-                    for s in paginator.get_page(int(data["start"]) / paginator.per_page + 1)
+                    for s in page
                 ]
                 if request.session.get("debug"):
                     nextwake = device.next_update_expected()
@@ -202,7 +298,11 @@ class TabledataView(View):
                         0,
                         {
                             "timestamp": {
-                                "display": str(timezone.localtime(nextwake).strftime("%d.%m.%Y %H:%M:%S")),
+                                "display": str(
+                                    timezone.localtime(nextwake).strftime(
+                                        "%d.%m.%Y %H:%M:%S"
+                                    )
+                                ),
                                 "timestamp": int(nextwake.timestamp()),
                             },
                             "battery": {"voltage": 0, "percentage": 0, "display": "-"},
@@ -216,21 +316,34 @@ class TabledataView(View):
                             "temp": "...",
                         },
                     )
-                response["recordsFiltered"] = paginator.count
-                response["recordsTotal"] = Status.objects.filter(device=device).count() if data["imei"] != 0 else 0
+                if device is not None:
+                    response["recordsTotal"] = _cached_count(
+                        device,
+                        {},
+                        Status.objects.filter(device=device, position_pending=False),
+                    )
+                    response["recordsFiltered"] = _cached_count(
+                        device, data, status_query
+                    )
 
         elif data["type"] == "tracker":
-            col_map = ["sn", "alias", "last_position__voltage_raw"]
+            col_map = ["sn", "alias", "summary__voltage"]
             try:
                 devices = (
                     request.user.devices.filter(
-                        Q(sn__contains=data["search"]["value"]) | Q(alias__contains=data["search"]["value"])
+                        Q(sn__contains=data["search"]["value"])
+                        | Q(alias__contains=data["search"]["value"])
+                    )
+                    .select_related("summary")
+                    .order_by(
+                        *[
+                            F(col_map[o["column"]]).__getattribute__(o["dir"])()
+                            for o in data["order"]
+                        ]
                     )
-                    .all()
-                    .order_by(*[F(col_map[o["column"]]).__getattribute__(o["dir"])() for o in data["order"]])
                 )
             except Exception as e:
-                devices = []
+                devices = Device.objects.none()
                 response["error"] = str(e)
             paginator = Paginator(devices, int(data["length"]))
             response["data"] = [
@@ -246,8 +359,8 @@ class TabledataView(View):
                 for d in paginator.get_page(int(data["start"]) / paginator.per_page + 1)
             ]
 
-            response["recordsTotal"] = len(request.user.devices.all())
-            response["recordsFiltered"] = len(devices)
+            response["recordsTotal"] = request.user.devices.count()
+            response["recordsFiltered"] = paginator.count
         else:
             return HttpResponseBadRequest()
         for d in response["data"]:
@@ -284,7 +397,7 @@ class ExportDevice(View):
         if end == timezone.datetime.fromtimestamp(0):
             end = timezone.datetime.max
 
-        status_query = device.status_set.all()
+        status_query = device.status_set.filter(position_pending=False)
         if start != timezone.datetime.min:
             status_query = status_query.filter(timestamp__gt=start)
         if end != timezone.datetime.max:
@@ -336,7 +449,12 @@ class ExportDevice(View):
             kwargs_list = []
             for i, df in enumerate(DistanceFunction):
                 for j, ef in enumerate(ErrorFunction):
-                    for k, oa in enumerate(OptimizationAlgorithm):
+                    # Wie bisher nur die scipy Verfahren, der Export vergleicht deren Varianten
+                    for k, oa in enumerate(
+                        a
+                        for a in OptimizationAlgorithm
+                        if a != OptimizationAlgorithm.LINEAR_LSQ
+                    ):
                         for max_tower in range(1, 8):
                             for r in (False, True):
                                 kwargs_list.append(
@@ -370,7 +488,9 @@ class ExportDevice(View):
                         f"{kwargs['distance_function'].name}-{kwargs['error_function'].name}-{kwargs['oa'].name}-{kwargs['max_tower']}{'-random' if kwargs['random_tower'] else ''}"
                     )
                     segment = gpxpy.gpx.GPXTrackSegment()
-                    for (latitude, longitude), distance, time in zip(points, distances, times):
+                    for (latitude, longitude), distance, time in zip(
+                        points, distances, times
+                    ):
                         segment.points.append(
                             gpxpy.gpx.GPXTrackPoint(
                                 latitude=latitude,
@@ -393,6 +513,24 @@ class WebManifestView(TemplateView):
     content_type = "application/manifest+json"
 
 
+class MetricsView(View):
+    """Prometheus Textformat, für Staff oder mit dem Token aus settings.METRICS als Bearer."""
+
+    def get(self, request: HttpRequest):
+        from . import metrics
+
+        token = metrics.get_config().get("TOKEN")
+        authorized = request.user.is_staff or (
+            token and request.headers.get("Authorization", "") == f"Bearer {token}"
+        )
+        if not authorized:
+            return HttpResponseForbidden()
+        return HttpResponse(
+            metrics.render_prometheus(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
 class CelltowerView(View):
     def get(self, request: HttpRequest, stunden: int):
         devices = Device.objects.all()
@@ -400,7 +538,9 @@ class CelltowerView(View):
 
         for device in devices:
             response[device.alias] = []
-            status_set = device.status_set.filter(timestamp__gte=timezone.now() - timedelta(hours=stunden))
+            status_set = device.status_set.filter(
+                timestamp__gte=timezone.now() - timedelta(hours=stunden)
+            )
             celltower_set = set()
             for s in status_set:
                 for m in s.measurements.all():
@@ -409,7 +549,9 @@ class CelltowerView(View):
             for celltower in celltower_set:
                 response[device.alias].append(
                     {
-                        "count": status_set.filter(measurements__celltower=celltower).count(),
+                        "count": status_set.filter(
+                            measurements__celltower=celltower
+                        ).count(),
                         "lat": celltower.lat,
                         "lon": celltower.lon,
                         "cid": hex(celltower.cid),
@@ -447,14 +589,18 @@ class AdminControlView(View):
 class TrackerDataView(View):
     def get(self, request: HttpRequest, imei: int):
         device = Device.objects.get(sn__exact=imei)
-        if not device.users.filter(id=request.user.id).exists() and not request.user.is_staff:
+        if (
+            not device.users.filter(id=request.user.id).exists()
+            and not request.user.is_staff
+        ):
             return HttpResponseForbidden()
         return JsonResponse(device.get_json_data(include_users=request.user.is_staff))
 
     def post(self, request: HttpRequest, imei: int):
         device = Device.objects.get(sn__exact=imei)
         if int(request.POST["imei"]) != imei or (
-            not device.users.filter(id=request.user.id).exists() and not request.user.is_staff
+            not device.users.filter(id=request.user.id).exists()
+            and not request.user.is_staff
         ):
             return HttpResponseForbidden()
         device.alias = request.POST["alias"]